@@ -0,0 +1,394 @@
+"""AsyncUtils.py
+
+Drive many subprocesses and expect sessions from a single thread.
+
+This is a small poll()-based event loop for generator tasks
+(Python 2 has no asyncio).  A task is a generator that yields
+wait requests (Readable, Sleep), other generators (sub-tasks, whose
+result is sent back in), or a Result to finish with a value:
+
+    def task(sub):
+        out = yield check_output(sub, ('show', 'version',))
+        yield Result(out.strip())
+
+    loop = EventLoop()
+    tasks = [loop.spawn(task(x)) for x in subs]
+    loop.run()
+    print [t.result for t in tasks]
+"""
+
+import sys, os
+import time
+import errno
+import select
+import subprocess
+import pexpect
+
+import ConsoleUtils
+
+class Result(object):
+    """Yield this from a task to finish it with a value."""
+
+    def __init__(self, value=None):
+        self.value = value
+
+class Readable(object):
+    """Wait for a file descriptor to become readable.
+
+    The task resumes with True, or False if the timeout expired.
+    """
+
+    def __init__(self, fd, timeout=None):
+        self.fd = fd
+        self.timeout = timeout
+
+class Sleep(Readable):
+
+    def __init__(self, timeout):
+        Readable.__init__(self, None, timeout)
+
+class Task(object):
+
+    def __init__(self, gen):
+        self.stack = [gen]
+        self.wait = None
+        self.deadline = None
+        self.done = False
+        self.result = None
+        self.exc_info = None
+
+    @property
+    def exc(self):
+        return self.exc_info[1] if self.exc_info else None
+
+class EventLoop(object):
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, gen):
+        task = Task(gen)
+        self.tasks.append(task)
+        self._step(task, None)
+        return task
+
+    def _finish(self, task, value=None, exc_info=None):
+        task.done = True
+        task.wait = task.deadline = None
+        task.result = value
+        task.exc_info = exc_info
+
+    def _step(self, task, value):
+        """Run a task until it blocks or finishes."""
+
+        exc_info = None
+        while True:
+
+            gen = task.stack[-1]
+            try:
+                if exc_info is not None:
+                    req = gen.throw(*exc_info)
+                    exc_info = None
+                else:
+                    req = gen.send(value)
+            except StopIteration:
+                req = Result()
+            except Exception:
+                exc_info = sys.exc_info()
+                task.stack.pop()
+                if not task.stack:
+                    self._finish(task, exc_info=exc_info)
+                    return
+                continue
+
+            if isinstance(req, Result):
+                gen.close()
+                task.stack.pop()
+                value = req.value
+                if not task.stack:
+                    self._finish(task, value=value)
+                    return
+                continue
+
+            if hasattr(req, 'send') and hasattr(req, 'throw'):
+                task.stack.append(req)
+                value = None
+                continue
+
+            if isinstance(req, Readable):
+                task.wait = req
+                if req.timeout is not None:
+                    task.deadline = time.time() + req.timeout
+                else:
+                    task.deadline = None
+                return
+
+            exc_info = (TypeError, TypeError("invalid request %r" % req), None,)
+
+    def run(self, deadline=None):
+        """Run until all tasks are done, or until 'deadline' seconds pass.
+
+        Returns True if all tasks completed.
+        """
+
+        stopAt = time.time() + deadline if deadline is not None else None
+
+        while True:
+
+            waiting = [x for x in self.tasks if not x.done]
+            if not waiting:
+                return True
+
+            now = time.time()
+            if stopAt is not None and now >= stopAt:
+                return False
+
+            poller = select.poll()
+            fds = {}
+            timeouts = []
+            for task in waiting:
+                if task.wait.fd is not None:
+                    fds.setdefault(task.wait.fd, []).append(task)
+                    poller.register(task.wait.fd, select.POLLIN|select.POLLPRI)
+                if task.deadline is not None:
+                    timeouts.append(task.deadline)
+            if stopAt is not None:
+                timeouts.append(stopAt)
+
+            if timeouts:
+                ms = max(0, int((min(timeouts) - now) * 1000.0 + 0.5))
+            else:
+                ms = None
+
+            try:
+                events = poller.poll(ms)
+            except select.error, what:
+                if what.args[0] == errno.EINTR: continue
+                raise
+
+            for fd, ev in events:
+                for task in fds.get(fd, []):
+                    if not task.done:
+                        task.wait = task.deadline = None
+                        self._step(task, True)
+
+            now = time.time()
+            for task in waiting:
+                if (not task.done
+                    and task.wait is not None
+                    and task.deadline is not None
+                    and now >= task.deadline):
+                    task.wait = task.deadline = None
+                    self._step(task, False)
+
+def runTasks(gens, deadline=None):
+    """Run a list of task generators to completion, return the Tasks."""
+    loop = EventLoop()
+    tasks = [loop.spawn(x) for x in gens]
+    loop.run(deadline=deadline)
+    return tasks
+
+######################################################################
+#
+# subprocess counterparts
+#
+######################################################################
+
+def wait(proc):
+    """Wait for a process to exit without blocking the loop."""
+    delay = 0.005
+    while proc.poll() is None:
+        yield Sleep(delay)
+        delay = min(delay*2, 0.1)
+    yield Result(proc.returncode)
+
+def communicate(proc):
+    """Collect a process's stdout, then wait for it to exit."""
+    fd = proc.stdout.fileno()
+    bufs = []
+    while True:
+        yield Readable(fd)
+        buf = os.read(fd, 65536)
+        if not buf: break
+        bufs.append(buf)
+    proc.stdout.close()
+    yield wait(proc)
+    yield Result("".join(bufs))
+
+def _getCmd(popenargs, kwargs):
+    cmd = kwargs.get("args")
+    if cmd is None:
+        cmd = popenargs[0]
+    return cmd
+
+def call(sub, *popenargs, **kwargs):
+    """Generator version of SubprocessBase.call()."""
+    proc = sub.popen(*popenargs, **kwargs)
+    code = yield wait(proc)
+    yield Result(code)
+
+def check_call(sub, *popenargs, **kwargs):
+    """Generator version of SubprocessBase.check_call()."""
+    proc = sub.popen(*popenargs, **kwargs)
+    code = yield wait(proc)
+    if code:
+        raise subprocess.CalledProcessError(code, _getCmd(popenargs, kwargs))
+    yield Result(0)
+
+def check_output(sub, *popenargs, **kwargs):
+    """Generator version of SubprocessBase.check_output()."""
+    if 'stdout' in kwargs:
+        raise ValueError('stdout argument not allowed, it will be overridden.')
+    proc = sub.popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
+    output = yield communicate(proc)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, _getCmd(popenargs, kwargs),
+                                            output=output)
+    yield Result(output)
+
+######################################################################
+#
+# expect counterparts
+#
+######################################################################
+
+def expect(sp, patterns, timeout=-1):
+    """Generator version of pexpect.spawn.expect().
+
+    Like expect(), returns the index of the matching pattern, or
+    raises TIMEOUT/EOF if those are not in the pattern list.
+    """
+
+    if timeout == -1:
+        timeout = sp.timeout
+    stopAt = time.time() + timeout if timeout is not None else None
+
+    pats = [x for x in patterns if x is not pexpect.TIMEOUT]
+    idx = [i for i, x in enumerate(patterns) if x is not pexpect.TIMEOUT]
+
+    while True:
+        i = sp.expect(pats + [pexpect.TIMEOUT,], timeout=0)
+        if i < len(pats):
+            yield Result(idx[i])
+            return
+
+        remaining = stopAt - time.time() if stopAt is not None else None
+        if remaining is not None and remaining <= 0:
+            if pexpect.TIMEOUT in patterns:
+                yield Result(patterns.index(pexpect.TIMEOUT))
+                return
+            raise pexpect.TIMEOUT("timeout exceeded")
+
+        yield Readable(sp.child_fd, remaining)
+
+def _loginRoot(sub, ctl, passwd):
+    """Log in with a password and get to a root bash prompt."""
+
+    i = yield expect(ctl, ["password: $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_LOGIN)
+    if i != 0:
+        raise pexpect.ExceptionPexpect("cannot get password prompt")
+
+    ctl.sendline(passwd)
+    i = yield expect(ctl, ["[>] $", "[#] $", pexpect.TIMEOUT, pexpect.EOF], timeout=ConsoleUtils.TIMEOUT_LOGIN)
+    if i > 1:
+        raise pexpect.ExceptionPexpect("cannot get bash prompt")
+
+    if i == 0:
+        # controller admin Cli
+        ctl.sendline("debug bash")
+        i = yield expect(ctl, ["[$] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+        if i != 0:
+            raise pexpect.ExceptionPexpect("cannot get bash prompt")
+
+    ctl.sendline(sub.ROOT_SHELL)
+    i = yield expect(ctl, ["[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+    if i != 0:
+        raise pexpect.ExceptionPexpect("cannot get bash prompt")
+
+def enableRoot(sub):
+    """Generator version of enableRoot().
+
+    Works with ControllerAdminSubprocess, SwitchInternalSshSubprocess
+    and SwitchRootSubprocess (and subclasses).
+    """
+
+    passwd = getattr(sub, 'PASS', None) or sub.popen_klass.PASS
+
+    ctl = sub.spawn(agent=False)
+    yield _loginRoot(sub, ctl, passwd)
+
+    for cmd in ConsoleUtils.getRootKeyCmds():
+        ctl.sendline(" ".join(cmd))
+        i = yield expect(ctl, ["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+        if i != 0:
+            raise pexpect.ExceptionPexpect("command failed: %d" % i)
+
+    # the old batch SSH status is no longer valid
+    ConsoleUtils.invalidateBatchSsh(sub.host)
+
+    yield Result(0)
+
+def _connectSwitch(sub, timeout):
+    """Connect to the switch Cli and enter 'debug admin'."""
+
+    sw = sub.spawn()
+    i = yield expect(sw, ["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+    if i != 0:
+        raise subprocess.CalledProcessError(i,
+                                            ('connect', 'switch', sub.switch,),
+                                            sw.before)
+
+    sw.sendline("debug admin")
+    i = yield expect(sw, ["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=timeout)
+    if i != 0:
+        raise subprocess.CalledProcessError(i, ('debug', 'admin',), sw.before)
+
+    yield Result(sw)
+
+def enableRecovery2(sub):
+    """Generator version of SwitchConnectMixin.enableRecovery2()."""
+
+    sw = yield _connectSwitch(sub, ConsoleUtils.TIMEOUT_SHORT)
+
+    for cmd, pat in (("enable", "[#] $",),
+                     ("debug bash", "[#] $",),
+                     ("exec bash -e", "[#] $",),):
+        sw.sendline(cmd)
+        i = yield expect(sw, [pat, pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+        if i != 0:
+            raise subprocess.CalledProcessError(i, tuple(cmd.split()), sw.before)
+
+    for cmd in (("PS1='BASH# '",), ('echo', 'hello',),):
+        sw.sendline(" ".join(cmd))
+        i = yield expect(sw, ["BASH[#] $", "[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+        if i != 0:
+            raise subprocess.CalledProcessError(i, cmd, sw.before)
+
+    for cmd in ConsoleUtils.getRecovery2KeyCmds():
+        sw.sendline(" ".join(cmd))
+        i = yield expect(sw, ["BASH[#] $", "[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+        if i != 0:
+            raise subprocess.CalledProcessError(i, ('...',), sw.before)
+
+    yield Result(0)
+
+def switchCheckOutput(sub, cmd):
+    """Generator version of SwitchConnectMixin.check_output()."""
+
+    sw = yield _connectSwitch(sub, ConsoleUtils.TIMEOUT_LONG)
+
+    if isinstance(cmd, basestring):
+        sw.sendline(cmd)
+    else:
+        sw.sendline(" ".join(cmd))
+    i = yield expect(sw, ["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=ConsoleUtils.TIMEOUT_LONG)
+    if i != 0:
+        raise subprocess.CalledProcessError(i, cmd, sw.before)
+    buf = sw.before
+
+    sw.sendline('exit')
+    i = yield expect(sw, [pexpect.EOF, "[>] $", pexpect.TIMEOUT,], timeout=ConsoleUtils.TIMEOUT_SHORT)
+    if i != 0:
+        raise subprocess.CalledProcessError(i, ('exit',), buf+sw.before)
+
+    yield Result(buf)
@@ -0,0 +1,340 @@
+"""BenchUtils.py
+
+Micro-benchmarks for the hot helpers in ConsoleUtils and IpUtils.
+
+Inputs are generated (sized like a real fleet), so the suite runs
+offline.  Run with bench-utils, e.g.
+
+  bench-utils --scale 2000 --json results.json
+  bench-utils --save-baseline
+  bench-utils --check --threshold 0.25
+"""
+
+import os
+import sys
+import time
+import json
+
+import ConsoleUtils
+import IpUtils
+import CacheUtils
+
+def makeCliTable(rows, warnings=0):
+    """Generate 'show switch' style table output with 'rows' rows."""
+    legend = ("#    Switch Name    IP Address                Switch MAC Address      "
+              "Connected Since               Fabric Role  ")
+    sep    = ("----|--------------|-------------------------|-----------------------|"
+              "-----------------------------|------------|")
+    lines = ["Warning: this is a warning",] * warnings
+    lines.append(legend)
+    lines.append(sep)
+    for i in xrange(1, rows+1):
+        mac = "70:72:cf:%02x:%02x:%02x" % ((i>>16) & 0xff, (i>>8) & 0xff, i & 0xff,)
+        ip = "fe80::7272:cf%02x:fe%02x:%02x%02x%%9" % ((i>>16) & 0xff, (i>>8) & 0xff, 0, i & 0xff,)
+        lines.append("%-4d %-14s %-25s %-23s %-29s %-12s"
+                     % (i, "leaf%d" % i, ip, mac,
+                        "2016-04-04 10:00:%02d.000000 UTC" % (i % 60),
+                        "leaf" if i % 4 else "spine",))
+    return "\n".join(lines) + "\n"
+
+def makeCliDetail(rows):
+    """Generate 'show ... details' style output."""
+    lines = []
+    for i in xrange(rows):
+        lines.append("%-30s : %s" % ("Attribute %d" % i, "value %d" % (i*7,),))
+    return "\n".join(lines) + "\n"
+
+def makeMacs(count):
+    return ["70:72:cf:%02x:%02x:%02x" % ((i>>16) & 0xff, (i>>8) & 0xff, i & 0xff,)
+            for i in xrange(count)]
+
+def makeV6Addrs(count):
+    return ["fe80::7272:cfff:fe%02x:%02x%02x" % ((i>>16) & 0xff, (i>>8) & 0xff, i & 0xff,)
+            for i in xrange(count)]
+
+def makeWords(count):
+    """Command-line words, some needing quotes."""
+    words = ("show", "running-config", "switch leaf1a", "interface 'eth1'",
+             "description \"uplink to spine\"", "$HOME/*.cfg", "a;b|c", "echo `id`!",)
+    return [words[i % len(words)] + str(i) for i in xrange(count)]
+
+def makeCliTables(tables, rows):
+    """Generate multi-table ('~ Title ~') output."""
+    bufs = []
+    for i in xrange(tables):
+        bufs.append("~~~~~~~~~~~~~~~~~~ Table %d ~~~~~~~~~~~~~~~~~~\n" % i)
+        bufs.append(makeCliTable(rows))
+    return "".join(bufs)
+
+# reference implementations (as of before the span caching), kept
+# to check the current parsers for speed and for identical output
+
+def legacyParseCliTableRow(legend, sep, data):
+
+    cols = [x for x in enumerate(sep) if x[1] == '|']
+    cols = [x[0] for x in cols]
+    m = {}
+    p = 0
+    idx = None
+    while cols:
+        q = cols.pop(0)
+        key = legend[p:q].strip()
+        val = data[p:q].strip()
+        if key == '#':
+            idx = int(val)
+        else:
+            m[key] = val
+        p = q+1
+
+    if idx is None:
+        raise ValueError("invalid data: %s" % data)
+
+    return idx, m
+
+def legacyParseCliTable(buf):
+
+    lines = buf.strip().splitlines()
+    while lines:
+        line = lines[0]
+        if line.startswith('#'):
+            break
+        if ':' in line:
+            sys.stderr.write(lines.pop(0) + "\n")
+        elif line == 'None.':
+            return []
+        else:
+            raise ValueError("invalid cli output: %s" % line)
+
+    legend, sep, rest = lines[0], lines[1], lines[2:]
+    m = {}
+    sz = -sys.maxint
+    while rest:
+        idx, rec = legacyParseCliTableRow(legend, sep, rest.pop(0))
+        m[idx] = rec
+        sz = max(sz, idx)
+
+    l = [{}] * sz
+    for key, val in m.iteritems():
+        l[key-1] = val
+
+    return l
+
+def legacyParseCliTables(buf):
+    m = {}
+    while buf:
+
+        if not buf.startswith('~'):
+            raise ValueError("extra data: %s" % buf)
+
+        line, sep, buf = buf.partition("\n")
+        if not sep:
+            raise ValueError("extra data: %s" % line)
+
+        title = line.strip().strip('~').strip()
+
+        p = buf.find("\n~")
+        if p > -1:
+            m[title] = legacyParseCliTable(buf[:p])
+            buf = buf[p+1:]
+        else:
+            m[title] = legacyParseCliTable(buf)
+            buf = ""
+
+    return m
+
+def timeIt(fn, args, repeat=5, number=1):
+    """Return the best wall time (seconds) of 'repeat' runs of fn(*args)."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for j in xrange(number):
+            fn(*args)
+        dur = (time.time() - start) / number
+        if best is None or dur < best:
+            best = dur
+    return best
+
+class Bench(object):
+    """Time a function, optionally against a reference implementation.
+
+    'items' is the number of inputs handled by one call, used to
+    report the time per item.
+    """
+
+    def __init__(self, name, fn, ref, args, number=1, items=1):
+        self.name = name
+        self.fn = fn
+        self.ref = ref
+        self.args = args
+        self.number = number
+        self.items = items
+
+    def check(self):
+        """Make sure both implementations give the same result."""
+        if self.ref is None:
+            return
+        a = self.fn(*self.args)
+        b = self.ref(*self.args)
+        if a != b:
+            raise ValueError("%s: output differs from reference" % self.name)
+
+    def run(self, repeat=5):
+        self.check()
+        t = timeIt(self.fn, self.args, repeat=repeat, number=self.number)
+        r = None
+        if self.ref is not None:
+            r = timeIt(self.ref, self.args, repeat=repeat, number=self.number)
+        return t, r
+
+def _mapper(fn):
+    def _map(l):
+        return [fn(x) for x in l]
+    return _map
+
+def getCliBenches(rows=1000, tables=10):
+    table = makeCliTable(rows)
+    tbls = makeCliTables(tables, rows // tables or 1)
+    lines = table.splitlines()
+    legend, sep, row = lines[0], lines[1], lines[2]
+    detail = makeCliDetail(rows)
+    return [Bench("parseCliTableRow",
+                  ConsoleUtils.parseCliTableRow, legacyParseCliTableRow,
+                  (legend, sep, row,), number=1000),
+            Bench("parseCliTable/%d" % rows,
+                  ConsoleUtils.parseCliTable, legacyParseCliTable,
+                  (table,), items=rows),
+            Bench("parseCliTables/%dx%d" % (tables, rows // tables or 1,),
+                  ConsoleUtils.parseCliTables, legacyParseCliTables,
+                  (tbls,), items=rows),
+            Bench("parseCliDetail/%d" % rows,
+                  ConsoleUtils.parseCliDetail, None,
+                  (detail,), items=rows),]
+
+def getQuoteBenches(count=1000):
+    words = makeWords(count)
+    return [Bench("quote/%d" % count,
+                  _mapper(ConsoleUtils.quote), None, (words,), items=count),
+            Bench("quotePcli/%d" % count,
+                  _mapper(ConsoleUtils.quotePcli), None, (words,), items=count),]
+
+def getIpBenches(count=1000):
+    macs = makeMacs(count)
+    addrs = makeV6Addrs(count)
+    nums = [IpUtils.pton(x) for x in addrs]
+    return [Bench("pton/%d" % count,
+                  _mapper(IpUtils.pton), None, (addrs,), items=count),
+            Bench("ntop/%d" % count,
+                  _mapper(IpUtils.ntop), None, (nums,), items=count),
+            Bench("mton/%d" % count,
+                  _mapper(IpUtils.mton), None, (macs,), items=count),
+            Bench("getV6AddrFromMac/%d" % count,
+                  _mapper(lambda x: IpUtils.getV6AddrFromMac(x, intf="eth0")), None,
+                  (macs,), items=count),
+            Bench("ptonMany/%d" % count,
+                  IpUtils.ptonMany, _mapper(IpUtils.pton), (addrs,), items=count),
+            Bench("ntopMany/%d" % count,
+                  IpUtils.ntopMany, _mapper(IpUtils.ntop), (nums,), items=count),
+            Bench("mtonMany/%d" % count,
+                  IpUtils.mtonMany, _mapper(IpUtils.mton), (macs,), items=count),
+            Bench("getV6AddrsFromMacs/%d" % count,
+                  lambda l: IpUtils.getV6AddrsFromMacs(l, intf="eth0"),
+                  _mapper(lambda x: IpUtils.getV6AddrFromMac(x, intf="eth0")),
+                  (macs,), items=count),
+            Bench("getMacsFromV6Addrs/%d" % count,
+                  IpUtils.getMacsFromV6Addrs, _mapper(IpUtils.getMacFromV6Addr),
+                  (addrs,), items=count),]
+
+def _setupSsh():
+    """Let the ssh command builders run without a real key or agent."""
+    if 'TESTS_SSH_KEY' not in os.environ or 'SSH_AUTH_SOCK' not in os.environ:
+        os.environ.setdefault('TESTS_SSH_KEY', "/nonexistent/bench-key")
+        ConsoleUtils._pubKeyFpr = ConsoleUtils._pubKeyFpr or "bench"
+
+def getWrapBenches(count=1000):
+    _setupSsh()
+    hosts = ["fe80::7272:cfff:fe00:%x%%eth0" % i for i in xrange(count)]
+    cmd = ('show', 'running-config', 'switch', 'leaf1a',)
+
+    def ssh(l):
+        return [ConsoleUtils.SshPopen.wrap_params(cmd, host=h, user='root', agent=False)
+                for h in l]
+    def cli(l):
+        return [ConsoleUtils.ControllerCliPopen.wrap_params(cmd, host=h, user='root',
+                                                            mode='enable', agent=False)
+                for h in l]
+    def pcli(l):
+        return [ConsoleUtils.SwitchPcliPopen.wrap_params(cmd, host=h, user='recovery2',
+                                                         agent=False)
+                for h in l]
+
+    return [Bench("SshPopen.wrap_params/%d" % count, ssh, None, (hosts,), items=count),
+            Bench("ControllerCliPopen.wrap_params/%d" % count, cli, None, (hosts,), items=count),
+            Bench("SwitchPcliPopen.wrap_params/%d" % count, pcli, None, (hosts,), items=count),]
+
+def getSuite(scale=1000, tables=10):
+    return (getCliBenches(rows=scale, tables=tables)
+            + getQuoteBenches(scale)
+            + getIpBenches(scale)
+            + getWrapBenches(scale))
+
+def runBenches(benches, repeat=5, fd=sys.stdout, pattern=None):
+    """Run the benchmarks, report on 'fd' and return the results.
+
+    The results map each benchmark name to its 'time' (seconds per
+    call), 'item' (seconds per input item) and 'ref' (reference time,
+    or None).
+    """
+    results = {}
+    if fd is not None:
+        fd.write("%-36s %12s %10s %12s %8s\n"
+                 % ("benchmark", "time", "per item", "reference", "speedup",))
+    for b in benches:
+        if pattern and pattern not in b.name:
+            continue
+        t, r = b.run(repeat=repeat)
+        results[b.name] = {'time' : t, 'item' : t / b.items, 'ref' : r,}
+        if fd is None:
+            continue
+        if r is not None:
+            fd.write("%-36s %10.1fus %8.2fus %10.1fus %7.2fx\n"
+                     % (b.name, t*1e6, t*1e6/b.items, r*1e6, r/t if t else 0.0,))
+        else:
+            fd.write("%-36s %10.1fus %8.2fus %12s %8s\n"
+                     % (b.name, t*1e6, t*1e6/b.items, "-", "-",))
+    return results
+
+def getBaselinePath():
+    return os.path.join(CacheUtils.getCacheDir(), "bench-baseline.json")
+
+def loadResults(path):
+    with open(path) as fd:
+        data = json.load(fd)
+    return data.get('results', {})
+
+def saveResults(results, path):
+    data = {'time' : time.time(),
+            'python' : sys.version.split()[0],
+            'results' : results,}
+    d = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, "w") as fd:
+        json.dump(data, fd, indent=2, sort_keys=True)
+        fd.write("\n")
+
+def compareResults(results, baseline, threshold=0.2):
+    """Find benchmarks that got slower than the baseline.
+
+    Returns a list of (name, baseline time, current time) for
+    benchmarks that are more than 'threshold' (a fraction) slower.
+    Benchmarks missing from either side are ignored.
+    """
+    slow = []
+    for name in sorted(results.keys()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        cur = results[name]['time']
+        if cur > base['time'] * (1.0 + threshold):
+            slow.append((name, base['time'], cur,))
+    return slow
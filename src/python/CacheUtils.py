@@ -0,0 +1,116 @@
+"""CacheUtils.py
+
+Small persistent caches, shared between tool invocations.
+
+Set $TOOLS_CACHE_DIR to relocate the cache files.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+def getCacheDir():
+    d = os.environ.get('TOOLS_CACHE_DIR')
+    if d: return d
+    d = os.environ.get('XDG_CACHE_HOME')
+    if not d:
+        d = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(d, "carlroth-tools")
+
+class JsonCache(object):
+    """Dictionary persisted as a JSON file.
+
+    Updates are merged with the file contents on disk and written
+    atomically, so that concurrent scripts do not corrupt the cache
+    (though the last writer wins for a given key).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(getCacheDir(), name + ".json")
+        self.data = None
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def _write(self, data):
+        d = os.path.dirname(self.path)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d, 0700)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        fno, p = tempfile.mkstemp(prefix="." + self.name + "-", dir=d)
+        try:
+            with os.fdopen(fno, "w") as fd:
+                json.dump(data, fd, indent=2, sort_keys=True)
+            os.rename(p, self.path)
+        finally:
+            if os.path.exists(p):
+                os.unlink(p)
+
+    def load(self, reload=False):
+        with self.lock:
+            if self.data is None or reload:
+                self.data = self._read()
+            return self.data
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def update(self, m=None, remove=()):
+        """Set and remove several keys at once."""
+        with self.lock:
+            data = self._read()
+            data.update(m or {})
+            for key in remove:
+                data.pop(key, None)
+            self.data = data
+            try:
+                self._write(data)
+            except (IOError, OSError):
+                # the cache is advisory
+                pass
+
+    def put(self, key, val):
+        self.update({key : val})
+
+    def remove(self, key):
+        self.update(remove=(key,))
+
+FILE_DIGEST_CACHE = JsonCache("filedigests")
+
+def getFileDigest(path):
+    """Return the MD5 hex digest of a file.
+
+    Digests are cached by path, size and mtime, so that large files
+    (e.g. SWIs) are only hashed again after they change.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    ent = FILE_DIGEST_CACHE.get(path)
+    if ent and ent['size'] == st.st_size and ent['mtime'] == st.st_mtime:
+        return ent['md5']
+
+    h = hashlib.md5()
+    with open(path, "rb") as fd:
+        while True:
+            buf = fd.read(1<<20)
+            if not buf: break
+            h.update(buf)
+    digest = h.hexdigest()
+    FILE_DIGEST_CACHE.put(path, {'size' : st.st_size,
+                                 'mtime' : st.st_mtime,
+                                 'md5' : digest,})
+    return digest
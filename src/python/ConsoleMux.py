@@ -0,0 +1,588 @@
+"""ConsoleMux.py
+
+Daemon that keeps track consoles open, so that sessions can attach to
+a console instantly (see ConsoleUtils.TrackConsoleSubprocess).  Run it
+with console-mux.
+
+One epoll loop serves all of the consoles.  Each console runs 'track
+console HOST' on a pty; its recent output is kept in a ring buffer
+(so boot output between sessions is not lost) and the prompt it is
+sitting at is tracked from that output.
+
+Clients connect to a Unix socket and send one request line:
+
+  ATTACH HOST   attach to the console (opening it if needed); the reply
+                is 'OK STATE', then the current (prompt) line, then the
+                console output and input are relayed both ways
+  TAIL HOST N   reply 'OK STATE', then the last N bytes of output
+  LIST          reply with a JSON object describing each console
+  CLOSE HOST    close the console
+
+Errors are reported as 'ERROR message'.
+
+The socket is in $XDG_RUNTIME_DIR, or else in a private (0700)
+per-user directory under the temporary directory.  Clients only
+connect to a socket owned by, and served by a process of, the same
+user.
+"""
+
+import os
+import sys
+import re
+import json
+import time
+import errno
+import fcntl
+import select
+import signal
+import socket
+import stat
+import struct
+import termios
+import tempfile
+import subprocess
+
+CONSOLE_MUX_SOCKET = os.environ.get('CONSOLE_MUX_SOCKET')
+
+# console output kept per console
+MUX_RING_SIZE = 256<<10
+
+# console output queued for a slow client before it is dropped
+MUX_CLIENT_MAX = 1<<20
+
+# output searched for the prompt state
+MUX_TAIL = 512
+
+MUX_REQUEST_MAX = 1024
+
+# prompt states, tried in order against the end of the output
+MUX_STATES = (('login', re.compile("login: $")),
+              ('password', re.compile("[pP]assword: $")),
+              ('uboot', re.compile("(Hit any key to stop autoboot: *[0-9]* *|=> )$")),
+              ('config', re.compile("[(]config[^)]*[)][#] $")),
+              ('enable', re.compile("[#] $")),
+              ('cli', re.compile("[>] $")),)
+
+# any other output
+MUX_BUSY = 'busy'
+
+class MuxError(Exception):
+    pass
+
+def getSocketPath():
+    if CONSOLE_MUX_SOCKET:
+        return CONSOLE_MUX_SOCKET
+    d = os.environ.get('XDG_RUNTIME_DIR')
+    if d:
+        return os.path.join(d, "console-mux.sock")
+    d = os.path.join(tempfile.gettempdir(), "console-mux-%d" % os.getuid())
+    return os.path.join(d, "console-mux.sock")
+
+def _checkOwner(path, isType, what):
+    st = os.lstat(path)
+    if not isType(st.st_mode) or st.st_uid != os.getuid():
+        raise MuxError("%s is not a %s owned by uid %d" % (path, what, os.getuid(),))
+    return st
+
+def _makeSocketDir(path):
+    """Create the private directory for the default socket path."""
+    d = os.path.dirname(path)
+    if CONSOLE_MUX_SOCKET or os.environ.get('XDG_RUNTIME_DIR'):
+        return
+    try:
+        os.mkdir(d, 0700)
+    except OSError, what:
+        if what.errno != errno.EEXIST:
+            raise
+    st = _checkOwner(d, stat.S_ISDIR, "directory")
+    if st.st_mode & 0077:
+        raise MuxError("%s is accessible by other users" % d)
+
+def getState(buf):
+    for name, rx in MUX_STATES:
+        if rx.search(buf):
+            return name
+    return MUX_BUSY
+
+def _setNonBlocking(fd):
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+class RingBuffer(object):
+    """The last 'size' bytes of a stream."""
+
+    def __init__(self, size=MUX_RING_SIZE):
+        self.size = size
+        self.chunks = []
+        self.length = 0
+        self.total = 0
+
+    def append(self, buf):
+        self.chunks.append(buf)
+        self.length += len(buf)
+        self.total += len(buf)
+        if self.length > self.size * 2:
+            # compact once in a while rather than on every append
+            data = "".join(self.chunks)[-self.size:]
+            self.chunks = [data]
+            self.length = len(data)
+
+    def tail(self, count):
+        count = min(count, self.size)
+        if count <= 0:
+            return ""
+        bufs = []
+        n = 0
+        for buf in reversed(self.chunks):
+            bufs.append(buf)
+            n += len(buf)
+            if n >= count:
+                break
+        return "".join(reversed(bufs))[-count:]
+
+class Endpoint(object):
+    """An fd in the epoll loop, with an output queue."""
+
+    def __init__(self, mux, fd):
+        self.mux = mux
+        self.fd = fd
+        self.outbuf = []
+        self.outlen = 0
+        self.closed = False
+
+    def _write(self, buf):
+        raise NotImplementedError
+
+    def send(self, buf):
+        if self.closed or not buf:
+            return
+        self.outbuf.append(buf)
+        self.outlen += len(buf)
+        self.flush()
+
+    def flush(self):
+        while self.outbuf and not self.closed:
+            buf = self.outbuf[0]
+            try:
+                n = self._write(buf)
+            except (OSError, socket.error), what:
+                if what.args[0] in (errno.EAGAIN, errno.EINTR,):
+                    break
+                self.close()
+                return
+            self.outlen -= n
+            if n < len(buf):
+                self.outbuf[0] = buf[n:]
+                break
+            self.outbuf.pop(0)
+        if not self.closed:
+            self.mux.setWritable(self, bool(self.outbuf))
+
+    def close(self):
+        self.closed = True
+
+class MuxConsole(Endpoint):
+    """A 'track console' process on a pty."""
+
+    def __init__(self, mux, host):
+        self.host = host
+        self.ring = RingBuffer()
+        self.clients = set()
+        self.state = MUX_BUSY
+        self.tail = ""
+        self.opened = time.time()
+        self.lastOutput = None
+        self.lastClient = time.time()
+
+        master, slave = os.openpty()
+        try:
+            def _setCtty():
+                os.setsid()
+                fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+            self.proc = subprocess.Popen(('track', 'console', host,),
+                                         stdin=slave, stdout=slave, stderr=slave,
+                                         close_fds=True, preexec_fn=_setCtty)
+        except:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        _setNonBlocking(master)
+        Endpoint.__init__(self, mux, master)
+
+    def _write(self, buf):
+        return os.write(self.fd, buf)
+
+    def read(self):
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError, what:
+            if what.errno in (errno.EAGAIN, errno.EINTR,):
+                return
+            # EIO, the console process is gone
+            buf = ""
+        if not buf:
+            self.close()
+            return
+        self.ring.append(buf)
+        self.tail = (self.tail + buf)[-MUX_TAIL:]
+        self.state = getState(self.tail)
+        self.lastOutput = time.time()
+        for client in list(self.clients):
+            client.send(buf)
+
+    def currentLine(self):
+        """The output since the last newline (e.g. the prompt)."""
+        return self.tail.rpartition("\n")[2]
+
+    def describe(self):
+        return {'state' : self.state,
+                'pid' : self.proc.pid,
+                'clients' : len(self.clients),
+                'bytes' : self.ring.total,
+                'opened' : self.opened,
+                'last_output' : self.lastOutput,}
+
+    def close(self):
+        if self.closed:
+            return
+        Endpoint.close(self)
+        self.mux.unregister(self)
+        os.close(self.fd)
+        if self.proc.poll() is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            if self.proc.poll() is None:
+                self.mux.zombies.append(self.proc)
+        for client in list(self.clients):
+            client.closeAfterFlush()
+        self.clients = set()
+        self.mux.consoleClosed(self)
+
+class MuxClient(Endpoint):
+    """A client connection on the Unix socket."""
+
+    def __init__(self, mux, sock):
+        Endpoint.__init__(self, mux, sock.fileno())
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.request = ""
+        self.console = None
+        self.closing = False
+
+    def _write(self, buf):
+        return self.sock.send(buf)
+
+    def send(self, buf):
+        Endpoint.send(self, buf)
+        if self.outlen > MUX_CLIENT_MAX:
+            sys.stderr.write("*** console-mux: dropping slow client\n")
+            self.close()
+
+    def flush(self):
+        Endpoint.flush(self)
+        if self.closing and not self.outbuf:
+            self.close()
+
+    def closeAfterFlush(self):
+        self.closing = True
+        self.flush()
+
+    def read(self):
+        try:
+            buf = self.sock.recv(65536)
+        except socket.error, what:
+            if what.args[0] in (errno.EAGAIN, errno.EINTR,):
+                return
+            buf = ""
+        if not buf:
+            self.close()
+            return
+        if self.console is not None:
+            self.console.send(buf)
+            return
+        self.request += buf
+        if "\n" not in self.request:
+            if len(self.request) > MUX_REQUEST_MAX:
+                self.send("ERROR request too long\n")
+                self.closeAfterFlush()
+            return
+        line, _, rest = self.request.partition("\n")
+        self.request = ""
+        self.mux.handleRequest(self, line.split(), rest)
+
+    def close(self):
+        if self.closed:
+            return
+        Endpoint.close(self)
+        self.mux.unregister(self)
+        self.sock.close()
+        if self.console is not None:
+            self.console.clients.discard(self)
+            self.console.lastClient = time.time()
+
+class ConsoleMux(object):
+    """The epoll loop."""
+
+    def __init__(self, path=None, idle=0):
+        self.path = path or getSocketPath()
+        self.idle = idle
+        self.epoll = None
+        self.sock = None
+        self.endpoints = {}
+        self.writable = set()
+        self.consoles = {}
+        self.zombies = []
+        self.running = False
+
+    def register(self, ep):
+        self.endpoints[ep.fd] = ep
+        self.epoll.register(ep.fd, select.EPOLLIN)
+
+    def unregister(self, ep):
+        if self.endpoints.get(ep.fd) is ep:
+            del self.endpoints[ep.fd]
+            self.writable.discard(ep.fd)
+            try:
+                self.epoll.unregister(ep.fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def setWritable(self, ep, writable):
+        if self.endpoints.get(ep.fd) is not ep:
+            return
+        if writable == (ep.fd in self.writable):
+            return
+        if writable:
+            self.writable.add(ep.fd)
+            self.epoll.modify(ep.fd, select.EPOLLIN | select.EPOLLOUT)
+        else:
+            self.writable.discard(ep.fd)
+            self.epoll.modify(ep.fd, select.EPOLLIN)
+
+    def consoleClosed(self, console):
+        if self.consoles.get(console.host) is console:
+            del self.consoles[console.host]
+
+    def getConsole(self, host):
+        console = self.consoles.get(host)
+        if console is None:
+            console = self.consoles[host] = MuxConsole(self, host)
+            self.register(console)
+        return console
+
+    def handleRequest(self, client, words, rest):
+        cmd = words[0].upper() if words else ""
+        try:
+            if cmd == 'ATTACH' and len(words) == 2:
+                console = self.getConsole(words[1])
+                client.console = console
+                console.clients.add(client)
+                client.send("OK %s\n" % console.state)
+                client.send(console.currentLine())
+                if rest:
+                    console.send(rest)
+                return
+            if cmd == 'TAIL' and len(words) == 3:
+                console = self.consoles.get(words[1])
+                if console is None:
+                    raise MuxError("no console for %s" % words[1])
+                client.send("OK %s\n" % console.state)
+                client.send(console.ring.tail(int(words[2])))
+            elif cmd == 'LIST' and len(words) == 1:
+                m = dict([(k, v.describe(),) for k, v in self.consoles.items()])
+                client.send(json.dumps(m, sort_keys=True) + "\n")
+            elif cmd == 'CLOSE' and len(words) == 2:
+                console = self.consoles.get(words[1])
+                if console is not None:
+                    console.close()
+                client.send("OK\n")
+            else:
+                raise MuxError("invalid request: %s" % " ".join(words))
+        except (MuxError, ValueError, OSError), what:
+            client.send("ERROR %s\n" % str(what))
+        client.closeAfterFlush()
+
+    def _bind(self):
+        _makeSocketDir(self.path)
+        if os.path.exists(self.path):
+            _checkOwner(self.path, stat.S_ISSOCK, "socket")
+            # refuse to take over a live daemon, else remove the stale socket
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise MuxError("console-mux already running on %s" % self.path)
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(64)
+        sock.setblocking(0)
+        return sock
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error, what:
+                if what.args[0] in (errno.EAGAIN, errno.EINTR,):
+                    return
+                raise
+            self.register(MuxClient(self, conn))
+
+    def _reap(self):
+        self.zombies = [x for x in self.zombies if x.poll() is None]
+        now = time.time()
+        for console in self.consoles.values():
+            if console.proc.poll() is not None:
+                # drain anything left on the pty first
+                console.read()
+                console.close()
+            elif self.idle and not console.clients and now - console.lastClient > self.idle:
+                console.close()
+
+    def stop(self, *args):
+        self.running = False
+
+    def serve(self, hosts=()):
+        """Run until stop() is called; open the consoles for 'hosts' right away."""
+        self.sock = self._bind()
+        self.epoll = select.epoll()
+        self.epoll.register(self.sock.fileno(), select.EPOLLIN)
+        self.running = True
+        try:
+            for host in hosts:
+                try:
+                    self.getConsole(host)
+                except OSError, what:
+                    sys.stderr.write("*** cannot open console %s: %s\n" % (host, str(what),))
+            while self.running:
+                try:
+                    events = self.epoll.poll(1.0)
+                except IOError, what:
+                    if what.errno == errno.EINTR:
+                        continue
+                    raise
+                for fd, mask in events:
+                    if fd == self.sock.fileno():
+                        self._accept()
+                        continue
+                    ep = self.endpoints.get(fd)
+                    if ep is None:
+                        continue
+                    if mask & select.EPOLLOUT:
+                        ep.flush()
+                    if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                        if not ep.closed:
+                            ep.read()
+                self._reap()
+        finally:
+            for console in self.consoles.values():
+                console.close()
+            for ep in self.endpoints.values():
+                ep.close()
+            self.epoll.close()
+            self.sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+# client side
+
+def isRunning(path=None):
+    return os.path.exists(path or getSocketPath())
+
+# struct ucred, on Linux
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+def _connect(path, timeout):
+    """Connect to the daemon, if it is our own."""
+    path = path or getSocketPath()
+    try:
+        _checkOwner(path, stat.S_ISSOCK, "socket")
+    except OSError, what:
+        raise socket.error(what.errno, "%s: %s" % (path, what.strerror,))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        # the socket may have been replaced since the check
+        pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                                            struct.calcsize("3i")))
+        if uid != os.getuid():
+            raise MuxError("%s is served by uid %d" % (path, uid,))
+    except:
+        sock.close()
+        raise
+    return sock
+
+def _readLine(sock):
+    line = ""
+    while not line.endswith("\n"):
+        c = sock.recv(1)
+        if not c:
+            raise MuxError("console-mux closed the connection")
+        line += c
+        if len(line) > MUX_REQUEST_MAX:
+            raise MuxError("invalid console-mux reply")
+    return line.rstrip("\n")
+
+def _checkReply(line):
+    words = line.split(None, 1)
+    if not words or words[0] != 'OK':
+        raise MuxError(line.partition(' ')[2] or "invalid console-mux reply")
+    return words[1] if len(words) > 1 else None
+
+def attach(host, path=None, timeout=5):
+    """Attach to a console, return (socket, prompt state).
+
+    The socket is left in blocking mode; the first data on it is the
+    current line of console output (e.g. the prompt).
+    """
+    sock = _connect(path, timeout)
+    try:
+        sock.sendall("ATTACH %s\n" % host)
+        state = _checkReply(_readLine(sock))
+    except:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock, state
+
+def request(line, path=None, timeout=5):
+    """Send a TAIL, LIST or CLOSE request, return (status, data)."""
+    sock = _connect(path, timeout)
+    try:
+        sock.sendall(line + "\n")
+        bufs = []
+        while True:
+            buf = sock.recv(65536)
+            if not buf:
+                break
+            bufs.append(buf)
+    finally:
+        sock.close()
+    buf = "".join(bufs)
+    if buf.startswith("ERROR"):
+        raise MuxError(buf.partition(' ')[2].strip())
+    return buf
+
+def tail(host, count, path=None):
+    """Return (prompt state, the last 'count' bytes of console output)."""
+    buf = request("TAIL %s %d" % (host, count,), path=path)
+    line, _, data = buf.partition("\n")
+    return _checkReply(line), data
+
+def listConsoles(path=None):
+    return json.loads(request("LIST", path=path))
+
+def closeConsole(host, path=None):
+    request("CLOSE %s" % host, path=path)
@@ -4,11 +4,27 @@
 import sys, os, pwd
 import subprocess
 import pexpect
+import pexpect.fdpexpect
 import re
+import errno
 import tempfile
 import socket
+import time
+import atexit
+import hashlib
+import threading
+import glob
+import tarfile
+import gzip
 
 import IpUtils
+import CacheUtils
+import FleetUtils
+import MetricsUtils
+import TraceUtils
+import TimeoutUtils
+import InventoryUtils
+import ConsoleMux
 
 # track support is only for remote access
 try:
@@ -73,7 +89,12 @@ def quotePcli(s, quote=""):
 
     return oq + q + oq
 
-def findPubKey():
+# seconds before the ssh-agent check is repeated
+SSH_KEY_CACHE_TTL = int(os.environ.get('SSH_KEY_CACHE_TTL', '3600'))
+
+SSH_KEY_CACHE = CacheUtils.JsonCache("sshkey")
+
+def findPubKey(force=False):
     """Retrieve the SSH public key for switch communication.
 
     Set the key specifier in $TESTS_SSH_KEY
@@ -82,6 +103,12 @@ def findPubKey():
     - find its public component
     - make sure ssh-agent is running
     - make sure the key is unlocked
+
+    The fingerprint is cached (by key path and mtime) as is the
+    ssh-agent check (by $SSH_AUTH_SOCK, for SSH_KEY_CACHE_TTL seconds),
+    so that this only forks ssh-keygen/ssh-add when the cache is stale.
+
+    Returns the key fingerprint.
     """
 
     if 'TESTS_SSH_KEY' not in os.environ:
@@ -91,39 +118,954 @@ def findPubKey():
         raise ValueError("no ssh-agent set up")
 
     keySpec = os.environ['TESTS_SSH_KEY']
+    sock = os.environ['SSH_AUTH_SOCK']
 
     if not os.path.exists(keySpec):
         raise ValueError("SSH key file not found")
     if not os.path.exists(keySpec+'.pub'):
         raise ValueError("SSH public key file not found")
 
-    # get the fingerprint
-    buf = subprocess.check_output(('ssh-keygen', '-l', '-f', keySpec,))
-    fpr = buf.strip().split()[1]
+    mtime = max(os.stat(keySpec).st_mtime, os.stat(keySpec+'.pub').st_mtime)
+    now = time.time()
 
-    sigs = subprocess.check_output(('ssh-add', '-l',))
-    if fpr not in sigs:
-        raise ValueError("SSH key is not in ssh-agent")
+    # a copy, the cached entry is compared below
+    ent = dict(SSH_KEY_CACHE.get(keySpec) or {})
+    if force or not ent or ent.get('mtime') != mtime:
+        ent = {'mtime' : mtime,}
 
-findPubKey()
+    # get the fingerprint
+    fpr = ent.get('fpr')
+    if fpr is None:
+        buf = subprocess.check_output(('ssh-keygen', '-l', '-f', keySpec,))
+        fpr = ent['fpr'] = buf.strip().split()[1]
+
+    agentOk = (ent.get('sock') == sock
+               and os.path.exists(sock)
+               and now - ent.get('checked', 0) < SSH_KEY_CACHE_TTL)
+    if not agentOk:
+        sigs = subprocess.check_output(('ssh-add', '-l',))
+        if fpr not in sigs:
+            SSH_KEY_CACHE.remove(keySpec)
+            raise ValueError("SSH key is not in ssh-agent")
+        ent['sock'] = sock
+        ent['checked'] = now
+
+    if ent != SSH_KEY_CACHE.get(keySpec):
+        SSH_KEY_CACHE.put(keySpec, ent)
+
+    return fpr
+
+_pubKeyFpr = None
+
+def checkPubKey():
+    """Validate the SSH key once per process, return its fingerprint."""
+    global _pubKeyFpr
+    if _pubKeyFpr is None:
+        _pubKeyFpr = findPubKey()
+    return _pubKeyFpr
+
+def invalidatePubKey():
+    """Discard the cached key validation, e.g. after an auth failure."""
+    global _pubKeyFpr
+    _pubKeyFpr = None
+    keySpec = os.environ.get('TESTS_SSH_KEY')
+    if keySpec:
+        SSH_KEY_CACHE.remove(keySpec)
+
+def getIdentityFile():
+    checkPubKey()
+    return os.environ['TESTS_SSH_KEY']
 
 def getPubKey():
-    with open(os.environ['TESTS_SSH_KEY']+'.pub', "r") as fd:
+    with open(getIdentityFile()+'.pub', "r") as fd:
         pubkey = fd.read().strip()
     return pubkey
 
 def getIdentityArgs():
-    ident = os.environ['TESTS_SSH_KEY']
+    ident = getIdentityFile()
     return ['-oIdentityFile=%s' % ident, '-oIdentitiesOnly=yes',]
 
+def getRootKeyCmds():
+    """Shell commands to install our public key for root."""
+    return [('stty', '-echo', 'rows', '10000', 'cols', '999',),
+
+            ('chmod', '0755', '/root',),
+            # hm, this was a recent change, appears to be a
+            # security vuln.
+
+            ('mkdir', '-p', '/root/.ssh',),
+            ('chmod', '0700', '/root/.ssh',),
+            ('touch', '/root/.ssh/authorized_keys',),
+            ('chmod', '0600', '/root/.ssh/authorized_keys',),
+            ('set', 'dummy', quote(getPubKey()),),
+            ('shift',),
+            # idempotent, the commands may be run again (see provisionShell)
+            ('grep', '-qxF', '"$*"', '/root/.ssh/authorized_keys',
+             '||', 'echo', '"$*"', ">>/root/.ssh/authorized_keys",),]
+
+def getRecovery2KeyCmds():
+    """Shell commands to set up the recovery2 (uid 0) user with our public key."""
+    return [('stty', '-echo', 'rows', '10000', 'cols', '999',),
+            ('userdel', '--force', 'recovery2', '||', ':',),
+            ('useradd',
+             '--create-home',
+             '--home-dir', '/var/run/recovery2',
+             '--non-unique', '--no-user-group', '--uid', '0', '--gid', '0',
+             'recovery2',),
+            ('mkdir', '-p', '/var/run/recovery2/.ssh',),
+            ('chmod', '0700', '/var/run/recovery2/.ssh',),
+            ('touch', '/var/run/recovery2/.ssh/authorized_keys',),
+            ('chmod', '0600', '/var/run/recovery2/.ssh/authorized_keys',),
+            ('set', 'dummy', quote(getPubKey()),),
+            ('shift',),
+            # idempotent, the commands may be run again (see provisionShell)
+            ('grep', '-qxF', '"$*"', '/var/run/recovery2/.ssh/authorized_keys',
+             '||', 'echo', '"$*"', ">>/var/run/recovery2/.ssh/authorized_keys",),]
+
 ADMIN_USER = 'admin'
 ADMIN_PASS = 'adminadmin'
 
+# longest waits; interactive sessions usually wait less,
+# see ConsoleSpawn and TimeoutUtils
 TIMEOUT_BOOT = 180
 TIMEOUT_LONG = 30
 TIMEOUT_SHORT = 5
 TIMEOUT_LOGIN = 10
 
+def _getCksumTable():
+    tbl = []
+    for i in range(256):
+        c = i << 24
+        for j in range(8):
+            if c & 0x80000000:
+                c = ((c << 1) ^ 0x04C11DB7) & 0xffffffff
+            else:
+                c = (c << 1) & 0xffffffff
+        tbl.append(c)
+    return tbl
+
+CKSUM_TABLE = _getCksumTable()
+
+def cksum(buf):
+    """Compute the POSIX cksum(1) CRC of a string.
+
+    Returns (crc, length) as printed by cksum.
+    """
+    tbl = CKSUM_TABLE
+    crc = 0
+    for c in buf:
+        crc = ((crc << 8) & 0xffffffff) ^ tbl[(crc >> 24) ^ ord(c)]
+    n = len(buf)
+    while n:
+        crc = ((crc << 8) & 0xffffffff) ^ tbl[(crc >> 24) ^ (n & 0xff)]
+        n >>= 8
+    return (~crc) & 0xffffffff, len(buf)
+
+def shellQuote(s):
+    """Quote a string as a single shell word."""
+    return "'" + s.replace("'", "'\\''") + "'"
+
+PROVISION_RE = re.compile("@@PROVISION@@ ([0-9 ]*|CKSUM) @@")
+
+# the tty line discipline limits input lines to 4095 characters
+PROVISION_MAX_LINE = 4000
+
+def getProvisionLine(cmds):
+    """Frame a list of shell commands as a single command line.
+
+    The remote shell verifies the checksum of the framed script, runs
+    each command in turn (without stopping on errors) and prints a
+    single status line with the exit code of each command.
+    """
+
+    # split the tag so that the echoed command line does not match it
+    tag = '"@@PROVISION""@@"'
+
+    steps = ['%s; c="$c $?"' % " ".join(cmd) for cmd in cmds]
+    script = "c=; " + "; ".join(steps) + '; echo %s "$c" @@' % tag
+    crc, sz = cksum(script)
+
+    return ('S=%s; if test "$(printf %%s "$S" | cksum)" = "%d %d"; then sh -c "$S"; else echo %s CKSUM @@; fi'
+            % (shellQuote(script), crc, sz, tag,))
+
+def _provisionError(i, cmd, before):
+    return pexpect.ExceptionPexpect("command failed: %d" % i)
+
+def provisionShell(sp, cmds, prompts, error, timeout=TIMEOUT_LONG):
+    """Run setup commands in an open (root) shell session.
+
+    'prompts' is the expect pattern list for the shell prompt, with
+    the expected prompt first.  'error(i, cmd, before)' builds the
+    exception to raise for a failed command.
+
+    All of the commands are sent in a single round trip (see
+    getProvisionLine); if that fails, fall back to sending one
+    command at a time, waiting for the prompt after each.
+
+    Returns the exit code of each command, or None if the commands
+    were run one at a time.
+    """
+
+    codes = None
+    line = getProvisionLine(cmds)
+    if len(line) < PROVISION_MAX_LINE:
+        sp.sendline(line)
+        i = sp.expect([PROVISION_RE, pexpect.TIMEOUT, pexpect.EOF,], timeout=timeout,
+                      adaptive=False)
+        if i == 0:
+            status = sp.match.group(1)
+            j = sp.expect(prompts, timeout=TIMEOUT_SHORT)
+            if j == 0 and status != 'CKSUM':
+                codes = [int(x) for x in status.split()]
+            elif status == 'CKSUM':
+                sys.stderr.write("*** setup script checksum mismatch\n")
+
+    if codes is not None and len(codes) == len(cmds) and not any(codes):
+        return codes
+
+    if codes is not None:
+        for cmd, code in zip(cmds, codes):
+            if code:
+                sys.stderr.write("*** %s: exit code %d\n" % (" ".join(cmd), code,))
+    sys.stderr.write("*** batch setup failed, retrying one command at a time\n")
+
+    for cmd in cmds:
+        sp.sendline(" ".join(cmd))
+        i = sp.expect(prompts, timeout=TIMEOUT_SHORT, adaptive=False)
+        if i != 0:
+            raise error(i, cmd, sp.before)
+
+    return None
+
+SHELL_MARK_RE = re.compile("@@SHELL@@ ([0-9a-f]+) ([0-9]+) (BEGIN|END ([0-9]+)) @@\r?\n")
+
+class ShellResult(object):
+    """Outcome of one ShellChannel command."""
+
+    def __init__(self, cmd, code, output, duration):
+        self.cmd = cmd
+        self.code = code
+        self.output = output
+        self.duration = duration
+
+    def __repr__(self):
+        return "<ShellResult %r code=%s duration=%.2fs>" % (self.cmd, self.code, self.duration,)
+
+class ShellChannel(object):
+    """Run commands one after the other on an open shell session.
+
+    'sp' is a pexpect session sitting at a (POSIX) shell prompt, e.g. a
+    root shell, 'debug bash', or an ONIE/loader console shell.
+    Each command is framed by unique sentinel lines carrying its exit
+    code, so there is no need to guess at the prompt.  Each command
+    runs in a subshell, so that a failure does not end a 'bash -e'
+    session.
+    """
+
+    def __init__(self, sp, timeout=TIMEOUT_LONG):
+        self.sp = sp
+        self.timeout = timeout
+        self.token = os.urandom(4).encode("hex")
+        self.seq = 0
+        self.broken = False
+
+    def _mark(self, what):
+        # split the tag so that the echoed command line does not match
+        return "echo \"@@SHELL\"\"@@ %s %d %s @@\"" % (self.token, self.seq, what,)
+
+    def _expectMark(self, kind, timeout):
+        while True:
+            # commands have no typical run time, always wait the full timeout
+            i = self.sp.expect([SHELL_MARK_RE, pexpect.TIMEOUT, pexpect.EOF,], timeout=timeout,
+                               adaptive=False)
+            if i != 0:
+                self.broken = True
+                return i, None
+            m = self.sp.match
+            if m.group(1) == self.token and int(m.group(2)) == self.seq and m.group(3).startswith(kind):
+                return 0, m
+            # stale output from an earlier (timed out) command
+
+    def run(self, cmd, timeout=None):
+        """Run a command, return a ShellResult.
+
+        'cmd' is a shell command string, or a sequence of words that
+        are quoted for the shell.
+        Raises pexpect.ExceptionPexpect if the shell does not respond
+        (after which the channel is no longer usable).
+        """
+
+        if self.broken:
+            raise pexpect.ExceptionPexpect("shell channel is no longer usable")
+        if timeout is None:
+            timeout = self.timeout
+        if isinstance(cmd, basestring):
+            line = cmd
+        else:
+            line = " ".join([shellQuote(x) for x in cmd])
+
+        self.seq += 1
+        start = time.time()
+        self.sp.sendline("%s; ( %s ) && %s || %s"
+                         % (self._mark("BEGIN"), line,
+                            self._mark("END 0"), self._mark("END $?"),))
+
+        i, m = self._expectMark("BEGIN", TIMEOUT_SHORT)
+        if i != 0:
+            raise pexpect.ExceptionPexpect("shell did not start command: %s" % line)
+        i, m = self._expectMark("END", timeout)
+        if i != 0:
+            raise pexpect.ExceptionPexpect("shell command timed out: %s" % line)
+
+        output = self.sp.before.replace("\r\n", "\n")
+        return ShellResult(cmd, int(m.group(4)), output, time.time()-start)
+
+    def call(self, cmd, timeout=None):
+        return self.run(cmd, timeout=timeout).code
+
+    def check_call(self, cmd, timeout=None):
+        res = self.run(cmd, timeout=timeout)
+        if res.code:
+            raise subprocess.CalledProcessError(res.code, cmd, res.output)
+        return 0
+
+    def check_output(self, cmd, timeout=None):
+        res = self.run(cmd, timeout=timeout)
+        if res.code:
+            raise subprocess.CalledProcessError(res.code, cmd, res.output)
+        return res.output
+
+    def runAll(self, cmds, timeout=None):
+        """Run several commands, return a list of ShellResult."""
+        return [self.run(cmd, timeout=timeout) for cmd in cmds]
+
+# interactive (pexpect) sessions, see spawnSession
+# set $CONSOLE_TRANSCRIPT to also save the session output to a file
+SPAWN_SEARCH_WINDOW = int(os.environ.get('SPAWN_SEARCH_WINDOW', '8192'))
+SPAWN_LONG_STEP = 2
+CONSOLE_TRANSCRIPT = os.environ.get('CONSOLE_TRANSCRIPT')
+CONSOLE_TRANSCRIPT_MAX = int(os.environ.get('CONSOLE_TRANSCRIPT_MAX', str(16<<20)))
+CONSOLE_TRANSCRIPT_KEEP = 3
+
+class TranscriptLog(object):
+    """File-like transcript, optionally echoed to e.g. stdout.
+
+    If 'path' is set, the output is also appended to that file, which
+    is rotated (path.1, path.2, ...) when it reaches 'maxSize' bytes.
+    """
+
+    def __init__(self, path=None, maxSize=CONSOLE_TRANSCRIPT_MAX, keep=CONSOLE_TRANSCRIPT_KEEP,
+                 echo=None):
+        self.path = path
+        self.maxSize = maxSize
+        self.keep = keep
+        self.echo = echo
+        self.fd = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _open(self):
+        self.fd = open(self.path, "a")
+        self.size = self.fd.tell()
+
+    def _rotate(self):
+        self.fd.close()
+        self.fd = None
+        for i in range(self.keep-1, 0, -1):
+            src = "%s.%d" % (self.path, i,)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.path, i+1,))
+        if self.keep > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+        self._open()
+
+    def write(self, buf):
+        if self.echo is not None:
+            self.echo.write(buf)
+        if self.path is None:
+            return
+        with self.lock:
+            if self.fd is None:
+                self._open()
+            self.fd.write(buf)
+            self.size += len(buf)
+            if self.size >= self.maxSize:
+                self._rotate()
+
+    def flush(self):
+        if self.echo is not None:
+            self.echo.flush()
+        with self.lock:
+            if self.fd is not None:
+                self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+
+TRANSCRIPT_LOG = TranscriptLog(CONSOLE_TRANSCRIPT)
+
+# set $CONSOLE_TRANSCRIPT_DIR to save a gzipped transcript per session,
+# set $CONSOLE_ECHO=0 to not echo session output to stdout
+CONSOLE_TRANSCRIPT_DIR = os.environ.get('CONSOLE_TRANSCRIPT_DIR')
+CONSOLE_ECHO = os.environ.get('CONSOLE_ECHO', '1') not in ('', '0', 'no',)
+CONSOLE_LOG_INTERVAL = 0.1
+CONSOLE_LOG_MAX = 4<<20
+
+class SessionLog(object):
+    """pexpect logfile for a single session.
+
+    Writes only append to an in-memory buffer; the TranscriptWriter
+    thread does the actual (possibly slow) output.  If the writer falls
+    more than CONSOLE_LOG_MAX bytes behind, output is dropped rather
+    than blocking the session.
+    """
+
+    def __init__(self, writer, tag=None):
+        self.writer = writer
+        self.tag = tag
+        self.bufs = []
+        self.size = 0
+        self.dropped = 0
+        self.partial = ""
+        self.fd = None
+        self.closed = False
+
+    def write(self, buf):
+        with self.writer.lock:
+            if self.size + len(buf) > CONSOLE_LOG_MAX:
+                self.dropped += len(buf)
+            else:
+                self.bufs.append(buf)
+                self.size += len(buf)
+        self.writer.wake()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.writer.wake()
+
+class TranscriptWriter(object):
+    """Background thread that writes session transcripts in batches.
+
+    Output is tagged with the session host, one line at a time, so that
+    concurrent sessions stay readable.
+    """
+
+    def __init__(self, echo=None, log=None, logDir=None):
+        self.echo = echo
+        self.log = log
+        self.logDir = logDir
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+        self.seq = 0
+        self.shutdown = False
+
+    def open(self, tag=None):
+        sess = SessionLog(self, tag=tag)
+        with self.lock:
+            self.sessions.append(sess)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.close)
+        return sess
+
+    def wake(self):
+        self.event.set()
+
+    def _openSessionFile(self, sess):
+        self.seq += 1
+        name = "%s-%s-%d-%d.log.gz" % ((sess.tag or "session").replace('/', '_'),
+                                       time.strftime("%Y%m%d%H%M%S"),
+                                       os.getpid(), self.seq,)
+        if not os.path.isdir(self.logDir):
+            os.makedirs(self.logDir)
+        return gzip.open(os.path.join(self.logDir, name), "wb")
+
+    def _tagLines(self, sess, buf, final):
+        buf = sess.partial + buf
+        lines = buf.split("\n")
+        sess.partial = lines.pop()
+        if sess.partial and final:
+            lines.append(sess.partial)
+            sess.partial = ""
+        if not lines:
+            return ""
+        if sess.tag:
+            pfx = sess.tag + "| "
+            return "".join([pfx + x.rstrip("\r") + "\n" for x in lines])
+        return "".join([x + "\n" for x in lines])
+
+    def _drain(self, final=False):
+        batch = []
+        with self.lock:
+            for sess in self.sessions:
+                # hold back partial lines (e.g. prompts) for one interval
+                if sess.bufs or sess.dropped or sess.partial or sess.closed:
+                    batch.append((sess, "".join(sess.bufs), sess.dropped,
+                                  final or sess.closed or not sess.bufs,))
+                    sess.bufs, sess.size, sess.dropped = [], 0, 0
+            self.sessions = [x for x in self.sessions if not x.closed]
+
+        out = []
+        for sess, buf, dropped, flushPartial in batch:
+            if dropped:
+                buf += "\n[... %d bytes dropped]\n" % dropped
+            if buf and self.logDir:
+                try:
+                    if sess.fd is None:
+                        sess.fd = self._openSessionFile(sess)
+                    sess.fd.write(buf)
+                except (IOError, OSError), what:
+                    sys.stderr.write("*** cannot write transcript: %s\n" % str(what))
+                    self.logDir = None
+            out.append(self._tagLines(sess, buf, flushPartial))
+            if sess.closed and sess.fd is not None:
+                sess.fd.close()
+                sess.fd = None
+
+        out = "".join(out)
+        if not out:
+            return
+        if self.echo is not None:
+            self.echo.write(out)
+            self.echo.flush()
+        if self.log is not None:
+            self.log.write(out)
+            self.log.flush()
+
+    def _run(self):
+        while not self.shutdown:
+            with self.lock:
+                partial = any([x.partial for x in self.sessions])
+            self.event.wait(CONSOLE_LOG_INTERVAL if partial else None)
+            self.event.clear()
+            time.sleep(CONSOLE_LOG_INTERVAL)
+            try:
+                self._drain()
+            except Exception, what:
+                sys.stderr.write("*** transcript writer failed: %s\n" % str(what))
+
+    def close(self):
+        """Write out everything that is still pending."""
+        self.shutdown = True
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join(1.0)
+        with self.lock:
+            for sess in self.sessions:
+                sess.closed = True
+        self._drain(final=True)
+
+TRANSCRIPT_WRITER = TranscriptWriter(echo=sys.stdout if CONSOLE_ECHO else None,
+                                     log=TRANSCRIPT_LOG if CONSOLE_TRANSCRIPT else None,
+                                     logDir=CONSOLE_TRANSCRIPT_DIR)
+
+def getSessionLog(tag=None):
+    """Get a logfile for a new pexpect session, tagged with e.g. the host."""
+    return TRANSCRIPT_WRITER.open(tag)
+
+class ConsoleSpawnMixin(object):
+    """pexpect session with a bounded search window.
+
+    Pattern lists are compiled once and cached, since the same few
+    prompts are matched over and over.
+
+    The timeout passed to expect() is the longest wait; the actual
+    wait is learned per host and prompt (see TimeoutUtils).  If the
+    session is still producing output when the learned wait runs out,
+    the wait is extended up to the full timeout.
+    """
+
+    PATTERN_CACHE = {}
+
+    def compile_pattern_list(self, patterns):
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        try:
+            key = (tuple(patterns), self.ignorecase, getattr(self, "encoding", None),)
+            hash(key)
+        except TypeError:
+            return super(ConsoleSpawnMixin, self).compile_pattern_list(patterns)
+        compiled = self.PATTERN_CACHE.get(key)
+        if compiled is None:
+            compiled = super(ConsoleSpawnMixin, self).compile_pattern_list(patterns)
+            self.PATTERN_CACHE[key] = compiled
+        return compiled
+
+    host = None
+    lastPattern = None
+
+    # input sent since the last match, part of the learned timeout key
+    sent = ""
+
+    def send(self, s):
+        if len(self.sent) < 4096:
+            self.sent += s
+        return super(ConsoleSpawnMixin, self).send(s)
+
+    def expect(self, pattern, timeout=-1, searchwindowsize=-1, adaptive=True, **kwargs):
+        """Like pexpect.spawn.expect, learning how long each wait takes.
+
+        Waits are learned for the previous prompt, the input sent
+        since, and the expected prompt; a wait past the learned limit
+        widens it, but never ends before 'timeout'.  Set 'adaptive' to
+        False for the output of commands, which has no typical run time.
+        """
+        compiled = self.compile_pattern_list(pattern)
+        return self.expect_list(compiled, timeout, searchwindowsize,
+                                adaptive=adaptive, **kwargs)
+
+    def _expectAdaptive(self, pattern_list, timeout, searchwindowsize):
+        pats = [x.pattern for x in pattern_list if hasattr(x, 'pattern')]
+        op = TimeoutUtils.getOp(self.lastPattern, pats[0] if pats else "EOF", self.sent)
+        limit = TimeoutUtils.getTimeout(self.host, op, timeout)
+
+        steps = pattern_list
+        if pexpect.TIMEOUT not in steps:
+            steps = list(steps) + [pexpect.TIMEOUT]
+        timeoutIdx = steps.index(pexpect.TIMEOUT)
+
+        sup = super(ConsoleSpawnMixin, self)
+        start = time.time()
+        i = sup.expect_list(steps, limit, searchwindowsize)
+        if i == timeoutIdx and limit < timeout:
+            # past the learned limit, widen it for the next wait,
+            # but still wait as long as the caller asked
+            TimeoutUtils.miss(self.host, op)
+            self.trimBuffer()
+            i = sup.expect_list(steps, max(0, start + timeout - time.time()),
+                                searchwindowsize)
+
+        if i != timeoutIdx:
+            TimeoutUtils.observe(self.host, op, time.time()-start)
+            return i
+
+        if timeoutIdx >= len(pattern_list):
+            raise pexpect.TIMEOUT("Timeout exceeded after %.1fs (%s)" % (time.time()-start, op,))
+        return timeoutIdx
+
+    def expect_list(self, pattern_list, timeout=-1, searchwindowsize=-1, *args, **kwargs):
+        kwargs = dict(kwargs)
+        adaptive = kwargs.pop('adaptive', True)
+        if timeout == -1:
+            timeout = self.timeout
+        if TraceUtils.enabled():
+            pats = [getattr(x, 'pattern', getattr(x, '__name__', x)) for x in pattern_list]
+            timer = MetricsUtils.phase('expect', 'wait', self.host, patterns=pats)
+        else:
+            timer = MetricsUtils.phase('expect', 'wait', self.host)
+        with timer:
+            try:
+                if (adaptive and timeout is not None and TimeoutUtils.TIMEOUT_ADAPTIVE
+                    and not args and not kwargs):
+                    i = self._expectAdaptive(pattern_list, timeout, searchwindowsize)
+                else:
+                    i = super(ConsoleSpawnMixin, self).expect_list(pattern_list, timeout, searchwindowsize,
+                                                                *args, **kwargs)
+            except pexpect.TIMEOUT:
+                self.trimBuffer()
+                raise
+        if pattern_list[i] is pexpect.TIMEOUT:
+            # callers that wait in steps would otherwise keep all output
+            self.trimBuffer()
+        else:
+            self.lastPattern = getattr(pattern_list[i], 'pattern', None)
+            self.sent = ""
+        return i
+
+    def trimBuffer(self, size=None):
+        """Discard all but the last 'size' bytes of unmatched input."""
+        size = size or self.searchwindowsize or SPAWN_SEARCH_WINDOW
+        buf = self.buffer
+        if len(buf) > size:
+            self.buffer = buf[-size:]
+
+class ConsoleSpawn(ConsoleSpawnMixin, pexpect.spawn):
+
+    def close(self, force=True):
+        try:
+            super(ConsoleSpawn, self).close(force=force)
+        finally:
+            if isinstance(self.logfile, SessionLog):
+                self.logfile.close()
+
+class ConsoleFdSpawn(ConsoleSpawnMixin, pexpect.fdpexpect.fdspawn):
+    """Session on a socket, e.g. a console attached through ConsoleMux."""
+
+    def __init__(self, sock, **kwargs):
+        # keep the socket object, it owns the fd
+        self.sock = sock
+        pexpect.fdpexpect.fdspawn.__init__(self, sock.fileno(), **kwargs)
+
+    def close(self, force=True):
+        try:
+            if self.child_fd != -1:
+                self.sock.close()
+                self.child_fd = -1
+                self.closed = True
+        finally:
+            if isinstance(self.logfile, SessionLog):
+                self.logfile.close()
+
+    def isalive(self):
+        return self.child_fd != -1 and not self.flag_eof
+
+    # the daemon may close the socket with client input unread; treat
+    # that like a pty hangup (EOF) rather than a socket error
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        try:
+            return super(ConsoleFdSpawn, self).read_nonblocking(size, timeout)
+        except OSError, what:
+            if what.errno != errno.ECONNRESET:
+                raise
+            self.flag_eof = True
+            raise pexpect.EOF("connection reset")
+
+    def send(self, s):
+        try:
+            return super(ConsoleFdSpawn, self).send(s)
+        except OSError, what:
+            if what.errno not in (errno.EPIPE, errno.ECONNRESET,):
+                raise
+            return 0
+
+def spawnSession(cmd, args=[], host=None, **kwargs):
+    """Start an interactive session.
+
+    The session output is logged via getSessionLog(host), and expect()
+    only searches the last SPAWN_SEARCH_WINDOW bytes of input.
+    """
+    kwargs = dict(kwargs)
+    if 'logfile' not in kwargs:
+        kwargs['logfile'] = getSessionLog(host)
+    kwargs.setdefault('searchwindowsize', SPAWN_SEARCH_WINDOW)
+    sp = ConsoleSpawn(cmd, list(args), **kwargs)
+    sp.host = host
+    return sp
+
+def attachSession(sock, host=None, **kwargs):
+    """Start an interactive session on a connected socket.
+
+    Like spawnSession, but for e.g. a console attached through
+    ConsoleMux.
+    """
+    kwargs = dict(kwargs)
+    if 'logfile' not in kwargs:
+        kwargs['logfile'] = getSessionLog(host)
+    kwargs.setdefault('searchwindowsize', SPAWN_SEARCH_WINDOW)
+    sp = ConsoleFdSpawn(sock, **kwargs)
+    sp.host = host
+    return sp
+
+def expectLong(sp, patterns, timeout):
+    """Wait for a pattern over a long (e.g. boot) period.
+
+    Like sp.expect(patterns, timeout=timeout), but the wait is split
+    into short steps, and the unmatched input is trimmed after each
+    (see ConsoleSpawnMixin.expect_list), so that chatty output does
+    not accumulate in memory.
+    """
+
+    if not isinstance(patterns, list):
+        patterns = [patterns]
+    timeoutIdx = None
+    steps = []
+    idxMap = []
+    for idx, p in enumerate(patterns):
+        if p is pexpect.TIMEOUT:
+            timeoutIdx = idx
+        else:
+            steps.append(p)
+            idxMap.append(idx)
+    steps.append(pexpect.TIMEOUT)
+
+    deadline = time.time() + timeout
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        i = sp.expect(steps, timeout=min(SPAWN_LONG_STEP, deadline-now), adaptive=False)
+        if i < len(idxMap):
+            return idxMap[i]
+
+    if timeoutIdx is None:
+        raise pexpect.TIMEOUT("timed out after %ss" % timeout)
+    return timeoutIdx
+
+# SSH connection multiplexing, see SshControlMaster
+# set $SSH_MUX=0 to disable it
+SSH_MUX = os.environ.get('SSH_MUX', '1') not in ('', '0', 'no',)
+SSH_MUX_DIR = os.environ.get('SSH_MUX_DIR',
+                             os.path.join(tempfile.gettempdir(),
+                                          "ssh-mux-%d" % os.getuid()))
+SSH_MUX_TTL = int(os.environ.get('SSH_MUX_TTL', '300'))
+SSH_MUX_KEEP = os.environ.get('SSH_MUX_KEEP', '0') not in ('', '0', 'no',)
+# set $SSH_MUX_KEEP=1 to leave masters running (until SSH_MUX_TTL)
+# for subsequent scripts
+SSH_MUX_CHECK = 10
+SSH_MUX_RETRY = 30
+
+def getSshOptions(user):
+    """Common ssh/scp options for batch-mode access."""
+    l = ['-F/dev/null',
+         '-oUser=%s' % user,
+         '-oStrictHostKeyChecking=no',
+         '-oUserKnownHostsFile=/dev/null',]
+    return l
+
+class SshControlMaster(object):
+    """Persistent ssh ControlMaster connection to a single host.
+
+    The master is started on demand, and is shut down either
+    explicitly (at exit) or by ssh itself once it has been idle
+    for SSH_MUX_TTL seconds (ControlPersist).
+    """
+
+    def __init__(self, host, user, ident):
+        self.host = host
+        self.user = user
+        self.ident = ident
+
+        # keep this short, unix socket paths are limited to ~100 chars
+        key = "%s@%s:%s" % (user, host, ident,)
+        self.path = os.path.join(SSH_MUX_DIR,
+                                 hashlib.sha1(key).hexdigest()[:16])
+
+        self.started = False
+        self.checked = None
+        self.failed = None
+        self.lock = threading.Lock()
+
+    def _cmd(self, *args):
+        cmd = ['ssh',]
+        cmd.extend(getSshOptions(self.user))
+        if ':' in self.host:
+            cmd.append('-6')
+        cmd.append('-oControlPath=%s' % self.path)
+        cmd.extend(args)
+        cmd.append(self.host)
+        return cmd
+
+    def _run(self, cmd):
+        with open(os.devnull, "r+") as fd:
+            return subprocess.call(cmd, stdin=fd, stdout=fd, stderr=fd)
+
+    def check(self):
+        """Test that the master is still accepting connections."""
+        if not os.path.exists(self.path):
+            return False
+        return self._run(self._cmd('-Ocheck')) == 0
+
+    def start(self):
+        """Start a new master, returns True if successful."""
+
+        if not os.path.isdir(SSH_MUX_DIR):
+            try:
+                os.makedirs(SSH_MUX_DIR, 0700)
+            except OSError:
+                if not os.path.isdir(SSH_MUX_DIR):
+                    raise
+
+        cmd = self._cmd('-oBatchMode=yes',
+                        "-oConnectTimeout=%d" % TIMEOUT_SHORT,
+                        '-oControlMaster=yes',
+                        '-oControlPersist=%d' % SSH_MUX_TTL,
+                        '-oIdentityFile=%s' % self.ident,
+                        '-oIdentitiesOnly=yes',
+                        '-N', '-f',)
+        with MetricsUtils.phase('ssh', 'connect', self.host):
+            self.started = self._run(cmd) == 0
+        return self.started
+
+    def stop(self):
+        if os.path.exists(self.path):
+            self._run(self._cmd('-Oexit'))
+        self.started = False
+        self.checked = None
+
+    def ready(self):
+        """Make sure the master is running, starting it if necessary.
+
+        Returns True if the master can be used.
+        """
+
+        now = time.time()
+
+        if self.failed is not None and now - self.failed < SSH_MUX_RETRY:
+            return False
+
+        if self.checked is not None and now - self.checked < SSH_MUX_CHECK:
+            return True
+
+        # re-use a master left by a previous process if possible
+        if self.check() or self.start():
+            self.checked = now
+            self.failed = None
+            return True
+
+        self.checked = None
+        self.failed = now
+        return False
+
+    def getArgs(self):
+        """Client arguments to connect through this master."""
+        return ['-oControlPath=%s' % self.path, '-oControlMaster=no',]
+
+class SshControlManager(object):
+    """Track ControlMaster connections, one per (host, user, identity)."""
+
+    def __init__(self):
+        self.masters = {}
+        self.lock = threading.Lock()
+        self.registered = False
+
+    def getMaster(self, host, user, ident):
+        key = (host, user, ident,)
+        with self.lock:
+            master = self.masters.get(key, None)
+            if master is None:
+                master = self.masters[key] = SshControlMaster(host, user, ident)
+            if not self.registered and not SSH_MUX_KEEP:
+                atexit.register(self.shutdown)
+                self.registered = True
+        return master
+
+    def getArgs(self, host, user):
+        """Return ssh/scp arguments to multiplex a connection.
+
+        Returns an empty list if multiplexing is disabled or not available,
+        in which case the caller makes a regular connection.
+        """
+        if not SSH_MUX:
+            return []
+        master = self.getMaster(host, user, getIdentityFile())
+        with master.lock:
+            if master.ready():
+                return master.getArgs()
+        return []
+
+    def shutdown(self):
+        """Stop all masters started by this process."""
+        with self.lock:
+            masters, self.masters = self.masters, {}
+        for master in masters.values():
+            if master.started:
+                master.stop()
+
+SSH_MUX_MANAGER = SshControlManager()
+
 class PopenBase(subprocess.Popen):
 
     @classmethod
@@ -138,14 +1080,27 @@ class SubprocessBase(object):
 
     popen_klass = subprocess.Popen
 
+    def popen(self, *popenargs, **kwargs):
+        """Start (but do not wait for) a process."""
+        return self.popen_klass(*popenargs, **kwargs)
+
+    def _phase(self, name, popenargs, kwargs):
+        host = kwargs.get('host', getattr(self, 'host', None))
+        if not TraceUtils.enabled():
+            return MetricsUtils.phase(self.__class__.__name__, name, host)
+        cmd = popenargs[0] if popenargs else kwargs.get('args')
+        return MetricsUtils.phase(self.__class__.__name__, name, host, cmd=cmd)
+
     def call(self, *popenargs, **kwargs):
-        return self.popen_klass(*popenargs, **kwargs).wait()
+        with self._phase('call', popenargs, kwargs):
+            return self.popen_klass(*popenargs, **kwargs).wait()
 
     def check_call(self, *popenargs, **kwargs):
 
         # try to break inheritance loop
         ##retcode = self.call(*popenargs, **kwargs)
-        retcode = self.popen_klass(*popenargs, **kwargs).wait()
+        with self._phase('check_call', popenargs, kwargs):
+            retcode = self.popen_klass(*popenargs, **kwargs).wait()
 
         if retcode:
             cmd = kwargs.get("args")
@@ -157,9 +1112,14 @@ class SubprocessBase(object):
     def check_output(self, *popenargs, **kwargs):
         if 'stdout' in kwargs:
             raise ValueError('stdout argument not allowed, it will be overridden.')
-        process = self.popen_klass(stdout=subprocess.PIPE, *popenargs, **kwargs)
-        output, unused_err = process.communicate()
-        retcode = process.poll()
+        with self._phase('check_output', popenargs, kwargs):
+            process = self.popen_klass(stdout=subprocess.PIPE, *popenargs, **kwargs)
+            output, unused_err = process.communicate()
+            retcode = process.poll()
+        if output:
+            MetricsUtils.addBytes(self.__class__.__name__,
+                                  kwargs.get('host', getattr(self, 'host', None)),
+                                  len(output))
         if retcode:
             cmd = kwargs.get("args")
             if cmd is None:
@@ -167,8 +1127,40 @@ class SubprocessBase(object):
             raise subprocess.CalledProcessError(retcode, cmd, output=output)
         return output
 
+    def iter_output(self, *popenargs, **kwargs):
+        """Generate the command output line by line, as it arrives.
+
+        Lines include their trailing newline.  The exit status is
+        checked once the output is exhausted; if the caller stops early
+        the process is killed.
+        """
+        if 'stdout' in kwargs:
+            raise ValueError('stdout argument not allowed, it will be overridden.')
+        process = self.popen_klass(stdout=subprocess.PIPE, *popenargs, **kwargs)
+        done = False
+        try:
+            for line in iter(process.stdout.readline, ''):
+                yield line
+            done = True
+        finally:
+            if not done and process.poll() is None:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+            process.stdout.close()
+            retcode = process.wait()
+        if retcode:
+            cmd = kwargs.get("args")
+            if cmd is None:
+                cmd = popenargs[0]
+            raise subprocess.CalledProcessError(retcode, cmd)
+
 class SshPopen(PopenBase):
 
+    # default for the 'interactive' parameter
+    INTERACTIVE = False
+
     @classmethod
     def wrap_params(cls, *args, **kwargs):
 
@@ -183,12 +1175,9 @@ class SshPopen(PopenBase):
         user = kwargs.pop('user')
 
         topt = "-oConnectTimeout=%d" % TIMEOUT_SHORT
-        sshcmd = ['ssh',
-                  '-F/dev/null',
-                  '-oUser=%s' % user,
-                  '-oStrictHostKeyChecking=no',
-                  '-oUserKnownHostsFile=/dev/null',
-                  topt,]
+        sshcmd = ['ssh',]
+        sshcmd.extend(getSshOptions(user))
+        sshcmd.append(topt)
         sshcmd.extend(getIdentityArgs())
         sshcmd.append(host)
 
@@ -199,7 +1188,7 @@ class SshPopen(PopenBase):
         if tty:
             sshcmd[2:2] = ['-oRequestTTY=force',]
 
-        interactive = kwargs.pop('interactive', False)
+        interactive = kwargs.pop('interactive', cls.INTERACTIVE)
         if interactive:
             sshcmd[2:2] = ['-oPasswordAuthentication=yes',
                            '-oChallengeResponseAuthentication=no',
@@ -211,6 +1200,11 @@ class SshPopen(PopenBase):
         if not agent:
             sshcmd[2:2] = ['-oPubkeyAuthentication=no',]
 
+        # password logins need their own connection,
+        # everything else can share a master
+        if agent and not interactive:
+            sshcmd[2:2] = SSH_MUX_MANAGER.getArgs(host, user)
+
         if cmd:
             sshcmd += ['--',]
             if isinstance(cmd, basestring):
@@ -223,6 +1217,78 @@ class SshPopen(PopenBase):
 IN = "in"
 OUT = "out"
 
+# default transfer engine for check_scp, 'scp' or 'tar'
+SCP_ENGINE = os.environ.get('SCP_ENGINE', 'scp')
+
+# remember the outcome of testBatchSsh(), see getBatchSshReady()
+SSH_READY_TTL = int(os.environ.get('SSH_READY_TTL', '600'))
+SSH_READY_FAIL_TTL = int(os.environ.get('SSH_READY_FAIL_TTL', '60'))
+SSH_READY_CACHE = CacheUtils.JsonCache("sshready")
+
+# ssh exits with this code on connection or authentication errors
+SSH_ERROR = 255
+
+def _getReadyKey(host, user):
+    return "%s@%s %s" % (user, host, checkPubKey(),)
+
+def getBatchSshReady(host, user):
+    """Return the cached batch SSH status for this host and user.
+
+    Returns True or False, or None if the status is unknown or stale.
+    """
+    ent = SSH_READY_CACHE.get(_getReadyKey(host, user))
+    if not ent:
+        return None
+    ttl = SSH_READY_TTL if ent['ok'] else SSH_READY_FAIL_TTL
+    if time.time() - ent['time'] > ttl:
+        return None
+    return ent['ok']
+
+def setBatchSshReady(host, user, ok):
+    SSH_READY_CACHE.put(_getReadyKey(host, user),
+                        {'ok' : ok, 'time' : time.time(),})
+
+def invalidateBatchSsh(host, user=None):
+    """Forget the batch SSH status for a host (any user by default).
+
+    Link-local addresses match with any zone.
+    """
+    if user is not None:
+        SSH_READY_CACHE.remove(_getReadyKey(host, user))
+        return
+    addr = host.partition('%')[0]
+    keys = []
+    for key in SSH_READY_CACHE.load():
+        userHost = key.partition(' ')[0]
+        if userHost.partition('@')[2].partition('%')[0] == addr:
+            keys.append(key)
+    if keys:
+        SSH_READY_CACHE.update(remove=keys)
+
+def _tarRootOwner(ti):
+    ti.uid = ti.gid = 0
+    ti.uname = ti.gname = "root"
+    return ti
+
+class CountingFile(object):
+    """Count the bytes read from or written to a file object."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.count = 0
+
+    def read(self, *args):
+        buf = self.fd.read(*args)
+        self.count += len(buf)
+        return buf
+
+    def write(self, buf):
+        self.fd.write(buf)
+        self.count += len(buf)
+
+    def __getattr__(self, attr):
+        return getattr(self.fd, attr)
+
 class SshSubprocessBase(SubprocessBase):
     """Decorate subprocess commands with a host parameter."""
 
@@ -230,14 +1296,57 @@ class SshSubprocessBase(SubprocessBase):
         self.host = host
         self.user = user
 
+    def popen(self, *args, **kwargs):
+        return super(SshSubprocessBase, self).popen(*args, host=self.host, user=self.user, **kwargs)
+
+    def _isBatch(self, kwargs):
+        """Test if a command runs with ssh BatchMode (no password login)."""
+        return not kwargs.get('interactive', getattr(self.popen_klass, 'INTERACTIVE', False))
+
+    def _checkReady(self, code, batch=True):
+        """Update the batch SSH status after running a command.
+
+        Only a command that ran in batch mode shows that batch SSH works.
+        """
+        if code == SSH_ERROR:
+            invalidateBatchSsh(self.host, self.user)
+        elif batch and getBatchSshReady(self.host, self.user) is not True:
+            setBatchSshReady(self.host, self.user, True)
+
     def call(self, *args, **kwargs):
-        return super(SshSubprocessBase, self).call(*args, host=self.host, user=self.user, **kwargs)
+        code = super(SshSubprocessBase, self).call(*args, host=self.host, user=self.user, **kwargs)
+        self._checkReady(code, batch=self._isBatch(kwargs))
+        return code
 
     def check_call(self, *args, **kwargs):
-        return super(SshSubprocessBase, self).check_call(*args, host=self.host, user=self.user, **kwargs)
+        batch = self._isBatch(kwargs)
+        try:
+            code = super(SshSubprocessBase, self).check_call(*args, host=self.host, user=self.user, **kwargs)
+        except subprocess.CalledProcessError, what:
+            self._checkReady(what.returncode, batch=batch)
+            raise
+        self._checkReady(code, batch=batch)
+        return code
 
     def check_output(self, *args, **kwargs):
-        return super(SshSubprocessBase, self).check_output(*args, host=self.host, user=self.user, **kwargs)
+        batch = self._isBatch(kwargs)
+        try:
+            buf = super(SshSubprocessBase, self).check_output(*args, host=self.host, user=self.user, **kwargs)
+        except subprocess.CalledProcessError, what:
+            self._checkReady(what.returncode, batch=batch)
+            raise
+        self._checkReady(0, batch=batch)
+        return buf
+
+    def iter_output(self, *args, **kwargs):
+        batch = self._isBatch(kwargs)
+        try:
+            for line in super(SshSubprocessBase, self).iter_output(*args, host=self.host, user=self.user, **kwargs):
+                yield line
+        except subprocess.CalledProcessError, what:
+            self._checkReady(what.returncode, batch=batch)
+            raise
+        self._checkReady(0, batch=batch)
 
     def check_scp(self, *args, **kwargs):
         """Copy to/from a controller.
@@ -245,16 +1354,28 @@ class SshSubprocessBase(SubprocessBase):
         Set 'direction' to IN or OUT.
         Set 'host' to the remote source or dest host.
         Set 'quote' to False to disable e.g. pattern quoting
+        Set 'engine' to 'tar' to use check_tar() instead of scp.
+        Set 'bwlimit' to limit the bandwidth (Kbit/s).
         Set *args to the file arguments, with the final source/dest
         as the last argument.
         """
 
         kwargs = dict(kwargs)
+        engine = kwargs.pop('engine', SCP_ENGINE)
+        if engine == 'tar':
+            return self.check_tar(*args, **kwargs)
+        if engine != 'scp':
+            raise ValueError("invalid engine %s" % engine)
+
         _dir = kwargs.pop('direction')
 
         args = list(args)
         scpargs = []
 
+        bwlimit = kwargs.pop('bwlimit', None)
+        if bwlimit:
+            scpargs.extend(['-l', str(int(bwlimit)),])
+
         host = self.host
         if ':' in host:
             host = '[' + host + ']'
@@ -277,23 +1398,29 @@ class SshSubprocessBase(SubprocessBase):
         else:
             raise ValueError("invalid direction")
 
-        scpcmd = ['scp',
-                  '-F/dev/null',
-                  '-oUser=%s' % self.user,
-                  '-oStrictHostKeyChecking=no',
-                  '-oUserKnownHostsFile=/dev/null',
-                  '-oBatchMode=yes',]
+        scpcmd = ['scp',]
+        scpcmd.extend(getSshOptions(self.user))
+        scpcmd.append('-oBatchMode=yes')
+        scpcmd.extend(SSH_MUX_MANAGER.getArgs(self.host, self.user))
         scpcmd.extend(getIdentityArgs())
         scpcmd.extend(scpargs)
 
-        args = (scpcmd,) + tuple(args)
-        subprocess.check_call(scpcmd)
-
-    def testBatchSsh(self):
-        """Test that root SSH login is enabled.
+        if _dir == OUT:
+            sz = sum([os.path.getsize(x) for x in scpargs[:-1] if os.path.isfile(x)])
+            MetricsUtils.addBytes('scp', self.host, sz)
 
-        Returns 0 if successful.
-        """
+        args = (scpcmd,) + tuple(args)
+        with MetricsUtils.phase('scp', _dir, self.host, cmd=" ".join(scpargs)):
+            try:
+                subprocess.check_call(scpcmd)
+            except subprocess.CalledProcessError, what:
+                # scp exits with 1 on any error, including ssh errors;
+                # the probe forgets the batch SSH status only on the latter
+                self._probeBatchSsh()
+                raise
+        self._checkReady(0)
+
+    def _probeBatchSsh(self):
         try:
             code = self.check_call(('/bin/true',),
                                    tty=False, interactive=False)
@@ -301,6 +1428,232 @@ class SshSubprocessBase(SubprocessBase):
             code = what.returncode
         return True if code == 0 else False
 
+    def testBatchSsh(self, cached=True):
+        """Test that root SSH login is enabled.
+
+        Returns True if successful.
+        Set 'cached' to False to skip the readiness cache.
+        """
+        if cached:
+            ok = getBatchSshReady(self.host, self.user)
+            if ok is not None:
+                return ok
+        ok = self._probeBatchSsh()
+        setBatchSshReady(self.host, self.user, ok)
+        return ok
+
+    def getRemoteDigests(self, dstdir, pattern="*"):
+        """Get the MD5 digests of remote files, in a single call.
+
+        Returns a dict mapping file names (in 'dstdir',
+        matching the shell glob 'pattern') to hex digests.
+        """
+        cmd = ("cd %s 2>/dev/null && md5sum %s 2>/dev/null || :"
+               % (shellQuote(dstdir), pattern,))
+        m = {}
+        buf = self.check_output(cmd, tty=False, interactive=False)
+        for line in buf.splitlines():
+            l = line.strip().split(None, 1)
+            if len(l) == 2:
+                m[l[1].lstrip('*')] = l[0]
+        return m
+
+    def _putTar(self, members, dstcmd, compress=False):
+        """Stream a tar archive to a remote command.
+
+        'members' is a list of (local path, archive name).  Members
+        are owned by root in the archive, like the files scp creates
+        (the remote tar runs as root and keeps the archive owner).
+        """
+        with MetricsUtils.phase('tar', OUT, self.host):
+            proc = self.popen(dstcmd, stdin=subprocess.PIPE,
+                              tty=False, interactive=False)
+            fd = CountingFile(proc.stdin)
+            try:
+                with tarfile.open(fileobj=fd, mode="w|gz" if compress else "w|") as tf:
+                    for src, arcname in members:
+                        tf.add(src, arcname=arcname, filter=_tarRootOwner)
+            finally:
+                proc.stdin.close()
+                code = proc.wait()
+                MetricsUtils.addBytes('tar', self.host, fd.count)
+        self._checkReady(code)
+        if code:
+            raise subprocess.CalledProcessError(code, dstcmd)
+
+    def _getTar(self, srccmd, dst, compress=False):
+        """Unpack a tar stream from a remote command.
+
+        If 'dst' is a local directory, the archive members are
+        extracted into it, otherwise the archive must contain a single
+        file, which is written to 'dst'.
+        """
+
+        with MetricsUtils.phase('tar', IN, self.host):
+            proc = self.popen(srccmd, stdout=subprocess.PIPE,
+                              tty=False, interactive=False)
+            fd = CountingFile(proc.stdout)
+            isDir = os.path.isdir(dst)
+            cnt = 0
+            try:
+                with tarfile.open(fileobj=fd, mode="r|gz" if compress else "r|",
+                                  ignore_zeros=True) as tf:
+                    for m in tf:
+                        if m.name.startswith('/') or '..' in m.name.split('/'):
+                            raise ValueError("invalid archive member %s" % m.name)
+                        if isDir:
+                            tf.extract(m, dst)
+                            continue
+                        if not m.isfile() or cnt:
+                            raise ValueError("cannot copy multiple files to %s" % dst)
+                        with open(dst, "wb") as outfd:
+                            outfd.write(tf.extractfile(m).read())
+                        os.chmod(dst, m.mode)
+                        cnt += 1
+            finally:
+                proc.stdout.close()
+                code = proc.wait()
+                MetricsUtils.addBytes('tar', self.host, fd.count)
+        self._checkReady(code)
+        if code:
+            raise subprocess.CalledProcessError(code, srccmd)
+
+    def check_tar(self, *args, **kwargs):
+        """Copy to/from a host by streaming a tar archive over ssh.
+
+        This takes the same arguments as check_scp, but copies all of
+        the files with a single connection, and preserves file modes.
+        Set 'compress' to True to gzip the stream.
+        """
+
+        kwargs = dict(kwargs)
+        _dir = kwargs.pop('direction')
+        _q = kwargs.pop('quote', True)
+        compress = kwargs.pop('compress', False)
+        qf = shellQuote if _q else (lambda x: x)
+        z = 'z' if compress else ''
+
+        args = list(args)
+        if len(args) < 2:
+            raise ValueError("missing source or destination")
+        srcs, dst = args[:-1], args[-1]
+
+        if _dir == OUT:
+            d = qf(dst)
+            members = [(x, os.path.basename(x.rstrip('/')),) for x in srcs]
+            if len(srcs) == 1 and os.path.isfile(srcs[0]):
+                # copying a single file may rename it
+                n = shellQuote(members[0][1])
+                cmd = ("if test -d %s; then tar x%spf - -C %s; "
+                       "else T=$(mktemp -d \"$(dirname %s)/.tar-XXXXXX\") "
+                       "&& tar x%spf - -C \"$T\" && mv -f \"$T\"/%s %s && rmdir \"$T\"; fi"
+                       % (d, z, d, d, z, n, d,))
+            else:
+                cmd = "tar x%spf - -C %s" % (z, d,)
+            self._putTar(members, cmd, compress=compress)
+        elif _dir == IN:
+            # one archive, members relative to their source directory;
+            # tar applies each -C relative to the previous one
+            groups = []
+            for src in srcs:
+                h, t = os.path.split(src.rstrip('/'))
+                if groups and groups[-1][0] == h:
+                    groups[-1][1].append(qf(t))
+                else:
+                    groups.append((h, [qf(t)],))
+            words = []
+            for h, l in groups:
+                h = h or '.'
+                words.append("-C %s%s %s" % ('' if h.startswith('/') else '"$PWD"/',
+                                             qf(h), " ".join(l),))
+            self._getTar("tar c%sf - %s" % (z, " ".join(words),), dst, compress=compress)
+        else:
+            raise ValueError("invalid direction")
+
+    def check_distribute(self, paths, dstdir, workers=4, bwlimit=None):
+        """Upload files to a remote directory, skipping unchanged files.
+
+        Local and remote files are compared by MD5 (the remote digests
+        are collected in a single call).  Changed files are uploaded
+        concurrently ('workers' at a time, sharing 'bwlimit' Kbit/s)
+        to a temporary name, then renamed into place, so that a
+        partial upload never replaces a good file.
+
+        Returns the list of file names that were uploaded.
+        """
+
+        local = {}
+        for p in paths:
+            local[os.path.basename(p)] = (p, CacheUtils.getFileDigest(p),)
+        if not local:
+            return []
+
+        names = " ".join([shellQuote(x) for x in sorted(local)])
+        remote = self.getRemoteDigests(dstdir, names)
+        todo = [x for x in sorted(local) if remote.get(x) != local[x][1]]
+        if not todo:
+            return []
+
+        limit = None
+        if bwlimit:
+            limit = max(1, bwlimit / min(workers, len(todo)))
+
+        def upload(name):
+            src = local[name][0]
+            tmp = os.path.join(dstdir, ".%s.tmp-%d" % (name, os.getpid(),))
+            dst = os.path.join(dstdir, name)
+            try:
+                self.check_scp(src, tmp, direction=OUT, bwlimit=limit, engine='scp')
+                self.check_call("mv -f %s %s" % (shellQuote(tmp), shellQuote(dst),),
+                                tty=False, interactive=False)
+            except:
+                self.call("rm -f %s" % shellQuote(tmp),
+                          tty=False, interactive=False)
+                raise
+            return dst
+
+        results = FleetUtils.runFleet(todo, upload, workers=workers)
+        for res in results:
+            if res.exc is not None:
+                res.reraise()
+        return todo
+
+    def check_sync(self, srcdir, dstdir, pattern="*.py"):
+        """Copy changed files from a local directory to a remote one.
+
+        Files matching 'pattern' are compared by content (MD5) with
+        the remote copies, and only the changed files are sent, as a
+        single tar stream.  Stale .pyc/.pyo files for the changed
+        files are removed.
+
+        Returns the list of file names that were sent.
+        """
+
+        local = {}
+        for p in glob.glob(os.path.join(srcdir, pattern)):
+            if not os.path.isfile(p): continue
+            with open(p) as fd:
+                local[os.path.basename(p)] = hashlib.md5(fd.read()).hexdigest()
+
+        remote = self.getRemoteDigests(dstdir, pattern)
+        changed = sorted([x for x in local if remote.get(x) != local[x]])
+        if not changed:
+            return []
+
+        d = shellQuote(dstdir)
+        stale = []
+        for e in changed:
+            b, ext = os.path.splitext(e)
+            if ext == '.py':
+                stale.append(shellQuote(b + '.pyc'))
+                stale.append(shellQuote(b + '.pyo'))
+        cmd = "mkdir -p %s && tar xf - -C %s" % (d, d,)
+        if stale:
+            cmd += " && cd %s && rm -f %s" % (d, " ".join(stale),)
+
+        self._putTar([(os.path.join(srcdir, x), x,) for x in changed], cmd)
+        return changed
+
 class ControllerRootSubprocess(SshSubprocessBase):
 
     popen_klass = SshPopen
@@ -352,49 +1705,80 @@ class ControllerCliPopen(SshPopen):
 
 CLI_WARN_RE = re.compile("^[a-z_ ]+: .*$")
 
-def parseCliTableRow(legend, sep, data):
+# column spans, keyed by (legend, separator) line
+CLI_TABLE_SPANS = {}
+CLI_TABLE_SPANS_MAX = 64
 
-    cols = [x for x in enumerate(sep) if x[1] == '|']
-    cols = [x[0] for x in cols]
-    m = {}
+def _getCliTableSpans(legend, sep):
+    """Compute the (key, start, end) column spans for a table.
+
+    Columns are delimited by the '|' characters in the separator line.
+    Spans are computed once per distinct table header.
+    """
+
+    spans = CLI_TABLE_SPANS.get((legend, sep,))
+    if spans is not None:
+        return spans
+
+    spans = []
     p = 0
-    idx = None
-    while cols:
-        q = cols.pop(0)
+    q = sep.find('|')
+    while q > -1:
         key = legend[p:q].strip()
-        val = data[p:q].strip()
+        if type(key) is str:
+            key = intern(key)
+        spans.append((key, p, q,))
+        p = q+1
+        q = sep.find('|', p)
+    spans = tuple(spans)
+
+    if len(CLI_TABLE_SPANS) >= CLI_TABLE_SPANS_MAX:
+        CLI_TABLE_SPANS.clear()
+    CLI_TABLE_SPANS[(legend, sep,)] = spans
+    return spans
+
+def _parseCliTableRow(spans, data):
+    m = {}
+    idx = None
+    for key, p, q in spans:
         if key == '#':
-            idx = int(val)
+            idx = int(data[p:q].strip())
         else:
-            m[key] = val
-        p = q+1
+            m[key] = data[p:q].strip()
 
     if idx is None:
         raise ValueError("invalid data: %s" % data)
 
     return idx, m
 
+def parseCliTableRow(legend, sep, data):
+    return _parseCliTableRow(_getCliTableSpans(legend, sep), data)
+
 def parseCliTable(buf):
 
     lines = buf.strip().splitlines()
-    while lines:
-        line = lines[0]
+    i = 0
+    while i < len(lines):
+        line = lines[i]
         if line.startswith('#'):
             break
         if ':' in line:
-            sys.stderr.write(lines.pop(0) + "\n")
+            sys.stderr.write(line + "\n")
+            i += 1
         elif line == 'None.':
             return []
         else:
             raise ValueError("invalid cli output: %s" % line)
 
-    legend, sep, rest = lines[0], lines[1], lines[2:]
+    legend, sep = lines[i], lines[i+1]
+    spans = _getCliTableSpans(legend, sep)
     m = {}
     sz = -sys.maxint
-    while rest:
-        idx, rec = parseCliTableRow(legend, sep, rest.pop(0))
+    for j in xrange(i+2, len(lines)):
+        idx, rec = _parseCliTableRow(spans, lines[j])
         m[idx] = rec
-        sz = max(sz, idx)
+        if idx > sz:
+            sz = idx
 
     l = [{}] * sz
     for key, val in m.iteritems():
@@ -414,26 +1798,78 @@ def parseCliDetail(buf):
             sys.stderr.write(line + "\n")
     return m
 
+def iterCliTable(lines):
+    """Incremental version of parseCliTable.
+
+    Consume an iterable of lines (e.g. from iter_output) and generate
+    (index, record) pairs one row at a time.
+    Rows are not re-ordered or padded, use parseCliTable for that.
+    """
+
+    lines = iter(lines)
+    legend = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            legend = line
+            break
+        if ':' in line:
+            sys.stderr.write(line + "\n")
+        elif line == 'None.':
+            return
+        else:
+            raise ValueError("invalid cli output: %s" % line)
+    if legend is None:
+        raise ValueError("missing table header")
+
+    sep = next(lines, None)
+    if sep is None:
+        raise ValueError("missing table separator")
+    spans = _getCliTableSpans(legend, sep.rstrip("\r\n"))
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        yield _parseCliTableRow(spans, line)
+
+def iterCliDetail(lines):
+    """Incremental version of parseCliDetail, generate (key, value) pairs."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        p = line.find(' : ')
+        if p > -1:
+            yield line[:p].strip(), line[p+3:].strip()
+        else:
+            sys.stderr.write(line + "\n")
+
 def parseCliTables(buf):
     m = {}
-    while buf:
+    pos = 0
+    sz = len(buf)
+    while pos < sz:
 
-        if not buf.startswith('~'):
-            raise ValueError("extra data: %s" % buf)
+        if not buf.startswith('~', pos):
+            raise ValueError("extra data: %s" % buf[pos:])
 
-        line, sep, buf = buf.partition("\n")
-        if not sep:
-            raise ValueError("extra data: %s" % line)
+        q = buf.find("\n", pos)
+        if q < 0:
+            raise ValueError("extra data: %s" % buf[pos:])
 
-        title = line.strip().strip('~').strip()
+        title = buf[pos:q].strip().strip('~').strip()
+        pos = q+1
 
-        p = buf.find("\n~")
+        p = buf.find("\n~", pos)
         if p > -1:
-            m[title] = parseCliTable(buf[:p])
-            buf = buf[p+1:]
+            m[title] = parseCliTable(buf[pos:p])
+            pos = p+1
         else:
-            m[title] = parseCliTable(buf)
-            buf = ""
+            m[title] = parseCliTable(buf[pos:])
+            pos = sz
 
     return m
 
@@ -467,26 +1903,111 @@ class CopyOutContext(object):
 
         return None
 
+def parseSwitchIpam(buf):
+    """Map switch names to IPAM addresses in 'show running-config switch' output."""
+    m = {}
+    cur = None
+    for line in buf.splitlines():
+        words = line.split()
+        if len(words) == 2 and words[0] == 'switch' and not line[:1].isspace():
+            cur = words[1]
+        elif cur and len(words) > 3 and words[:3] == ['interface', 'ma1', 'ip-address']:
+            m[cur] = words[3].partition('/')[0]
+    return m
+
+def addLocalZone(addr):
+    """Add the local interface to a link-local address."""
+    if addr and addr.lower().startswith('fe80:') and '%' not in addr:
+        return "%s%%%s" % (addr, IpUtils.getDefaultV6Intf(),)
+    return addr
+
+def _getInventoryRecord(row):
+    """Make an inventory record from a 'show switch' table row."""
+    mac = row.get('Switch MAC Address') or None
+    try:
+        linklocal = IpUtils.getV6AddrFromMac(mac, intf='-') if mac else None
+    except ValueError:
+        linklocal = None
+    return {'name' : row['Switch Name'],
+            'mac' : mac,
+            'ip' : row.get('IP Address') or None,
+            'role' : row.get('Fabric Role') or None,
+            'linklocal' : linklocal,}
+
 class ControllerCliMixin:
 
-    def getSwitchAddress(self, switch):
+    def _getInventoryKey(self):
+        return self.host
+
+    def loadInventory(self):
+        """Index all of the switches of this controller (see InventoryUtils).
+
+        Takes two Cli commands however many switches there are.
+        """
+
+        recs = {}
+        buf = self.check_output(('show', 'switch',))
+        for row in parseCliTable(buf):
+            if not row.get('Switch Name'): continue
+            rec = _getInventoryRecord(row)
+            recs[rec['name']] = rec
 
-        # try to get the IPAM address
         try:
-            buf = self.check_output(('show', 'switch', switch, 'running-config',))
+            buf = self.check_output(('show', 'running-config', 'switch',))
         except subprocess.CalledProcessError, what:
             buf = None
-        if buf:
-            lines = [x for x in buf.splitlines() if x.startswith("interface ma1 ip-address")]
-        else:
-            lines = []
-        if lines:
-            addr = lines[0].strip().split()[3].partition('/')[0]
-            if addr != '0.0.0.0':
-                l, s, r = addr.partition('%')
-                if s:
-                    addr = "%s%%%s" % (l, IpUtils.getDefaultV6Intf(),)
-                return addr
+        for name, addr in parseSwitchIpam(buf or "").items():
+            if name in recs:
+                recs[name]['ipam'] = addr
+
+        InventoryUtils.getInventory().update(self._getInventoryKey(), recs.values())
+        return len(recs)
+
+    def loadSwitch(self, switch):
+        """Index one switch of this controller.
+
+        Returns False if the controller does not know the switch.
+        """
+        row = self.getSwitch(switch)
+        if not row.get('Switch Name'):
+            return False
+        rec = _getInventoryRecord(row)
+        rec['ipam'] = self.getSwitchIpam(switch)
+        InventoryUtils.getInventory().update(self._getInventoryKey(), [rec], partial=True)
+        return True
+
+    def _findInventoryAddress(self, switch, refresh=False):
+        key = self._getInventoryKey()
+        inv = InventoryUtils.getInventory()
+        rec = None if refresh else inv.findByName(switch, controller=key)
+        if rec is None and self.loadSwitch(switch):
+            rec = inv.findByName(switch, controller=key)
+        return addLocalZone(InventoryUtils.getAddress(rec))
+
+    def getSwitchAddress(self, switch, refresh=False):
+        """Get the management address of a switch.
+
+        The local inventory is tried first, and may be up to
+        INVENTORY_TTL seconds old; set 'refresh' to index this switch
+        again (see also getSwitchSubprocess).
+        """
+
+        # try the local inventory
+        try:
+            addr = self._findInventoryAddress(switch, refresh=refresh)
+        except (subprocess.CalledProcessError, ValueError, IndexError, KeyError,
+                InventoryUtils.InventoryError, OSError,), what:
+            addr = None
+        if addr is not None:
+            return addr
+
+        # try to get the IPAM address
+        addr = self.getSwitchIpam(switch)
+        if addr is not None:
+            l, s, r = addr.partition('%')
+            if s:
+                addr = "%s%%%s" % (l, IpUtils.getDefaultV6Intf(),)
+            return addr
 
         # else use the link local address
         rec = self.getSwitch(switch)
@@ -504,6 +2025,38 @@ class ControllerCliMixin:
 
         return None
 
+    def getSwitchSubprocess(self, switch, klass=None):
+        """Get an ssh subprocess for a switch (SwitchRecovery2Subprocess by default).
+
+        If the switch does not answer batch ssh at its indexed
+        address, it is indexed again and tried at its new address.
+        """
+        klass = klass or SwitchRecovery2Subprocess
+        addr = self.getSwitchAddress(switch)
+        sub = klass(addr)
+        if addr is None or sub.testBatchSsh():
+            return sub
+        newAddr = self.getSwitchAddress(switch, refresh=True)
+        if newAddr is None or newAddr == addr:
+            return sub
+        return klass(newAddr)
+
+    def getSwitchIpam(self, switch):
+        """Get the IPAM address of a switch, or None."""
+        try:
+            buf = self.check_output(('show', 'switch', switch, 'running-config',))
+        except subprocess.CalledProcessError, what:
+            buf = None
+        if buf:
+            lines = [x for x in buf.splitlines() if x.startswith("interface ma1 ip-address")]
+        else:
+            lines = []
+        if lines:
+            addr = lines[0].strip().split()[3].partition('/')[0]
+            if addr != '0.0.0.0':
+                return addr
+        return None
+
     def getSwitch(self, switch):
 
         try:
@@ -573,25 +2126,207 @@ class ControllerCliMixin:
     def copyOut(self, src):
         return CopyOutContext(self, src)
 
+CLI_PROMPT_RE = re.compile("(?:^|[\r\n])[^\r\n(#>]*(?:[(]([-a-zA-Z0-9]+)[)])?([>#]) $")
+CLI_ERROR_RE = re.compile("^Error: ", re.M)
+
+CLI_MODES = ('login', 'enable', 'config',)
+CLI_MODE_CMDS = {'enable' : 'enable', 'config' : 'config',}
+
+class ControllerCliSession(object):
+    """Long-lived floodlight-cli process that runs many commands.
+
+    Commands are serialized (one at a time), and the Cli mode is
+    tracked from the prompt, so that each command can request the mode
+    it needs.  If the Cli exits, it is restarted for the next command.
+    """
+
+    def __init__(self, sub, mode=None):
+        self.sub = sub
+        self.mode = mode
+        self.sp = None
+        self.curMode = None
+        self.startMode = None
+        self.lock = threading.Lock()
+
+    def _expectPrompt(self, timeout=TIMEOUT_LONG, adaptive=True):
+        i = self.sp.expect([CLI_PROMPT_RE, pexpect.TIMEOUT, pexpect.EOF,], timeout=timeout,
+                           adaptive=adaptive)
+        if i != 0:
+            return i
+        submode, c = self.sp.match.group(1), self.sp.match.group(2)
+        if c == '>':
+            self.curMode = 'login'
+        elif submode:
+            self.curMode = submode
+        else:
+            self.curMode = 'enable'
+        return 0
+
+    def start(self):
+        self.close()
+        self.sp = self.sub.spawn(mode=self.mode)
+        i = self._expectPrompt(timeout=TIMEOUT_LOGIN)
+        if i != 0:
+            before = self.sp.before
+            self.close()
+            raise subprocess.CalledProcessError(i, ('floodlight-cli',), before)
+        self.startMode = self.curMode
+
+    def close(self):
+        sp, self.sp = self.sp, None
+        self.curMode = None
+        if sp is None: return
+        if sp.isalive():
+            sp.sendline('exit')
+            sp.sendline('exit')
+            sp.sendline('exit')
+            sp.expect([pexpect.EOF, pexpect.TIMEOUT,], timeout=TIMEOUT_SHORT)
+        sp.close(force=True)
+
+    def _modeLevel(self, mode):
+        if mode.startswith('config'):
+            return CLI_MODES.index('config') + (0 if mode == 'config' else 1)
+        return CLI_MODES.index(mode)
+
+    def _send(self, cmd, timeout=TIMEOUT_LONG, adaptive=False):
+        self.sp.sendline(cmd)
+        i = self._expectPrompt(timeout=timeout, adaptive=adaptive)
+        if i != 0:
+            # any late output would be taken for the next command's,
+            # start over with a new Cli
+            before = self.sp.before
+            self.close()
+            raise subprocess.CalledProcessError(i, cmd, before)
+
+        # drop the echoed command
+        buf = self.sp.before
+        line, sep, rest = buf.partition("\n")
+        if line.strip() == cmd.strip():
+            buf = rest
+        return buf
+
+    def setMode(self, mode):
+        """Navigate to the 'login', 'enable' or 'config' mode.
+
+        A config submode (e.g. 'config-switch') is left for 'config',
+        but cannot be entered this way.
+        """
+        if mode == self.curMode:
+            return
+        if mode not in CLI_MODES:
+            raise ValueError("cannot change to Cli mode %s" % mode)
+        tgt = self._modeLevel(mode)
+        while self._modeLevel(self.curMode) > tgt:
+            self._send('exit', timeout=TIMEOUT_SHORT, adaptive=True)
+        while self._modeLevel(self.curMode) < tgt:
+            nextMode = CLI_MODES[self._modeLevel(self.curMode)+1]
+            self._send(CLI_MODE_CMDS[nextMode], timeout=TIMEOUT_SHORT, adaptive=True)
+
+    def check_output(self, cmd, mode=None):
+        """Run a Cli command, return its output.
+
+        By default, commands run in the mode the Cli started in.
+        """
+
+        if not isinstance(cmd, basestring):
+            cmd = " ".join([quotePcli(w) for w in cmd])
+
+        with self.lock:
+            if self.sp is None or not self.sp.isalive():
+                self.start()
+            self.setMode(mode or self.startMode)
+            buf = self._send(cmd)
+
+        if CLI_ERROR_RE.search(buf):
+            raise subprocess.CalledProcessError(1, cmd, buf)
+        return buf
+
+    def check_outputs(self, cmds, mode=None):
+        """Run a queue of Cli commands, return their outputs in order."""
+        return [self.check_output(cmd, mode=mode) for cmd in cmds]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        self.close()
+        return None
+
 class ControllerCliSubprocess(ControllerCliMixin,
                               SshSubprocessBase):
+    """Batch access to the controller Cli.
+
+    Set 'session' to run all commands through a single
+    ControllerCliSession rather than a new Cli for each command.
+    """
 
     popen_klass = ControllerCliPopen
 
-    def __init__(self, host, mode=None):
+    def __init__(self, host, mode=None, session=False):
         self.host = host
         self.user = 'root'
         self.mode = mode
+        self.session = ControllerCliSession(self, mode=mode) if session else None
+
+    def spawn(self, **kwargs):
+        """Start an interactive Cli."""
+
+        kwargs = dict(kwargs)
+        mode = kwargs.pop('mode', self.mode)
+        args, popenKwargs = self.popen_klass.wrap_params(host=self.host, user=self.user,
+                                                         mode=mode)
+        if popenKwargs:
+            raise ValueError("invalid keyword arguments from subprocess: %s" % popenKwargs)
+        args = list(args)
+        if args:
+            cmd = args.pop(0)
+        else:
+            cmd = kwargs.pop('args')
+        if isinstance(cmd, basestring):
+            cmd, rest = cmd, []
+        else:
+            cmd, rest = cmd[0], cmd[1:]
+        return spawnSession(cmd, list(rest), *args, host=self.host, **kwargs)
+
+    def _sessionCmd(self, args, kwargs):
+        if args:
+            return args[0]
+        return kwargs['args']
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+    def popen(self, *args, **kwargs):
+        return super(SshSubprocessBase, self).popen(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
 
     def call(self, *args, **kwargs):
+        if self.session is not None:
+            try:
+                self.session.check_output(self._sessionCmd(args, kwargs))
+            except subprocess.CalledProcessError, what:
+                return what.returncode
+            return 0
         return super(SshSubprocessBase, self).call(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
 
     def check_call(self, *args, **kwargs):
+        if self.session is not None:
+            self.session.check_output(self._sessionCmd(args, kwargs))
+            return 0
         return super(SshSubprocessBase, self).check_call(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
 
     def check_output(self, *args, **kwargs):
+        if self.session is not None:
+            return self.session.check_output(self._sessionCmd(args, kwargs))
         return super(SshSubprocessBase, self).check_output(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
 
+    def iter_output(self, *args, **kwargs):
+        if self.session is not None:
+            # the session reads up to the prompt, there is nothing to stream
+            buf = self.session.check_output(self._sessionCmd(args, kwargs))
+            return iter(buf.splitlines(True))
+        return super(SshSubprocessBase, self).iter_output(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
+
 class ControllerAdminPopen(SshPopen):
     """Interactive access to admin cli.
 
@@ -600,6 +2335,9 @@ class ControllerAdminPopen(SshPopen):
 
     USER = ADMIN_USER
 
+    # password logins by default
+    INTERACTIVE = True
+
     @classmethod
     def wrap_params(cls, *args, **kwargs):
 
@@ -611,7 +2349,7 @@ class ControllerAdminPopen(SshPopen):
             cmd = kwargs.pop('args', None)
 
         kwargs.setdefault('tty', True)
-        kwargs.setdefault('interactive', True)
+        kwargs.setdefault('interactive', cls.INTERACTIVE)
         kwargs.setdefault('user', cls.USER)
         if cmd and kwargs['user'] == ADMIN_USER:
             raise ValueError("command not accepted for admin shell")
@@ -622,6 +2360,7 @@ class ControllerAdminSubprocess(SshSubprocessBase):
 
     USER = ADMIN_USER
     PASS = ADMIN_PASS
+    ROOT_SHELL = "exec sudo bash -e"
 
     popen_klass = ControllerAdminPopen
 
@@ -644,49 +2383,53 @@ class ControllerAdminSubprocess(SshSubprocessBase):
             cmd, rest = cmd, []
         else:
             cmd, rest = cmd[0], cmd[1:]
-        return pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        return spawnSession(cmd, list(rest), *args, host=self.host, **kwargs)
 
-    def enableRoot(self):
-        """Enable root login via the admin login."""
+    def _rootShell(self):
+        """Log in as admin and get to a root shell prompt."""
 
+        t = MetricsUtils.stopwatch('rootShell', self.host)
         ctl = self.spawn(agent=False)
         i = ctl.expect(["password: $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LOGIN)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get password prompt")
+        t.lap('connect')
 
         ctl.sendline(self.PASS)
         i = ctl.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF], timeout=TIMEOUT_LOGIN)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('auth')
 
         ctl.sendline("debug bash")
         i = ctl.expect(["[$] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('debug_bash')
 
-        ctl.sendline("exec sudo bash -e")
+        ctl.sendline(self.ROOT_SHELL)
         i = ctl.expect(["[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('root_shell')
 
-        for cmd in (('stty', '-echo', 'rows', '10000', 'cols', '999',),
-
-                    ('chmod', '0755', '/root',),
-                    # hm, this was a recent change, appears to be a
-                    # security vuln.
-
-                    ('mkdir', '-p', '/root/.ssh',),
-                    ('chmod', '0700', '/root/.ssh',),
-                    ('touch', '/root/.ssh/authorized_keys',),
-                    ('chmod', '0600', '/root/.ssh/authorized_keys',),
-                    ('set', 'dummy', quote(getPubKey()),),
-                    ('shift',),
-                    ('echo', '"$*"', ">>/root/.ssh/authorized_keys",),
-                ):
-            ctl.sendline(" ".join(cmd))
-            i = ctl.expect(["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
-            if i != 0:
-                raise pexpect.ExceptionPexpect("command failed: %d" % i)
+        return ctl
+
+    def shell(self):
+        """Open a root ShellChannel via the admin login."""
+        return ShellChannel(self._rootShell())
+
+    def enableRoot(self):
+        """Enable root login via the admin login."""
+
+        ctl = self._rootShell()
+        with MetricsUtils.phase('enableRoot', 'provision', self.host):
+            provisionShell(ctl, getRootKeyCmds(),
+                           ["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,],
+                           _provisionError)
+
+        # the old batch SSH status is no longer valid
+        invalidateBatchSsh(self.host)
 
         return 0
 
@@ -698,6 +2441,11 @@ class SwitchConnectSubprocessBase(SubprocessBase):
         self.switch = switch
         self.mode = mode
 
+    def popen(self, *args, **kwargs):
+        return super(SwitchConnectSubprocessBase, self).popen(*args,
+                                                              host=self.host, switch=self.switch, mode=self.mode,
+                                                              **kwargs)
+
     def call(self, *args, **kwargs):
         return super(SwitchConnectSubprocessBase, self).call(*args,
                                                              host=self.host, switch=self.switch, mode=self.mode,
@@ -713,6 +2461,11 @@ class SwitchConnectSubprocessBase(SubprocessBase):
                                                                      host=self.host, switch=self.switch, mode=self.mode,
                                                                      **kwargs)
 
+    def iter_output(self, *args, **kwargs):
+        return super(SwitchConnectSubprocessBase, self).iter_output(*args,
+                                                                    host=self.host, switch=self.switch, mode=self.mode,
+                                                                    **kwargs)
+
 class SwitchConnectPopen(ControllerCliPopen):
     """Connect to the switch Cli using the floodlight-cli 'connect switch' command."""
 
@@ -749,7 +2502,7 @@ class SwitchConnectMixin:
             cmd, rest = cmd, []
         else:
             cmd, rest = cmd[0], cmd[1:]
-        sw = pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        sw = spawnSession(cmd, list(rest), *args, host=self.switch, **kwargs)
 
         return sw
 
@@ -782,7 +2535,8 @@ class SwitchConnectMixin:
             sw.sendline(cmd)
         else:
             sw.sendline(" ".join(cmd))
-        i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG)
+        i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG,
+                      adaptive=False)
         if i != 0:
             raise subprocess.CalledProcessError(i, cmd, sw.before)
 
@@ -808,37 +2562,100 @@ class SwitchConnectMixin:
         else:
             cmd = kwargs.pop('args')
 
+        t = MetricsUtils.stopwatch('switchCli', self.switch)
         sw = self.spawn()
         i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise subprocess.CalledProcessError(i,
                                                 ('connect', 'switch', self.switch,),
                                                 sw.before)
+        t.lap('connect')
 
         sw.sendline("debug admin")
         i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG)
         if i != 0:
             raise subprocess.CalledProcessError(i, ('debug', 'admin',), sw.before)
+        t.lap('debug_admin')
 
         if isinstance(cmd, basestring):
             sw.sendline(cmd)
         else:
             sw.sendline(" ".join(cmd))
-        i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG)
+        i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG,
+                      adaptive=False)
         if i != 0:
             raise subprocess.CalledProcessError(i, cmd, sw.before)
         buf = sw.before
+        t.lap('command')
 
         sw.sendline('exit')
         i = sw.expect([pexpect.EOF, "[>] $", pexpect.TIMEOUT,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise subprocess.CalledProcessError(i, ('exit',), buf+sw.before)
+        t.lap('exit')
 
         return buf
 
+    def iter_output(self, *args, **kwargs):
+        """Generate the switch Cli output line by line.
+
+        Unlike check_output, the echoed command is not included.
+        """
+
+        args = list(args)
+        kwargs = dict(kwargs)
+        if args:
+            cmd = args.pop(0)
+        else:
+            cmd = kwargs.pop('args')
+
+        sw = self.spawn()
+        try:
+            i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
+            if i != 0:
+                raise subprocess.CalledProcessError(i,
+                                                    ('connect', 'switch', self.switch,),
+                                                    sw.before)
+
+            sw.sendline("debug admin")
+            i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG)
+            if i != 0:
+                raise subprocess.CalledProcessError(i, ('debug', 'admin',), sw.before)
+
+            if isinstance(cmd, basestring):
+                sw.sendline(cmd)
+            else:
+                sw.sendline(" ".join(cmd))
+
+            # the timeout applies to each line rather than to the whole output
+            echo = True
+            while True:
+                i = sw.expect(["\r\n", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG,
+                              adaptive=False)
+                if i == 0:
+                    if echo:
+                        echo = False
+                    else:
+                        yield sw.before + "\n"
+                elif i == 1:
+                    if sw.before:
+                        yield sw.before
+                    break
+                else:
+                    raise subprocess.CalledProcessError(i-1, cmd, sw.before)
+
+            sw.sendline('exit')
+            i = sw.expect([pexpect.EOF, "[>] $", pexpect.TIMEOUT,], timeout=TIMEOUT_SHORT)
+            if i != 0:
+                raise subprocess.CalledProcessError(i, ('exit',), sw.before)
+        finally:
+            if sw.isalive():
+                sw.close(force=True)
+
     def enableRecovery2(self):
         """Enable recovery (root) login via SSH."""
 
+        t = MetricsUtils.stopwatch('enableRecovery2', self.switch)
         sw = self.spawn()
         i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
@@ -847,16 +2664,19 @@ class SwitchConnectMixin:
             raise subprocess.CalledProcessError(i,
                                                 ('connect', 'switch', self.switch,),
                                                 sw.before)
+        t.lap('connect')
 
         sw.sendline("debug admin")
         i = sw.expect(["[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise subprocess.CalledProcessError(i, ('debug', 'admin',), sw.before)
+        t.lap('debug_admin')
 
         sw.sendline("enable")
         i = sw.expect(["[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise subprocess.CalledProcessError(i, ('enable',), sw.before)
+        t.lap('enable')
 
         # get ourselves into a bash environment where we can detect errors
 
@@ -879,26 +2699,12 @@ class SwitchConnectMixin:
         i = sw.expect(["BASH[#] $", "[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise subprocess.CalledProcessError(i, ('echo', 'hello',), sw.before)
+        t.lap('bash')
 
-        for cmd in (('stty', '-echo', 'rows', '10000', 'cols', '999',),
-                    ('userdel', '--force', 'recovery2', '||', ':',),
-                    ('useradd',
-                     '--create-home',
-                     '--home-dir', '/var/run/recovery2',
-                     '--non-unique', '--no-user-group', '--uid', '0', '--gid', '0',
-                     'recovery2',),
-                    ('mkdir', '-p', '/var/run/recovery2/.ssh',),
-                    ('chmod', '0700', '/var/run/recovery2/.ssh',),
-                    ('touch', '/var/run/recovery2/.ssh/authorized_keys',),
-                    ('chmod', '0600', '/var/run/recovery2/.ssh/authorized_keys',),
-                    ('set', 'dummy', quote(getPubKey()),),
-                    ('shift',),
-                    ('echo', '"$*"', ">>/var/run/recovery2/.ssh/authorized_keys",),
-                ):
-            sw.sendline(" ".join(cmd))
-            i = sw.expect(["BASH[#] $", "[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
-            if i != 0:
-                raise subprocess.CalledProcessError(i, ('...',), sw.before)
+        provisionShell(sw, getRecovery2KeyCmds(),
+                       ["BASH[#] $", "[#] $", pexpect.TIMEOUT, pexpect.EOF,],
+                       lambda i, cmd, before: subprocess.CalledProcessError(i, ('...',), before))
+        t.lap('provision')
 
         return 0
 
@@ -913,11 +2719,7 @@ class SwitchRecovery2Subprocess(SshSubprocessBase):
         self.host = host
         self.user = 'recovery2'
 
-    def testBatchSsh(self):
-        """Test that root SSH login is enabled.
-
-        Returns 0 if successful.
-        """
+    def _probeBatchSsh(self):
         try:
             code = self.check_call(('/bin/true',))
         except subprocess.CalledProcessError, what:
@@ -967,6 +2769,9 @@ class SwitchPcliSubprocess(SshSubprocessBase):
         self.user = user or self.popen_klass.USER
         self.mode = mode
 
+    def popen(self, *args, **kwargs):
+        return super(SshSubprocessBase, self).popen(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
+
     def call(self, *args, **kwargs):
         return super(SshSubprocessBase, self).call(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
 
@@ -976,6 +2781,9 @@ class SwitchPcliSubprocess(SshSubprocessBase):
     def check_output(self, *args, **kwargs):
         return super(SshSubprocessBase, self).check_output(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
 
+    def iter_output(self, *args, **kwargs):
+        return super(SshSubprocessBase, self).iter_output(*args, host=self.host, user=self.user, mode=self.mode, **kwargs)
+
 class ControllerWorkspaceCliPopen(PopenBase):
     """Batch-mode access to controller cli commands.
 
@@ -1028,6 +2836,10 @@ class ControllerWorkspaceCliSubprocess(ControllerCliMixin,
 
     popen_klass = ControllerWorkspaceCliPopen
 
+    def _getInventoryKey(self):
+        # one key per workspace
+        return "workspace:%s" % os.path.realpath(self.popen_klass.RUNCLI or "")
+
     def spawn(self, **kwargs):
 
         args, popenKwargs = self.popen_klass.wrap_params()
@@ -1051,7 +2863,7 @@ class ControllerWorkspaceCliSubprocess(ControllerCliMixin,
         if cwd:
             kwargs['cwd'] = cwd
 
-        return pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        return spawnSession(cmd, list(rest), *args, host="workspace", **kwargs)
 
 class WorkspaceSwitchConnectSubprocessBase(SubprocessBase):
     """Decorate subprocess commands with a switch parameter."""
@@ -1060,6 +2872,11 @@ class WorkspaceSwitchConnectSubprocessBase(SubprocessBase):
         self.switch = switch
         self.mode = mode
 
+    def popen(self, *args, **kwargs):
+        return super(WorkspaceSwitchConnectSubprocessBase, self).popen(*args,
+                                                                       switch=self.switch, mode=self.mode,
+                                                                       **kwargs)
+
     def call(self, *args, **kwargs):
         return super(WorkspaceSwitchConnectSubprocessBase, self).call(*args,
                                                                       switch=self.switch, mode=self.mode,
@@ -1074,6 +2891,11 @@ class WorkspaceSwitchConnectSubprocessBase(SubprocessBase):
         return super(WorkspaceSwitchConnectSubprocessBase, self).check_output(*args,
                                                                               switch=self.switch, mode=self.mode,
                                                                               **kwargs)
+
+    def iter_output(self, *args, **kwargs):
+        return super(WorkspaceSwitchConnectSubprocessBase, self).iter_output(*args,
+                                                                             switch=self.switch, mode=self.mode,
+                                                                             **kwargs)
 class WorkspaceSwitchConnectPopen(ControllerWorkspaceCliPopen):
 
     @classmethod
@@ -1120,7 +2942,7 @@ class WorkspaceSwitchConnectCliSubprocess(SwitchConnectMixin,
         if cwd:
             kwargs['cwd'] = cwd
 
-        sw = pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        sw = spawnSession(cmd, list(rest), *args, host=self.switch, **kwargs)
 
         return sw
 
@@ -1135,6 +2957,7 @@ class SwitchOnlSshPopen(ControllerAdminPopen):
 class SwitchInternalSshSubprocess(SshSubprocessBase):
 
     popen_klass = SwitchInternalSshPopen
+    ROOT_SHELL = "exec bash -e"
 
     def __init__(self, host, user=None):
         self.host = host
@@ -1156,44 +2979,47 @@ class SwitchInternalSshSubprocess(SshSubprocessBase):
             cmd, rest = cmd, []
         else:
             cmd, rest = cmd[0], cmd[1:]
-        return pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        return spawnSession(cmd, list(rest), *args, host=self.host, **kwargs)
 
-    def enableRoot(self):
-        """Enable root login via the admin login."""
+    def _rootShell(self):
+        """Log in as admin and get to a root shell prompt."""
 
+        t = MetricsUtils.stopwatch('rootShell', self.host)
         ctl = self.spawn(agent=False)
         i = ctl.expect(["password: $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LOGIN)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get password prompt")
+        t.lap('connect')
 
         ctl.sendline(self.popen_klass.PASS)
         i = ctl.expect(["[#] $", pexpect.TIMEOUT, pexpect.EOF], timeout=TIMEOUT_LOGIN)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('auth')
 
-        ctl.sendline("exec bash -e")
+        ctl.sendline(self.ROOT_SHELL)
         i = ctl.expect(["[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('root_shell')
 
-        for cmd in (('stty', '-echo', 'rows', '10000', 'cols', '999',),
-
-                    ('chmod', '0755', '/root',),
-                    # hm, this was a recent change, appears to be a
-                    # security vuln.
-
-                    ('mkdir', '-p', '/root/.ssh',),
-                    ('chmod', '0700', '/root/.ssh',),
-                    ('touch', '/root/.ssh/authorized_keys',),
-                    ('chmod', '0600', '/root/.ssh/authorized_keys',),
-                    ('set', 'dummy', quote(getPubKey()),),
-                    ('shift',),
-                    ('echo', '"$*"', ">>/root/.ssh/authorized_keys",),
-                ):
-            ctl.sendline(" ".join(cmd))
-            i = ctl.expect(["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
-            if i != 0:
-                raise pexpect.ExceptionPexpect("command failed: %d" % i)
+        return ctl
+
+    def shell(self):
+        """Open a root ShellChannel via the admin login."""
+        return ShellChannel(self._rootShell())
+
+    def enableRoot(self):
+        """Enable root login via the admin login."""
+
+        ctl = self._rootShell()
+        with MetricsUtils.phase('enableRoot', 'provision', self.host):
+            provisionShell(ctl, getRootKeyCmds(),
+                           ["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,],
+                           _provisionError)
+
+        # the old batch SSH status is no longer valid
+        invalidateBatchSsh(self.host)
 
         return 0
 
@@ -1206,6 +3032,9 @@ class TrackConsolePopen(PopenBase):
 
 ADDR_RE = re.compile("IPv4 Address[(]es[)]: [0-9.]+")
 
+# attach to track consoles through console-mux, if it is running
+CONSOLE_MUX = os.environ.get('CONSOLE_MUX', '1') not in ('', '0', 'no',)
+
 class TrackConsoleSubprocess(SubprocessBase):
 
     popen_klass = TrackConsolePopen
@@ -1214,9 +3043,28 @@ class TrackConsoleSubprocess(SubprocessBase):
         self.host = host
         self.loginBanner = None
 
+    def _attach(self, **kwargs):
+        """Attach to the console through console-mux.
+
+        The session's 'muxState' is the prompt state the console was
+        in (see ConsoleMux.MUX_STATES), and the current prompt line is
+        the first thing to read.
+        """
+        sock, state = ConsoleMux.attach(self.host)
+        sw = attachSession(sock, host=self.host, **kwargs)
+        sw.muxState = state
+        return sw
+
     def spawn(self, **kwargs):
         """Connect to the switch admin cli."""
 
+        if CONSOLE_MUX and ConsoleMux.isRunning():
+            try:
+                return self._attach(**kwargs)
+            except (socket.error, ConsoleMux.MuxError,), what:
+                sys.stderr.write("*** cannot attach through console-mux (%s), using track\n"
+                                 % str(what))
+
         cliCmd = ('track', 'console', self.host,)
         args, popenKwargs = self.popen_klass.wrap_params(cliCmd)
         if popenKwargs:
@@ -1231,14 +3079,17 @@ class TrackConsoleSubprocess(SubprocessBase):
             cmd, rest = cmd, []
         else:
             cmd, rest = cmd[0], cmd[1:]
-        sw = pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        sw = spawnSession(cmd, list(rest), *args, host=self.host, **kwargs)
 
         return sw
 
     def _findLogin(self, sp):
         """back out iteratively to get to a login prompt"""
 
-        for cnt in range(5):
+        # no need to probe if console-mux saw the login prompt
+        probe = getattr(sp, 'muxState', None) != 'login'
+
+        for cnt in range(5 if probe else 0):
 
             sp.sendline("")
 
@@ -1277,7 +3128,8 @@ class TrackConsoleSubprocess(SubprocessBase):
 
         sp.sendline("interface ma1 ip-address dhcp")
 
-        i = sp.expect(["[(]config[)][#] $", pexpect.TIMEOUT, pexpect.EOF], timeout=TIMEOUT_LOGIN)
+        i = sp.expect(["[(]config[)][#] $", pexpect.TIMEOUT, pexpect.EOF], timeout=TIMEOUT_LOGIN,
+                      adaptive=False)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get config prompt")
 
@@ -1331,24 +3183,10 @@ class TrackConsoleSubprocess(SubprocessBase):
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
 
-        for cmd in (('stty', '-echo', 'rows', '10000', 'cols', '999',),
-
-                    ('chmod', '0755', '/root',),
-                    # hm, this was a recent change, appears to be a
-                    # security vuln.
-
-                    ('mkdir', '-p', '/root/.ssh',),
-                    ('chmod', '0700', '/root/.ssh',),
-                    ('touch', '/root/.ssh/authorized_keys',),
-                    ('chmod', '0600', '/root/.ssh/authorized_keys',),
-                    ('set', 'dummy', quote(getPubKey()),),
-                    ('shift',),
-                    ('echo', '"$*"', ">>/root/.ssh/authorized_keys",),
-                ):
-            sp.sendline(" ".join(cmd))
-            i = sp.expect(["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
-            if i != 0:
-                raise pexpect.ExceptionPexpect("command failed: %d" % i)
+        provisionShell(sp, getRootKeyCmds(),
+                       ["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,],
+                       _provisionError)
+        self.invalidateBatchSsh()
 
     def _enableOnlRoot(self, sp):
 
@@ -1374,24 +3212,27 @@ class TrackConsoleSubprocess(SubprocessBase):
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
 
-        for cmd in (('stty', '-echo', 'rows', '10000', 'cols', '999',),
-
-                    ('chmod', '0755', '/root',),
-                    # hm, this was a recent change, appears to be a
-                    # security vuln.
-
-                    ('mkdir', '-p', '/root/.ssh',),
-                    ('chmod', '0700', '/root/.ssh',),
-                    ('touch', '/root/.ssh/authorized_keys',),
-                    ('chmod', '0600', '/root/.ssh/authorized_keys',),
-                    ('set', 'dummy', quote(getPubKey()),),
-                    ('shift',),
-                    ('echo', '"$*"', ">>/root/.ssh/authorized_keys",),
-                ):
-            sp.sendline(" ".join(cmd))
-            i = sp.expect(["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
-            if i != 0:
-                raise pexpect.ExceptionPexpect("command failed: %d" % i)
+        provisionShell(sp, getRootKeyCmds(),
+                       ["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,],
+                       _provisionError)
+        self.invalidateBatchSsh()
+
+    def invalidateBatchSsh(self):
+        """Forget the batch SSH status of this switch.
+
+        The status is kept by address, so this also covers the
+        addresses of the switch in the local inventory.
+        """
+        hosts = set([self.host])
+        try:
+            for rec in InventoryUtils.getInventory().findAll():
+                if rec['name'] == self.host:
+                    hosts.update([rec['ip'], rec['ipam'], rec['linklocal'],])
+        except InventoryUtils.InventoryError:
+            pass
+        for host in hosts:
+            if host:
+                invalidateBatchSsh(host)
 
     def enableRoot(self):
         """Enable root login via the admin login
@@ -1436,7 +3277,7 @@ class TrackConsoleSubprocess(SubprocessBase):
         Assume that the system was just rebooted.
         """
 
-        i = sp.expect(["Hit any key to stop autoboot: ", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_BOOT)
+        i = expectLong(sp, ["Hit any key to stop autoboot: ", pexpect.TIMEOUT, pexpect.EOF,], TIMEOUT_BOOT)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get uboot prompt")
 
@@ -1457,7 +3298,7 @@ class TrackConsoleSubprocess(SubprocessBase):
 
         sp.sendline("run onie_rescue")
 
-        i = sp.expect(["Please press Enter", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_BOOT)
+        i = expectLong(sp, ["Please press Enter", pexpect.TIMEOUT, pexpect.EOF,], TIMEOUT_BOOT)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get ONIE prompt")
 
@@ -1488,15 +3329,52 @@ class TrackConsoleSubprocess(SubprocessBase):
         if i == 0:
             raise pexpect.ExceptionPexpect("cannot start download")
 
+        # the switch is reinstalled, without our keys
+        self.invalidateBatchSsh()
+
         # wait for the login prompt
 
-        i = sp.expect(["login: $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LONG0)
+        i = expectLong(sp, ["login: $", pexpect.TIMEOUT, pexpect.EOF,], TIMEOUT_BOOT)
         if i != 0:
             raise pexpect.ExceptionPexpect("URL install failed")
 
+def getTrackAddresses(switches):
+    """Get the link-local addresses (without a zone) of switches in track.
+
+    Switches in the local inventory need no track lookup, the rest are
+    looked up in bulk and added to the inventory.  Unknown switches
+    map to None.
+    """
+    inv = InventoryUtils.getInventory()
+    m = {}
+    missing = []
+    for switch in switches:
+        rec = inv.findByName(switch, controller=InventoryUtils.TRACK)
+        if rec is not None and rec['linklocal']:
+            m[switch] = rec['linklocal']
+        elif switch not in missing:
+            missing.append(switch)
+    if not missing:
+        return m
+
+    data = TrackUtils.getBigTrack().getSwitches(missing)
+    found = [x for x in missing if data.get(x) is not None]
+    macs = [data[x]['Ethernet'] for x in found]
+    netInt = IpUtils.pton("fe80::")
+    addrs = IpUtils.ntopMany([netInt | x for x in IpUtils.mtonMany(macs)])
+    for switch in missing:
+        m[switch] = None
+    recs = []
+    for switch, mac, addr in zip(found, macs, addrs):
+        m[switch] = addr
+        recs.append({'name' : switch, 'mac' : mac, 'linklocal' : addr,})
+    inv.update(InventoryUtils.TRACK, recs)
+    return m
+
 class SwitchRootSubprocess(SshSubprocessBase):
 
     popen_klass = SwitchInternalSshPopen
+    ROOT_SHELL = "exec sudo bash -e"
 
     def __init__(self, host, user=None):
         user = user or self.popen_klass.USER
@@ -1519,55 +3397,70 @@ class SwitchRootSubprocess(SshSubprocessBase):
             cmd, rest = cmd, []
         else:
             cmd, rest = cmd[0], cmd[1:]
-        return pexpect.spawn(cmd, list(rest), *args, logfile=sys.stdout, **kwargs)
+        return spawnSession(cmd, list(rest), *args, host=self.host, **kwargs)
 
-    def enableRoot(self):
-        """Enable root login via the admin login."""
+    def _rootShell(self):
+        """Log in as admin and get to a root shell prompt."""
 
+        t = MetricsUtils.stopwatch('rootShell', self.host)
         ctl = self.spawn(agent=False)
         i = ctl.expect(["password: $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_LOGIN)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get password prompt")
+        t.lap('connect')
 
         ctl.sendline(self.popen_klass.PASS)
         i = ctl.expect(["[#] $", pexpect.TIMEOUT, pexpect.EOF], timeout=TIMEOUT_LOGIN)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('auth')
 
-        ctl.sendline("exec sudo bash -e")
+        ctl.sendline(self.ROOT_SHELL)
         i = ctl.expect(["[#] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
         if i != 0:
             raise pexpect.ExceptionPexpect("cannot get bash prompt")
+        t.lap('root_shell')
 
-        for cmd in (('stty', '-echo', 'rows', '10000', 'cols', '999',),
-
-                    ('chmod', '0755', '/root',),
-                    # hm, this was a recent change, appears to be a
-                    # security vuln.
-
-                    ('mkdir', '-p', '/root/.ssh',),
-                    ('chmod', '0700', '/root/.ssh',),
-                    ('touch', '/root/.ssh/authorized_keys',),
-                    ('chmod', '0600', '/root/.ssh/authorized_keys',),
-                    ('set', 'dummy', quote(getPubKey()),),
-                    ('shift',),
-                    ('echo', '"$*"', ">>/root/.ssh/authorized_keys",),
-                ):
-            ctl.sendline(" ".join(cmd))
-            i = ctl.expect(["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,], timeout=TIMEOUT_SHORT)
-            if i != 0:
-                raise pexpect.ExceptionPexpect("command failed: %d" % i)
+        return ctl
+
+    def shell(self):
+        """Open a root ShellChannel via the admin login."""
+        return ShellChannel(self._rootShell())
+
+    def enableRoot(self):
+        """Enable root login via the admin login."""
+
+        ctl = self._rootShell()
+        with MetricsUtils.phase('enableRoot', 'provision', self.host):
+            provisionShell(ctl, getRootKeyCmds(),
+                           ["[#] $", "[>] $", pexpect.TIMEOUT, pexpect.EOF,],
+                           _provisionError)
+
+        # the old batch SSH status is no longer valid
+        invalidateBatchSsh(self.host)
 
         return 0
 
     @classmethod
     def fromTrack(cls, switch):
-        bt = TrackUtils.BigTrack()
-        addr = bt.getSwitchV6Address(switch)
+        addr = getTrackAddresses([switch])[switch]
         if addr is None: return None
         intf = IpUtils.getDefaultV6Intf()
         addr = addr + '%' + intf
         return cls(addr)
 
+    @classmethod
+    def fromTrackAll(cls, switches):
+        """Look up several switches at once, return a dictionary.
+
+        Unknown switches map to None.
+        """
+        addrs = getTrackAddresses(switches)
+        intf = IpUtils.getDefaultV6Intf()
+        m = {}
+        for switch, addr in addrs.items():
+            m[switch] = cls(addr + '%' + intf) if addr is not None else None
+        return m
+
 class SwitchOnlSubprocess(SwitchRootSubprocess):
     popen_klass = SwitchOnlSshPopen
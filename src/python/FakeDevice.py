@@ -0,0 +1,380 @@
+"""FakeDevice.py
+
+Local stand-ins for ssh, scp, sudo, floodlight-cli, pcli and track,
+so that ConsoleUtils can be exercised (e.g. by LoadHarness) without
+real controllers or switches.
+
+The tool to emulate is chosen by the name this is run as (e.g. via a
+symlink to bin/fake-device), or is given as the first argument, as in
+'fake-device ssh HOST CMD...'.  Latency and
+failure rates come from the JSON profile in $FAKE_DEVICE_PROFILE,
+see DEFAULT_PROFILE.
+
+Remote commands are never run locally: ssh only emulates the
+floodlight-cli and pcli commands, anything else succeeds silently.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shlex
+
+DEFAULT_PROFILE = {
+    # seconds before a connection is up (first prompt)
+    'connect_delay' : 0.05,
+    # seconds per command
+    'command_delay' : 0.01,
+    # random +/- fraction applied to each delay
+    'jitter' : 0.5,
+    # probability that a connection fails
+    'connect_fail' : 0.0,
+    # probability that a Cli command fails
+    'command_fail' : 0.0,
+    # rows in 'show switch'
+    'switches' : 100,
+    # lines of output for other show commands
+    'output_lines' : 20,
+    # scp transfer rate, in bytes/s
+    'scp_rate' : 50e6,
+}
+
+def loadProfile():
+    profile = dict(DEFAULT_PROFILE)
+    path = os.environ.get('FAKE_DEVICE_PROFILE')
+    if path:
+        with open(path) as fd:
+            profile.update(json.load(fd))
+    return profile
+
+PROFILE = None
+
+def getProfile():
+    global PROFILE
+    if PROFILE is None:
+        PROFILE = loadProfile()
+    return PROFILE
+
+def delay(key, scale=1.0):
+    profile = getProfile()
+    secs = profile[key] * scale
+    jitter = profile['jitter']
+    if jitter:
+        secs *= 1.0 + random.uniform(-jitter, jitter)
+    if secs > 0:
+        time.sleep(secs)
+
+def chance(key):
+    p = getProfile()[key]
+    return p > 0 and random.random() < p
+
+class Terminal(object):
+    """Line-oriented I/O on stdin/stdout (usually a pty).
+
+    Reads with os.read, so that an end-of-file from a ^D on a terminal
+    is not sticky.
+    """
+
+    MAX_EOF = 3
+
+    def __init__(self):
+        self.buf = ""
+        self.eofs = 0
+
+    def write(self, buf):
+        while buf:
+            n = os.write(1, buf)
+            buf = buf[n:]
+
+    def readline(self):
+        """Return the next line (without the newline), or None on ^D/EOF."""
+        while "\n" not in self.buf:
+            try:
+                data = os.read(0, 4096)
+            except OSError:
+                # the other side of the pty is gone
+                sys.exit(0)
+            if not data:
+                self.eofs += 1
+                if self.eofs >= self.MAX_EOF:
+                    sys.exit(0)
+                if self.buf:
+                    line, self.buf = self.buf, ""
+                    return line
+                return None
+            self.eofs = 0
+            self.buf += data
+        line, _, self.buf = self.buf.partition("\n")
+        return line.rstrip("\r")
+
+def showSwitch():
+    legend = ("#    Switch Name    IP Address                Switch MAC Address      "
+              "Connected Since               Fabric Role  ")
+    sep    = ("----|--------------|-------------------------|-----------------------|"
+              "-----------------------------|------------|")
+    lines = [legend, sep,]
+    for i in xrange(1, getProfile()['switches']+1):
+        lines.append("%-4d %-14s %-25s %-23s %-29s %-12s"
+                     % (i, "leaf%d" % i,
+                        "fe80::7272:cfff:fe00:%x%%9" % i,
+                        "70:72:cf:00:%02x:%02x" % ((i>>8) & 0xff, i & 0xff,),
+                        "2016-04-04 10:00:00.000000 UTC",
+                        "leaf" if i % 4 else "spine",))
+    return lines
+
+def getOutput(name, cmd):
+    """Canned output for a Cli command."""
+    words = cmd.split()
+    if words == ['show', 'switch',]:
+        return showSwitch()
+    if words[:2] == ['show', 'switch'] and words[-1:] == ['running-config']:
+        return ["! switch",
+                "switch %s" % words[2],
+                "  interface ma1 ip-address 0.0.0.0/0",]
+    if words == ['show', 'version',]:
+        return ["Name                : %s" % name,
+                "Version             : 0.0.0 (fake)",]
+    if words and words[0] == 'show':
+        return ["%s line %d" % (cmd, i,) for i in xrange(getProfile()['output_lines'])]
+    return []
+
+MODE_PROMPTS = {'login' : "%s> ",
+                'enable' : "%s# ",
+                'config' : "%s(config)# ",}
+
+def runCli(term, name, mode='login', banner=None, onEof='exit'):
+    """Emulate an interactive Cli.
+
+    Returns when the Cli exits, or on ^D if 'onEof' is 'return'.
+    """
+
+    if banner:
+        term.write(banner + "\r\n")
+    while True:
+        term.write(MODE_PROMPTS[mode] % name)
+        line = term.readline()
+        if line is None:
+            if onEof == 'return':
+                return
+            term.write("\r\n")
+            continue
+        cmd = line.strip()
+        if not cmd:
+            continue
+
+        delay('command_delay')
+
+        if cmd in ('exit', 'logout', 'quit',):
+            if mode == 'config':
+                mode = 'enable'
+                continue
+            return
+        if cmd == 'end':
+            if mode == 'config':
+                mode = 'enable'
+            continue
+        if cmd == 'enable':
+            if mode == 'login':
+                mode = 'enable'
+            continue
+        if cmd in ('config', 'configure',):
+            mode = 'config'
+            continue
+        if cmd == 'debug admin':
+            term.write("Switching to debug admin mode\r\n")
+            continue
+        if cmd == 'debug bash':
+            runShell(term, name)
+            continue
+        if cmd.startswith('connect switch '):
+            sw = cmd.split()[2]
+            delay('connect_delay')
+            if chance('connect_fail'):
+                term.write("Error: cannot connect to switch %s\r\n" % sw)
+                continue
+            runCli(term, sw, banner="Connected to %s" % sw)
+            continue
+
+        if chance('command_fail'):
+            term.write("Error: command failed\r\n")
+            continue
+        for l in getOutput(name, cmd):
+            term.write(l + "\r\n")
+
+def runShell(term, name):
+    """Emulate a root shell; commands are echoed, never run."""
+    while True:
+        term.write("root@%s:~# " % name)
+        line = term.readline()
+        if line is None:
+            return
+        cmd = line.strip()
+        if cmd == 'exit' or cmd.startswith('exec '):
+            if cmd == 'exit':
+                return
+            continue
+        delay('command_delay')
+
+def runConsole(term, host):
+    """Emulate a switch serial console (login prompt and Cli)."""
+    loggedIn = random.random() < 0.5
+    while True:
+        if loggedIn:
+            runCli(term, host, onEof='return')
+            loggedIn = False
+            continue
+        term.write("\r\n%s login: " % host)
+        line = term.readline()
+        if line is None or not line.strip():
+            continue
+        delay('command_delay')
+        loggedIn = True
+
+def _parseCliArgs(args):
+    opts = {'mode' : None, 'cmd' : None,}
+    args = list(args)
+    while args:
+        a = args.pop(0)
+        if a in ('-m',):
+            opts['mode'] = args.pop(0)
+        elif a in ('-u', '-p',):
+            args.pop(0)
+        elif a == '-c':
+            opts['cmd'] = args.pop(0)
+    return opts
+
+def floodlightCli(args, name="controller"):
+    opts = _parseCliArgs(args)
+    term = Terminal()
+    mode = opts['mode'] or 'login'
+    cmd = opts['cmd']
+    if cmd is None:
+        runCli(term, name, mode=mode)
+        return 0
+    if cmd.startswith('connect switch '):
+        sw = cmd.split()[2]
+        delay('connect_delay')
+        if chance('connect_fail'):
+            sys.stderr.write("Error: cannot connect to switch %s\n" % sw)
+            return 1
+        runCli(term, sw, banner="Connected to %s" % sw)
+        return 0
+    delay('command_delay')
+    if chance('command_fail'):
+        sys.stdout.write("Error: command failed\n")
+        return 1
+    for l in getOutput(name, cmd):
+        sys.stdout.write(l + "\n")
+    return 0
+
+def pcli(args):
+    return floodlightCli(args, name="switch")
+
+def track(args):
+    if args[:1] == ['console'] and len(args) > 1:
+        delay('connect_delay')
+        if chance('connect_fail'):
+            sys.stderr.write("console %s: Connection refused\n" % args[1])
+            return 1
+        runConsole(Terminal(), args[1])
+        return 0
+    delay('command_delay')
+    return 0
+
+# ssh options that take an argument
+SSH_ARG_OPTS = "bcDEeFIiJLlmOopQRSWw"
+
+def _parseSshArgs(args):
+    """Split ssh arguments into (options, host, remote command words)."""
+    opts = []
+    args = list(args)
+    while args:
+        a = args.pop(0)
+        if a == '--':
+            break
+        if a.startswith('-') and len(a) > 1:
+            opts.append(a)
+            if len(a) == 2 and a[1] in SSH_ARG_OPTS:
+                opts.append(args.pop(0))
+            continue
+        args.insert(0, a)
+        break
+    host = args.pop(0) if args else None
+    if args and args[0] == '--':
+        args.pop(0)
+    return opts, host, args
+
+def runRemote(words):
+    """Dispatch a remote command line to the emulated tools."""
+    while words and words[0] == 'sudo':
+        # sudo [options] -- cmd...
+        if '--' in words:
+            words = words[words.index('--')+1:]
+        else:
+            words = words[1:]
+    if not words:
+        return 0
+    tool = os.path.basename(words[0])
+    if tool == 'floodlight-cli':
+        return floodlightCli(words[1:])
+    if tool == 'pcli':
+        return pcli(words[1:])
+    delay('command_delay')
+    return 0
+
+def ssh(args):
+    opts, host, rest = _parseSshArgs(args)
+    if host is None:
+        sys.stderr.write("usage: ssh host [command]\n")
+        return 255
+    delay('connect_delay')
+    if chance('connect_fail'):
+        sys.stderr.write("ssh: connect to host %s port 22: Connection timed out\n" % host)
+        return 255
+    if rest:
+        # like sshd, hand the joined command to a shell
+        return runRemote(shlex.split(" ".join(rest)))
+    term = Terminal()
+    if '-oPasswordAuthentication=yes' in opts:
+        term.write("%s's password: " % host)
+        if term.readline() is None:
+            return 255
+    runCli(term, "controller")
+    return 0
+
+def scp(args):
+    size = 0
+    for a in args:
+        if not a.startswith('-') and ':' not in a and os.path.isfile(a):
+            size += os.path.getsize(a)
+    delay('connect_delay')
+    if chance('connect_fail'):
+        sys.stderr.write("ssh: connect to host: Connection timed out\n")
+        return 255
+    rate = getProfile()['scp_rate']
+    if rate:
+        time.sleep(float(size) / rate)
+    return 0
+
+def sudo(args):
+    return runRemote(['sudo',] + list(args))
+
+TOOLS = {'ssh' : ssh,
+         'scp' : scp,
+         'sudo' : sudo,
+         'floodlight-cli' : floodlightCli,
+         'pcli' : pcli,
+         'track' : track,}
+
+def main(argv):
+    argv = list(argv)
+    tool = os.path.basename(argv[0])
+    if tool == 'fake-device' and len(argv) > 1:
+        argv.pop(0)
+        tool = argv[0]
+    if tool not in TOOLS:
+        sys.stderr.write("fake-device: cannot emulate %s\n" % tool)
+        return 1
+    random.seed()
+    return TOOLS[tool](argv[1:])
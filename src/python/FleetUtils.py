@@ -0,0 +1,176 @@
+"""FleetUtils.py
+
+Run commands on many switches or controllers concurrently.
+"""
+
+import sys
+import time
+import threading
+import subprocess
+import Queue
+
+class FleetTimeout(Exception):
+    pass
+
+class FleetResult(object):
+    """Outcome of running one unit of work on one target."""
+
+    def __init__(self, target):
+        self.target = target
+        self.host = getattr(target, 'host', target)
+        self.code = None
+        self.output = None
+        self.value = None
+        self.exc = None
+        self.excInfo = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def ok(self):
+        return self.exc is None and self.code == 0
+
+    def reraise(self):
+        """Raise the exception of this target, with the worker's traceback."""
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        raise self.exc
+
+    def __repr__(self):
+        return ("<FleetResult %s code=%s exc=%r duration=%s>"
+                % (self.host, self.code, self.exc, self.duration,))
+
+class FleetExecutor(object):
+    """Run work items on a bounded pool of worker threads.
+
+    'work' is either a command (string or sequence), which is run with
+    the target's check_output, or a callable that is passed the target
+    and returns a value.
+
+    'timeout' bounds each target, 'deadline' bounds the whole run
+    (both in seconds).  Targets that are still running when their time
+    is up are reported with a FleetTimeout exception and left to finish
+    in the background (still counting against 'workers'); targets not
+    yet started at the deadline are not started at all.
+    """
+
+    def __init__(self, workers=16, timeout=None, deadline=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.deadline = deadline
+        self.lock = threading.Lock()
+
+    def _runOne(self, res, work, done):
+        start = time.time()
+        code = output = value = exc = excInfo = None
+        try:
+            if callable(work):
+                value = work(res.target)
+                code = 0
+            else:
+                output = res.target.check_output(work)
+                code = 0
+        except subprocess.CalledProcessError, what:
+            code = what.returncode
+            output = what.output
+            exc = what
+            excInfo = sys.exc_info()
+        except Exception, what:
+            exc = what
+            excInfo = sys.exc_info()
+        end = time.time()
+
+        with self.lock:
+            # ignore late results from timed out targets
+            if not isinstance(res.exc, FleetTimeout):
+                res.start, res.end = start, end
+                res.code, res.output, res.value, res.exc = code, output, value, exc
+                res.excInfo = excInfo
+        done.put(res)
+
+    def run(self, targets, work):
+        """Run 'work' on each target, return a list of FleetResult."""
+
+        now = time.time()
+        stopAt = now + self.deadline if self.deadline is not None else None
+
+        results = [FleetResult(t) for t in targets]
+        pending = list(reversed(results))
+        active = {}
+        # timed out, but their threads are still running
+        abandoned = {}
+        done = Queue.Queue()
+
+        while True:
+
+            now = time.time()
+            while (pending
+                   and len(active) + len(abandoned) < self.workers
+                   and (stopAt is None or now < stopAt)):
+                res = pending.pop()
+                res.start = now
+                active[id(res)] = res
+                thr = threading.Thread(target=self._runOne, args=(res, work, done,))
+                thr.daemon = True
+                thr.start()
+
+            if not active and (not abandoned or not pending
+                               or (stopAt is not None and now >= stopAt)):
+                break
+
+            waits = []
+            if self.timeout is not None:
+                waits.extend([x.start + self.timeout - now for x in active.values()])
+            if stopAt is not None:
+                waits.append(stopAt - now)
+            wait = max(0, min(waits)) if waits else 1<<30
+
+            try:
+                res = done.get(True, wait)
+                active.pop(id(res), None)
+                abandoned.pop(id(res), None)
+                continue
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            with self.lock:
+                for res in active.values():
+                    if res.end is not None:
+                        # finished, but not yet collected
+                        continue
+                    expired = self.timeout is not None and now >= res.start + self.timeout
+                    if expired or (stopAt is not None and now >= stopAt):
+                        res.end = now
+                        res.exc = FleetTimeout("timed out after %.1fs" % (now-res.start,))
+                        abandoned[id(res)] = active.pop(id(res))
+
+        # anything left over missed the deadline
+        for res in pending:
+            res.exc = FleetTimeout("not started before deadline")
+
+        return results
+
+def runFleet(targets, work, workers=16, timeout=None, deadline=None):
+    """Convenience wrapper for FleetExecutor.run()."""
+    ex = FleetExecutor(workers=workers, timeout=timeout, deadline=deadline)
+    return ex.run(targets, work)
+
+def reportFleet(results, fd=sys.stdout):
+    """Print a one-line summary per target."""
+    for res in results:
+        if res.exc is not None and res.code is None:
+            status = "ERROR %s" % res.exc
+        elif res.code:
+            status = "FAILED (%d)" % res.code
+        else:
+            status = "ok"
+        dur = res.duration
+        dur = "%.2fs" % dur if dur is not None else "-"
+        fd.write("%s: %s [%s]\n" % (res.host, status, dur,))
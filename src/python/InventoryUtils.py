@@ -0,0 +1,191 @@
+"""InventoryUtils.py
+
+Local index of switches (name, MAC, management addresses, owning
+controller), so that switch names resolve without a round trip to
+the controller or to track.
+
+The index is an SQLite database in the tool cache directory (or at
+$TOOLS_INVENTORY), filled in bulk from a controller 'show switch'
+(see ConsoleUtils.ControllerCliMixin.loadInventory, or loadSwitch for
+a single switch) or from track
+(see ConsoleUtils.SwitchRootSubprocess.fromTrackAll).  Entries older
+than INVENTORY_TTL seconds are ignored.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+import socket
+
+import CacheUtils
+import IpUtils
+
+INVENTORY_TTL = int(os.environ.get('INVENTORY_TTL', '3600'))
+
+# records from track have no controller
+TRACK = ""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS switch (
+    name TEXT NOT NULL,
+    controller TEXT NOT NULL,
+    mac TEXT,
+    ip TEXT,
+    ipam TEXT,
+    linklocal TEXT,
+    role TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, controller)
+);
+CREATE INDEX IF NOT EXISTS switch_mac ON switch (mac);
+CREATE INDEX IF NOT EXISTS switch_ip ON switch (ip);
+CREATE INDEX IF NOT EXISTS switch_ipam ON switch (ipam);
+CREATE INDEX IF NOT EXISTS switch_linklocal ON switch (linklocal);
+"""
+
+# the inventory is advisory; callers can treat these errors as a miss
+InventoryError = sqlite3.Error
+
+COLUMNS = ('name', 'controller', 'mac', 'ip', 'ipam', 'linklocal', 'role', 'updated',)
+
+def getInventoryPath():
+    return (os.environ.get('TOOLS_INVENTORY')
+            or os.path.join(CacheUtils.getCacheDir(), "inventory.sqlite"))
+
+def _normAddr(addr):
+    """Canonical form of an address, without a zone."""
+    if not addr:
+        return addr
+    addr = addr.partition('%')[0]
+    try:
+        return IpUtils.ntop(IpUtils.pton(addr))
+    except (socket.error, ValueError,):
+        # not IPv6
+        return addr
+
+def _normMac(mac):
+    return mac.lower() if mac else mac
+
+class Inventory(object):
+    """Switch index backed by an SQLite database."""
+
+    def __init__(self, path=None, ttl=INVENTORY_TTL):
+        self.path = path or getInventoryPath()
+        self.ttl = ttl
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            if self.path != ":memory:":
+                d = os.path.dirname(self.path)
+                if not os.path.isdir(d):
+                    os.makedirs(d, 0700)
+            # serialized by self.lock
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.executescript(SCHEMA)
+            self.db = db
+        return self.db
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def update(self, controller, recs, partial=False):
+        """Replace the switches of one controller (or of track).
+
+        'recs' are dictionaries with 'name' and any of 'mac', 'ip',
+        'ipam', 'linklocal' and 'role'; addresses are stored in
+        canonical form, without a zone.  Set 'partial' to only replace
+        the given switches, as for track records ('controller' is TRACK).
+        """
+        now = time.time()
+        rows = []
+        for rec in recs:
+            rows.append((rec['name'], controller,
+                         _normMac(rec.get('mac')),
+                         _normAddr(rec.get('ip')),
+                         _normAddr(rec.get('ipam')),
+                         _normAddr(rec.get('linklocal')),
+                         rec.get('role'),
+                         now,))
+        with self.lock:
+            db = self._connect()
+            with db:
+                if controller != TRACK and not partial:
+                    db.execute("DELETE FROM switch WHERE controller = ?", (controller,))
+                db.executemany("INSERT OR REPLACE INTO switch (%s) VALUES (%s)"
+                               % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS)),),
+                               rows)
+        return len(rows)
+
+    def _query(self, where, args):
+        sql = ("SELECT * FROM switch WHERE (%s) AND updated > ? ORDER BY updated DESC"
+               % where)
+        with self.lock:
+            db = self._connect()
+            rows = db.execute(sql, tuple(args) + (time.time() - self.ttl,)).fetchall()
+        return [dict(zip(x.keys(), tuple(x))) for x in rows]
+
+    def findByName(self, name, controller=None):
+        """Return the newest record for a switch name, or None.
+
+        Set 'controller' to only consider that controller's switches.
+        """
+        if controller is None:
+            recs = self._query("name = ?", (name,))
+        else:
+            recs = self._query("name = ? AND controller = ?", (name, controller,))
+        return recs[0] if recs else None
+
+    def findByMac(self, mac):
+        recs = self._query("mac = ?", (_normMac(mac),))
+        return recs[0] if recs else None
+
+    def findByAddress(self, addr):
+        addr = _normAddr(addr)
+        recs = self._query("ip = ? OR ipam = ? OR linklocal = ?", (addr, addr, addr,))
+        return recs[0] if recs else None
+
+    def findAll(self, controller=None):
+        if controller is None:
+            return self._query("1", ())
+        return self._query("controller = ?", (controller,))
+
+    def clear(self, controller=None):
+        with self.lock:
+            db = self._connect()
+            with db:
+                if controller is None:
+                    db.execute("DELETE FROM switch")
+                else:
+                    db.execute("DELETE FROM switch WHERE controller = ?", (controller,))
+
+def getAddress(rec):
+    """Pick the management address of a switch record.
+
+    Same order as ControllerCliMixin.getSwitchAddress: the IPAM
+    address, then the address the controller reports, then the
+    link-local address.  Link-local addresses still need a zone.
+    """
+    if rec is None:
+        return None
+    if rec['ipam'] and rec['ipam'] != '0.0.0.0':
+        return rec['ipam']
+    return rec['ip'] or rec['linklocal'] or None
+
+INVENTORY = None
+INVENTORY_LOCK = threading.Lock()
+
+def getInventory():
+    """Get the shared Inventory."""
+    global INVENTORY
+    with INVENTORY_LOCK:
+        if INVENTORY is None:
+            INVENTORY = Inventory()
+        return INVENTORY
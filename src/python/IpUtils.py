@@ -4,6 +4,17 @@ Miscellaneous IP utilities.
 """
 
 import struct, socket, pyroute2
+import time
+import errno
+import select
+import threading
+from pyroute2.netlink.rtnl import RTMGRP_LINK, RTMGRP_IPV6_IFADDR, RTMGRP_IPV6_ROUTE
+
+# numpy is only needed for the (faster) bulk conversions
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def pton(addr):
     buf = socket.inet_pton(socket.AF_INET6, addr)
@@ -24,42 +35,133 @@ def mton(macStr):
     ql = struct.unpack("!Q", buf)
     return ql[0]
 
-IPR = pyroute2.IPRoute()
+# netlink sockets are opened on first use, see getIpRoute()
+IPR = None
+MON = None
+
+# snapshot lifetime if we cannot get change notifications
+SNAPSHOT_TTL = 5.0
+
+def getIpRoute():
+    global IPR
+    if IPR is None:
+        IPR = pyroute2.IPRoute()
+    return IPR
 
 def get_links():
     links = {}
-    for link in IPR.get_links():
+    for link in getIpRoute().get_links():
         links[link['index']] = dict(link['attrs'])
     return links
 
+class V6Snapshot(object):
+    """IPv6 routes and addresses, plus link names, from a single dump."""
+
+    def __init__(self, ipr):
+        self.created = time.time()
+        self.links = {}
+        for link in ipr.get_links():
+            self.links[link['index']] = dict(link['attrs'])
+        self.routes = []
+        for route in ipr.get_routes(family=socket.AF_INET6):
+            if route['family'] != socket.AF_INET6: continue
+            self.routes.append((route['dst_len'], dict(route['attrs']),))
+        self.addrs = {}
+        for addrData in ipr.get_addr(family=socket.AF_INET6):
+            attrs = dict(addrData['attrs'])
+            self.addrs.setdefault(addrData['index'], []).append(attrs['IFA_ADDRESS'])
+
+    def localRoutes(self):
+        """Generate the interface index of each link-local route."""
+        localMask = pton("fe80::")
+        for dstLen, attrs in self.routes:
+            if dstLen < 64: continue
+            dstAddr = pton(attrs['RTA_DST'])
+            if dstAddr & localMask != localMask: continue
+            yield attrs['RTA_OIF']
+
+    def getDefaultV6Intf(self):
+        for intfIndex in self.localRoutes():
+            intf = self.links[intfIndex]
+            return intf['IFLA_IFNAME']
+
+    def getDefaultV6Addr(self):
+        localMask = pton("fe80::")
+        for intfIndex in self.localRoutes():
+            for addr in self.addrs.get(intfIndex, []):
+                addrInt = pton(addr)
+                if addrInt & localMask == localMask:
+                    return addr
+
+SNAPSHOT = None
+SNAPSHOT_LOCK = threading.Lock()
+
+def _getMonitor():
+    """Open a netlink socket subscribed to link/address/route changes.
+
+    Returns None if notifications are not available.
+    """
+    global MON
+    if MON is None:
+        try:
+            mon = pyroute2.IPRoute()
+            mon.bind(groups=(RTMGRP_LINK
+                             | RTMGRP_IPV6_IFADDR
+                             | RTMGRP_IPV6_ROUTE))
+        except Exception:
+            return None
+        MON = mon
+    return MON
+
+def _changed(mon):
+    """Drain pending notifications, return True if there were any.
+
+    If notifications were lost (the socket buffer overflowed), that
+    counts as a change too.
+    """
+    changed = False
+    while True:
+        r, w, x = select.select([mon.fileno(),], [], [], 0)
+        if not r: break
+        try:
+            mon.get()
+        except EnvironmentError, what:
+            if what.errno != errno.ENOBUFS:
+                raise
+        changed = True
+    return changed
+
+def getSnapshot():
+    """Return a (possibly cached) V6Snapshot.
+
+    The snapshot is discarded whenever the kernel reports a link,
+    address or route change.
+    """
+    global SNAPSHOT
+    with SNAPSHOT_LOCK:
+        mon = _getMonitor()
+        if SNAPSHOT is not None:
+            if mon is not None:
+                if _changed(mon):
+                    SNAPSHOT = None
+            elif time.time() - SNAPSHOT.created > SNAPSHOT_TTL:
+                SNAPSHOT = None
+        if SNAPSHOT is None:
+            if mon is not None:
+                _changed(mon)
+            SNAPSHOT = V6Snapshot(getIpRoute())
+        return SNAPSHOT
+
+def invalidateSnapshot():
+    global SNAPSHOT
+    with SNAPSHOT_LOCK:
+        SNAPSHOT = None
+
 def getDefaultV6Intf():
-    localMask = pton("fe80::")
-    links = get_links()
-    for route in IPR.get_routes():
-        if route['family'] != socket.AF_INET6: continue
-        if route['dst_len'] < 64: continue
-        attrs = dict(route['attrs'])
-        dstAddr = pton(attrs['RTA_DST'])
-        if dstAddr & localMask != localMask: continue
-        intf = links[attrs['RTA_OIF']]
-        return intf['IFLA_IFNAME']
+    return getSnapshot().getDefaultV6Intf()
 
 def getDefaultV6Addr():
-    localMask = pton("fe80::")
-    links = get_links()
-    for route in IPR.get_routes():
-        if route['family'] != socket.AF_INET6: continue
-        if route['dst_len'] < 64: continue
-        attrs = dict(route['attrs'])
-        dstAddr = pton(attrs['RTA_DST'])
-        if dstAddr & localMask != localMask: continue
-        intfIndex = attrs['RTA_OIF']
-        for addrData in IPR.get_addr(index=intfIndex, family=socket.AF_INET6):
-            attrs = dict(addrData['attrs'])
-            addr = attrs['IFA_ADDRESS']
-            addrInt = pton(addr)
-            if addrInt & localMask == localMask:
-                return addr
+    return getSnapshot().getDefaultV6Addr()
 
 def getV6AddrFromMac(mac, intf=None):
     """See ztn.MdnsDiscovery.Server6.zone()."""
@@ -70,3 +172,163 @@ def getV6AddrFromMac(mac, intf=None):
     macArgs = macBytes + [intf,]
     return ("fe80::%02x%02x:%02xff:fe%02x:%02x%02x%%%s"
             % tuple(macArgs))
+
+def getMacFromV6Addr(addr):
+    """Reverse of getV6AddrFromMac.
+
+    Returns None if 'addr' does not have an EUI-64 interface id.
+    """
+    addrInt = pton(addr.partition('%')[0])
+    b = [(addrInt >> (56-8*i)) & 0xff for i in xrange(8)]
+    if b[3] != 0xff or b[4] != 0xfe:
+        return None
+    return ("%02x:%02x:%02x:%02x:%02x:%02x"
+            % (b[0] ^ 0x02, b[1], b[2], b[5], b[6], b[7],))
+
+# bulk conversions
+# with numpy, the addresses are handled as two arrays of uint64
+# (high and low 64 bits); otherwise these fall back to the
+# one-at-a-time functions above.  Both give the same results.
+
+MAC_LEN = 17
+MAC_DIGITS = [i for i in xrange(MAC_LEN) if i % 3 != 2]
+MAC_SEPS = [i for i in xrange(MAC_LEN) if i % 3 == 2]
+
+# hex digit values, 255 for non-digits
+HEX_VALUES = None
+HEX_DIGITS = None
+
+def _getHexTables():
+    global HEX_VALUES, HEX_DIGITS
+    if HEX_VALUES is None:
+        tbl = numpy.empty(256, dtype=numpy.uint8)
+        tbl.fill(255)
+        for i, c in enumerate("0123456789abcdef"):
+            tbl[ord(c)] = i
+            tbl[ord(c.upper())] = i
+        HEX_VALUES = tbl
+        HEX_DIGITS = numpy.frombuffer("0123456789abcdef", dtype=numpy.uint8)
+    return HEX_VALUES, HEX_DIGITS
+
+def _parseMacs(macs):
+    """Parse MAC strings to an (n, 6) array of byte values.
+
+    Returns None unless all of them are in the canonical
+    'xx:xx:xx:xx:xx:xx' form.
+    """
+    if numpy is None:
+        return None
+    for mac in macs:
+        if len(mac) != MAC_LEN:
+            return None
+    buf = "".join(macs)
+    if isinstance(buf, unicode):
+        # e.g. from JSON
+        try:
+            buf = buf.encode('ascii')
+        except UnicodeError:
+            return None
+    vals, digits = _getHexTables()
+    buf = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(len(macs), MAC_LEN)
+    if (buf[:, MAC_SEPS] != ord(':')).any():
+        return None
+    nibbles = vals[buf[:, MAC_DIGITS]]
+    if (nibbles == 255).any():
+        return None
+    return nibbles[:, 0::2].astype(numpy.uint64) * 16 + nibbles[:, 1::2]
+
+def ptonArray(addrs):
+    """Convert IPv6 address strings to (high, low) uint64 arrays."""
+    buf = "".join([socket.inet_pton(socket.AF_INET6, x) for x in addrs])
+    words = numpy.frombuffer(buf, dtype='>u8').astype(numpy.uint64).reshape(len(addrs), 2)
+    return words[:, 0].copy(), words[:, 1].copy()
+
+def ntopArray(hi, lo):
+    """Convert (high, low) uint64 arrays to IPv6 address strings."""
+    words = numpy.empty((len(hi), 2), dtype='>u8')
+    words[:, 0] = hi
+    words[:, 1] = lo
+    buf = words.tostring()
+    return [socket.inet_ntop(socket.AF_INET6, buf[i:i+16])
+            for i in xrange(0, len(buf), 16)]
+
+def mtonArray(macs):
+    """Like mton, for a list of MACs; returns a uint64 array.
+
+    Returns None if the MACs are not all in canonical form.
+    """
+    b = _parseMacs(macs)
+    if b is None:
+        return None
+    b[:, 0] |= 0x2
+    u = numpy.uint64
+    return ((b[:, 0] << u(56)) | (b[:, 1] << u(48)) | (b[:, 2] << u(40))
+            | u(0xfffe000000)
+            | (b[:, 3] << u(16)) | (b[:, 4] << u(8)) | b[:, 5])
+
+def _toInts(hi, lo):
+    return [(h << 64) | l for h, l in zip(hi.tolist(), lo.tolist())]
+
+def ptonMany(addrs):
+    """Like [pton(x) for x in addrs]."""
+    if numpy is None or not addrs:
+        return [pton(x) for x in addrs]
+    return _toInts(*ptonArray(addrs))
+
+def ntopMany(addrInts):
+    """Like [ntop(x) for x in addrInts]."""
+    if numpy is None or not addrInts:
+        return [ntop(x) for x in addrInts]
+    mask = (1<<64)-1
+    hi = numpy.array([x >> 64 for x in addrInts], dtype=numpy.uint64)
+    lo = numpy.array([x & mask for x in addrInts], dtype=numpy.uint64)
+    return ntopArray(hi, lo)
+
+def mtonMany(macs):
+    """Like [mton(x) for x in macs]."""
+    vals = mtonArray(macs) if macs else None
+    if vals is None:
+        return [mton(x) for x in macs]
+    return vals.tolist()
+
+# 'fe80::' prefix, then the digit positions for the six MAC bytes
+V6_LOCAL_TEMPLATE = "fe80::0000:00ff:fe00:0000"
+V6_LOCAL_DIGITS = (6, 8, 11, 18, 21, 23,)
+
+def getV6AddrsFromMacs(macs, intf=None):
+    """Like [getV6AddrFromMac(x, intf) for x in macs]."""
+    intf = intf or getDefaultV6Intf()
+    b = _parseMacs(macs) if macs else None
+    if b is None:
+        return [getV6AddrFromMac(x, intf=intf) for x in macs]
+    b[:, 0] ^= 0x02
+    vals, digits = _getHexTables()
+    n = len(macs)
+    sz = len(V6_LOCAL_TEMPLATE)
+    out = numpy.tile(numpy.frombuffer(V6_LOCAL_TEMPLATE, dtype=numpy.uint8), (n, 1))
+    for i, pos in enumerate(V6_LOCAL_DIGITS):
+        out[:, pos] = digits[b[:, i] >> numpy.uint64(4)]
+        out[:, pos+1] = digits[b[:, i] & numpy.uint64(0xf)]
+    buf = out.tostring()
+    sfx = "%" + intf
+    return [buf[i:i+sz] + sfx for i in xrange(0, len(buf), sz)]
+
+def getMacsFromV6Addrs(addrs):
+    """Like [getMacFromV6Addr(x) for x in addrs]."""
+    if numpy is None or not addrs:
+        return [getMacFromV6Addr(x) for x in addrs]
+    hi, lo = ptonArray([x.partition('%')[0] for x in addrs])
+    u = numpy.uint64
+    eui = ((lo >> u(24)) & u(0xffff)) == u(0xfffe)
+    mac = numpy.empty((len(addrs), 6), dtype=numpy.uint64)
+    for i, shift in enumerate((56, 48, 40, 16, 8, 0,)):
+        mac[:, i] = (lo >> u(shift)) & u(0xff)
+    mac[:, 0] ^= u(0x02)
+    vals, digits = _getHexTables()
+    out = numpy.empty((len(addrs), MAC_LEN), dtype=numpy.uint8)
+    out.fill(ord(':'))
+    out[:, MAC_DIGITS[0::2]] = digits[mac >> u(4)]
+    out[:, MAC_DIGITS[1::2]] = digits[mac & u(0xf)]
+    buf = out.tostring()
+    return [buf[i*MAC_LEN:(i+1)*MAC_LEN] if ok else None
+            for i, ok in enumerate(eui.tolist())]
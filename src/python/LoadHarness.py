@@ -0,0 +1,340 @@
+"""LoadHarness.py
+
+Drive many concurrent ConsoleUtils sessions against the FakeDevice
+stand-ins and report throughput, tail latency, file descriptor and
+pty usage, and memory.  Run with load-harness, e.g.
+
+  load-harness --scenario switch-cli --count 500 --concurrency 200
+  load-harness --scenario track-console --profile flaky --json out.json
+
+The harness only changes PATH (and the tool caches) for this process
+and its children; nothing reaches a real controller or switch.
+"""
+
+import os
+import sys
+import time
+import json
+import math
+import shutil
+import subprocess
+import tempfile
+import resource
+import threading
+
+import ConsoleUtils
+import ConsoleMux
+import CacheUtils
+import TimeoutUtils
+import FleetUtils
+import FakeDevice
+
+# built-in FakeDevice profiles, on top of FakeDevice.DEFAULT_PROFILE
+PROFILES = {
+    'fast' : {'connect_delay' : 0.0,
+              'command_delay' : 0.0,
+              'jitter' : 0.0,},
+    'lab' : {'connect_delay' : 0.3,
+             'command_delay' : 0.05,
+             'jitter' : 0.5,
+             'connect_fail' : 0.01,
+             'command_fail' : 0.01,},
+    'flaky' : {'connect_delay' : 1.0,
+               'command_delay' : 0.2,
+               'jitter' : 0.9,
+               'connect_fail' : 0.1,
+               'command_fail' : 0.05,},
+}
+
+TOOLS = ('ssh', 'scp', 'sudo', 'floodlight-cli', 'pcli', 'track',)
+
+def getProfile(spec):
+    """Get a profile by name, or from a JSON file."""
+    profile = dict(FakeDevice.DEFAULT_PROFILE)
+    if spec in PROFILES:
+        profile.update(PROFILES[spec])
+    else:
+        with open(spec) as fd:
+            profile.update(json.load(fd))
+    return profile
+
+def getToolsDir():
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def getFakeDevice():
+    return os.path.join(getToolsDir(), "src/bin/fake-device")
+
+class FakeEnv(object):
+    """Put the FakeDevice tools first on PATH.
+
+    Also point the tool caches at a scratch directory and turn off
+    ssh multiplexing and console echo, so that a run neither uses nor
+    pollutes the real state.
+
+    Set 'mux' to also run a console-mux (on a scratch socket) for the
+    track consoles.
+    """
+
+    def __init__(self, profile, mux=False):
+        self.profile = profile
+        self.mux = mux
+        self.dir = None
+        self.saved = {}
+        self.cachePaths = {}
+        self.muxPath = None
+        self.muxProc = None
+
+    def _setenv(self, key, val):
+        self.saved.setdefault(key, os.environ.get(key))
+        os.environ[key] = val
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix="load-harness-")
+        bindir = os.path.join(self.dir, "bin")
+        os.mkdir(bindir)
+        # wrapper scripts rather than symlinks, so that a missing
+        # interpreter cannot fall through to the real tool on PATH
+        fake = getFakeDevice()
+        for tool in TOOLS:
+            p = os.path.join(bindir, tool)
+            with open(p, "w") as fd:
+                fd.write("#!/bin/sh\nexec %s %s %s \"$@\"\n"
+                         % (ConsoleUtils.quote(sys.executable), ConsoleUtils.quote(fake), tool,))
+            os.chmod(p, 0755)
+
+        path = os.path.join(self.dir, "profile.json")
+        with open(path, "w") as fd:
+            json.dump(self.profile, fd, indent=2, sort_keys=True)
+
+        self._setenv('PATH', bindir + os.pathsep + os.environ.get('PATH', ''))
+        self._setenv('FAKE_DEVICE_PROFILE', path)
+        self._setenv('TOOLS_CACHE_DIR', os.path.join(self.dir, "cache"))
+        self._setenv('TESTS_SSH_KEY', os.path.join(self.dir, "id_rsa"))
+
+        # these caches were set up at import time
+        cacheDir = os.environ['TOOLS_CACHE_DIR']
+        for cache in self.getCaches():
+            self.cachePaths[cache] = cache.path
+            cache.path = os.path.join(cacheDir, cache.name + ".json")
+            cache.data = None
+
+        ConsoleUtils.SSH_MUX = False
+        ConsoleUtils.TRANSCRIPT_WRITER.echo = None
+        ConsoleUtils._pubKeyFpr = ConsoleUtils._pubKeyFpr or "load-harness"
+
+        # never attach to the user's console-mux
+        self.muxPath = ConsoleMux.CONSOLE_MUX_SOCKET
+        ConsoleMux.CONSOLE_MUX_SOCKET = os.path.join(self.dir, "console-mux.sock")
+        if self.mux:
+            self.startMux()
+        return self
+
+    def startMux(self, timeout=10.0):
+        cmd = (sys.executable, os.path.join(getToolsDir(), "src/bin/console-mux"),
+               '--socket', ConsoleMux.CONSOLE_MUX_SOCKET,)
+        self.muxProc = subprocess.Popen(cmd)
+        deadline = time.time() + timeout
+        while not ConsoleMux.isRunning():
+            if self.muxProc.poll() is not None or time.time() > deadline:
+                raise RuntimeError("console-mux did not start")
+            time.sleep(0.05)
+
+    def getCaches(self):
+        return (CacheUtils.FILE_DIGEST_CACHE,
+                ConsoleUtils.SSH_KEY_CACHE,
+                ConsoleUtils.SSH_READY_CACHE,
+                TimeoutUtils.TIMEOUT_CACHE,)
+
+    def stop(self):
+        TimeoutUtils.TIMEOUT_POLICY.flush()
+        if self.muxProc is not None:
+            if self.muxProc.poll() is None:
+                self.muxProc.terminate()
+            self.muxProc.wait()
+            self.muxProc = None
+        if self.dir is not None:
+            ConsoleMux.CONSOLE_MUX_SOCKET = self.muxPath
+        for cache, path in self.cachePaths.items():
+            cache.path = path
+            cache.data = None
+        self.cachePaths = {}
+        for key, val in self.saved.items():
+            if val is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = val
+        self.saved = {}
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, tb):
+        self.stop()
+        return False
+
+def countFds():
+    """Return (open fds, pty fds) of this process."""
+    fds = ptys = 0
+    d = "/proc/self/fd"
+    for e in os.listdir(d):
+        try:
+            dst = os.readlink(os.path.join(d, e))
+        except OSError:
+            continue
+        fds += 1
+        if dst == "/dev/ptmx" or dst.startswith("/dev/pts/"):
+            ptys += 1
+    return fds, ptys
+
+def getRss():
+    """Return the resident set size of this process, in bytes."""
+    with open("/proc/self/status") as fd:
+        for line in fd:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+class Sampler(object):
+    """Sample fd, pty and memory use in the background, keep the peaks."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peakFds = self.peakPtys = self.peakRss = 0
+        self.baseFds, self.basePtys = countFds()
+        self.baseRss = getRss()
+        self.thread = None
+        self.event = threading.Event()
+
+    def sample(self):
+        fds, ptys = countFds()
+        rss = getRss()
+        self.peakFds = max(self.peakFds, fds)
+        self.peakPtys = max(self.peakPtys, ptys)
+        self.peakRss = max(self.peakRss, rss)
+
+    def _run(self):
+        while not self.event.is_set():
+            self.sample()
+            self.event.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sample()
+        fds, ptys = countFds()
+        return {'fds' : {'base' : self.baseFds, 'peak' : self.peakFds, 'end' : fds,},
+                'ptys' : {'base' : self.basePtys, 'peak' : self.peakPtys, 'end' : ptys,},
+                'rss' : {'base' : self.baseRss, 'peak' : self.peakRss,},
+                # ru_maxrss is in KiB on Linux
+                'child_maxrss' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,}
+
+def switchCli(target):
+    controller, switch = target
+    sub = ConsoleUtils.SwitchConnectCliSubprocess(controller, switch)
+    return len(sub.check_output(('show', 'version',)))
+
+def controllerCli(target):
+    controller, idx = target
+    sub = ConsoleUtils.ControllerCliSubprocess(controller)
+    buf = sub.check_output(('show', 'switch',))
+    return len(ConsoleUtils.parseCliTable(buf))
+
+def trackConsole(target):
+    sub = ConsoleUtils.TrackConsoleSubprocess(target)
+    sp = sub.spawn()
+    try:
+        sub._findLogin(sp)
+    finally:
+        sp.close(force=True)
+    return 1
+
+SCENARIOS = {
+    'switch-cli' : switchCli,
+    'controller-cli' : controllerCli,
+    'track-console' : trackConsole,
+}
+
+def getTargets(scenario, count, controller="controller"):
+    if scenario == 'switch-cli':
+        return [(controller, "leaf%d" % (i+1),) for i in xrange(count)]
+    if scenario == 'controller-cli':
+        return [(controller, i,) for i in xrange(count)]
+    if scenario == 'track-console':
+        return ["leaf%d" % (i+1) for i in xrange(count)]
+    raise ValueError("invalid scenario %s" % scenario)
+
+def percentile(vals, pct):
+    """Nearest-rank percentile of a sorted list."""
+    if not vals:
+        return None
+    k = int(math.ceil(pct * len(vals) / 100.0)) - 1
+    return vals[max(0, min(len(vals)-1, k))]
+
+def runLoad(scenario, count=100, concurrency=50, controller="controller",
+            timeout=None):
+    """Run 'count' sessions of 'scenario', 'concurrency' at a time.
+
+    Returns a report dictionary (see formatReport).
+    """
+    targets = getTargets(scenario, count, controller=controller)
+    work = SCENARIOS[scenario]
+
+    sampler = Sampler()
+    sampler.start()
+    start = time.time()
+    results = FleetUtils.runFleet(targets, work, workers=concurrency, timeout=timeout)
+    wall = time.time() - start
+    usage = sampler.stop()
+
+    durs = sorted([x.duration for x in results if x.ok and x.duration is not None])
+    errors = {}
+    for res in results:
+        if not res.ok:
+            key = res.exc.__class__.__name__ if res.exc is not None else "exit %s" % res.code
+            errors[key] = errors.get(key, 0) + 1
+
+    return {'scenario' : scenario,
+            'count' : count,
+            'concurrency' : concurrency,
+            'wall' : wall,
+            'ok' : len(durs),
+            'errors' : errors,
+            'throughput' : len(durs) / wall if wall else 0.0,
+            'latency' : {'p50' : percentile(durs, 50),
+                         'p90' : percentile(durs, 90),
+                         'p99' : percentile(durs, 99),
+                         'max' : durs[-1] if durs else None,},
+            'usage' : usage,}
+
+def _fmtSecs(val):
+    return "%.3fs" % val if val is not None else "-"
+
+def formatReport(report, fd=sys.stdout):
+    fd.write("scenario    %s (%d sessions, %d concurrent)\n"
+             % (report['scenario'], report['count'], report['concurrency'],))
+    fd.write("wall        %.2fs\n" % report['wall'])
+    fd.write("ok          %d\n" % report['ok'])
+    for key, cnt in sorted(report['errors'].items()):
+        fd.write("error       %s: %d\n" % (key, cnt,))
+    fd.write("throughput  %.1f sessions/s\n" % report['throughput'])
+    lat = report['latency']
+    fd.write("latency     p50 %s  p90 %s  p99 %s  max %s\n"
+             % (_fmtSecs(lat['p50']), _fmtSecs(lat['p90']),
+                _fmtSecs(lat['p99']), _fmtSecs(lat['max']),))
+    usage = report['usage']
+    fd.write("fds         base %d  peak %d  end %d\n"
+             % (usage['fds']['base'], usage['fds']['peak'], usage['fds']['end'],))
+    fd.write("ptys        base %d  peak %d  end %d\n"
+             % (usage['ptys']['base'], usage['ptys']['peak'], usage['ptys']['end'],))
+    fd.write("rss         base %.1fM  peak %.1fM  (largest child %.1fM)\n"
+             % (usage['rss']['base'] / 1048576.0, usage['rss']['peak'] / 1048576.0,
+                usage['child_maxrss'] / 1048576.0,))
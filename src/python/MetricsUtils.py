@@ -0,0 +1,261 @@
+"""MetricsUtils.py
+
+In-process timing and transfer metrics for ConsoleUtils operations.
+
+Durations are kept as histograms per (operation, phase, host),
+transferred bytes as counters per (operation, host).
+
+Set $TOOLS_METRICS_JSON and/or $TOOLS_METRICS_PROM to a path to
+export the metrics when the process exits; the latter is in the
+Prometheus textfile-collector format (use a .prom suffix).
+
+Phases are also recorded as TraceUtils spans when tracing is enabled.
+"""
+
+import os
+import sys
+import time
+import json
+import atexit
+import tempfile
+import threading
+
+import TraceUtils
+
+# upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,)
+
+class Histogram(object):
+    """Cumulative histogram, as in Prometheus."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, val):
+        i = 0
+        for i, ub in enumerate(self.buckets):
+            if val <= ub:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += val
+        if self.min is None or val < self.min:
+            self.min = val
+        if self.max is None or val > self.max:
+            self.max = val
+
+    def cumulative(self):
+        """Generate (upper bound, cumulative count) pairs."""
+        n = 0
+        for ub, cnt in zip(self.buckets + (float('inf'),), self.counts):
+            n += cnt
+            yield ub, n
+
+    def toJson(self):
+        return {'count' : self.count,
+                'sum' : self.sum,
+                'min' : self.min,
+                'max' : self.max,
+                'buckets' : [[ub if ub != float('inf') else "+Inf", n]
+                             for ub, n in self.cumulative()],}
+
+class Phase(object):
+    """Context manager that times one phase of an operation."""
+
+    def __init__(self, registry, op, name, host, attrs=None):
+        self.registry = registry
+        self.op = op
+        self.name = name
+        self.host = host
+        self.attrs = attrs
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        end = time.time()
+        self.registry.observe(self.op, self.name, self.host,
+                              end - self.start,
+                              failed=type is not None)
+        if TraceUtils.TRACER is not None:
+            args = dict(self.attrs or {})
+            args['host'] = self.host
+            if type is not None:
+                args['error'] = "%s: %s" % (type.__name__, value,)
+            TraceUtils.complete("%s %s" % (self.op, self.name,), self.op,
+                                self.start, end, **args)
+        return False
+
+class Stopwatch(object):
+    """Time consecutive phases of a step-by-step flow.
+
+    Each lap() records the time since the previous lap (or since the
+    stopwatch was started) as the named phase.
+    """
+
+    def __init__(self, registry, op, host=None):
+        self.registry = registry
+        self.op = op
+        self.host = host
+        self.last = time.time()
+
+    def lap(self, name):
+        now = time.time()
+        self.registry.observe(self.op, name, self.host, now - self.last)
+        TraceUtils.complete("%s %s" % (self.op, name,), self.op,
+                            self.last, now, host=self.host)
+        self.last = now
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def observe(self, op, phase, host, secs, failed=False):
+        key = (op, phase, host or "",)
+        with self.lock:
+            hist = self.durations.get(key)
+            if hist is None:
+                hist = self.durations[key] = Histogram()
+            hist.observe(secs)
+            if failed:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def addBytes(self, op, host, count):
+        key = (op, host or "",)
+        with self.lock:
+            self.bytes[key] = self.bytes.get(key, 0) + count
+
+    def phase(self, op, name, host=None, **attrs):
+        return Phase(self, op, name, host, attrs)
+
+    def clear(self):
+        with self.lock:
+            self.durations.clear()
+            self.errors.clear()
+            self.bytes.clear()
+
+    def toJson(self):
+        with self.lock:
+            phases = []
+            for key in sorted(self.durations.keys()):
+                op, phase, host = key
+                ent = {'op' : op, 'phase' : phase, 'host' : host,
+                       'errors' : self.errors.get(key, 0),}
+                ent.update(self.durations[key].toJson())
+                phases.append(ent)
+            xfers = [{'op' : op, 'host' : host, 'bytes' : n,}
+                     for (op, host), n in sorted(self.bytes.items())]
+        return {'time' : time.time(),
+                'pid' : os.getpid(),
+                'argv' : sys.argv,
+                'phases' : phases,
+                'bytes' : xfers,}
+
+    def toPrometheus(self):
+        lines = []
+
+        def labels(**kwargs):
+            return ",".join(['%s="%s"' % (k, _escapeLabel(kwargs[k]),)
+                             for k in sorted(kwargs.keys())])
+
+        with self.lock:
+            lines.append("# HELP tools_phase_duration_seconds Duration of each operation phase.")
+            lines.append("# TYPE tools_phase_duration_seconds histogram")
+            for (op, phase, host), hist in sorted(self.durations.items()):
+                for ub, n in hist.cumulative():
+                    le = "+Inf" if ub == float('inf') else repr(ub)
+                    lines.append("tools_phase_duration_seconds_bucket{%s} %d"
+                                 % (labels(op=op, phase=phase, host=host, le=le), n,))
+                lines.append("tools_phase_duration_seconds_sum{%s} %f"
+                             % (labels(op=op, phase=phase, host=host), hist.sum,))
+                lines.append("tools_phase_duration_seconds_count{%s} %d"
+                             % (labels(op=op, phase=phase, host=host), hist.count,))
+
+            lines.append("# HELP tools_phase_errors_total Phases that ended with an exception.")
+            lines.append("# TYPE tools_phase_errors_total counter")
+            for (op, phase, host), n in sorted(self.errors.items()):
+                lines.append("tools_phase_errors_total{%s} %d"
+                             % (labels(op=op, phase=phase, host=host), n,))
+
+            lines.append("# HELP tools_transfer_bytes_total Bytes transferred.")
+            lines.append("# TYPE tools_transfer_bytes_total counter")
+            for (op, host), n in sorted(self.bytes.items()):
+                lines.append("tools_transfer_bytes_total{%s} %d"
+                             % (labels(op=op, host=host), n,))
+
+        return "\n".join(lines) + "\n"
+
+    def writeJson(self, path):
+        _writeFile(path, json.dumps(self.toJson(), indent=2, sort_keys=True) + "\n")
+
+    def writePrometheus(self, path):
+        _writeFile(path, self.toPrometheus())
+
+def _escapeLabel(s):
+    return str(s).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _writeFile(path, buf):
+    """Write atomically, so that a collector never sees a partial file."""
+    d = os.path.dirname(os.path.abspath(path))
+    fno, p = tempfile.mkstemp(prefix=".metrics-", dir=d)
+    try:
+        with os.fdopen(fno, "w") as fd:
+            fd.write(buf)
+        os.chmod(p, 0644)
+        os.rename(p, path)
+    finally:
+        if os.path.exists(p):
+            os.unlink(p)
+
+METRICS = MetricsRegistry()
+
+def phase(op, name, host=None, **attrs):
+    """Time a phase of an operation, e.g.
+
+    with MetricsUtils.phase("enableRoot", "login", host):
+        ...
+
+    Extra keyword arguments (e.g. cmd) are only used as trace attributes.
+    """
+    return METRICS.phase(op, name, host, **attrs)
+
+def stopwatch(op, host=None):
+    return Stopwatch(METRICS, op, host)
+
+def observe(op, name, host, secs, failed=False):
+    METRICS.observe(op, name, host, secs, failed=failed)
+
+def addBytes(op, host, count):
+    METRICS.addBytes(op, host, count)
+
+def export():
+    """Write the metrics files requested by the environment."""
+    path = os.environ.get('TOOLS_METRICS_JSON')
+    if path:
+        try:
+            METRICS.writeJson(path)
+        except (IOError, OSError), what:
+            sys.stderr.write("*** cannot write %s: %s\n" % (path, str(what),))
+    path = os.environ.get('TOOLS_METRICS_PROM')
+    if path:
+        try:
+            METRICS.writePrometheus(path)
+        except (IOError, OSError), what:
+            sys.stderr.write("*** cannot write %s: %s\n" % (path, str(what),))
+
+
+atexit.register(export)
@@ -0,0 +1,178 @@
+"""TimeoutUtils.py
+
+Learned, per-host timeouts for interactive (pexpect) sessions.
+
+Each wait is keyed by host and operation, where the operation is
+the prompt that was last matched, the first word of the input sent
+since, and the prompt that is expected next (e.g. "[>] $ -> [>] $
+(enable)"), so that only repeated prompt transitions share samples.
+Waits for command output should not be adaptive at all (see
+ConsoleUtils.ConsoleSpawnMixin.expect).  Observed latencies are kept in a
+small persistent cache, and each key has a limit from a high
+percentile of the recent latencies plus a margin, never more than the
+fixed timeout passed by the caller (e.g. ConsoleUtils.TIMEOUT_SHORT).
+A wait that runs past its limit widens it, and still waits for the
+fixed timeout.
+
+Set $TIMEOUT_ADAPTIVE=0 to always wait for the fixed timeouts.
+"""
+
+import os
+import re
+import time
+import math
+import atexit
+import threading
+
+import CacheUtils
+
+TIMEOUT_ADAPTIVE = os.environ.get('TIMEOUT_ADAPTIVE', '1') not in ('', '0', 'no',)
+
+# wait for TIMEOUT_MARGIN times the TIMEOUT_PERCENTILE latency,
+# plus TIMEOUT_SLACK seconds, but at least TIMEOUT_FLOOR seconds
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_MARGIN = 1.5
+TIMEOUT_SLACK = 0.5
+TIMEOUT_FLOOR = 1.0
+
+# use the fixed timeout until there are this many samples
+TIMEOUT_MIN_SAMPLES = 5
+
+# samples kept per key, and keys kept in the cache
+TIMEOUT_SAMPLES = 50
+TIMEOUT_MAX_KEYS = 2000
+
+# seconds between cache writes
+TIMEOUT_FLUSH_INTERVAL = 30
+
+# input sent at these prompts is never part of a key
+PASSWORD_RX = re.compile("assword|assphrase")
+
+def percentile(vals, pct):
+    """Nearest-rank percentile of a sorted list."""
+    k = int(math.ceil(pct * len(vals) / 100.0)) - 1
+    return vals[max(0, min(len(vals)-1, k))]
+
+def getOp(prev, pattern, sent=None):
+    """Describe a wait by the previous and the expected pattern.
+
+    Only the first word of the input sent in between is kept, and
+    none of it after a password prompt.
+    """
+    op = "%s -> %s" % (prev or "spawn", pattern,)
+    words = (sent or "").split(None, 1)
+    if words and not (prev and PASSWORD_RX.search(prev)):
+        if isinstance(words[0], unicode):
+            words[0] = words[0].encode('utf-8')
+        op += " (%s)" % words[0][:32]
+    return op
+
+class TimeoutPolicy(object):
+    """Learn a limit for each wait from the recent latencies.
+
+    Each wait in a row that runs past its limit doubles the limit for
+    that key, up to the fixed timeout; waits that time out are not
+    recorded (the host is likely down, not slow).
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.samples = {}
+        self.misses = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.lastFlush = time.time()
+        self.registered = False
+
+    def _key(self, host, op):
+        return "%s|%s" % (host or "-", op,)
+
+    def _getSamples(self, key):
+        samples = self.samples.get(key)
+        if samples is None:
+            ent = self.cache.get(key) or {}
+            samples = self.samples[key] = list(ent.get('samples', []))
+        return samples
+
+    def getTimeout(self, host, op, cap):
+        """Return the limit for the next wait, at most 'cap'."""
+        if not TIMEOUT_ADAPTIVE or cap is None:
+            return cap
+        key = self._key(host, op)
+        with self.lock:
+            samples = self._getSamples(key)
+            if len(samples) < TIMEOUT_MIN_SAMPLES:
+                return cap
+            val = percentile(sorted(samples), TIMEOUT_PERCENTILE)
+            misses = self.misses.get(key, 0)
+        val = max(TIMEOUT_FLOOR, val * TIMEOUT_MARGIN + TIMEOUT_SLACK)
+        val *= 1 << min(misses, 16)
+        return min(cap, val)
+
+    def observe(self, host, op, secs):
+        """Record a completed wait."""
+        key = self._key(host, op)
+        with self.lock:
+            samples = self._getSamples(key)
+            samples.append(round(secs, 3))
+            del samples[:-TIMEOUT_SAMPLES]
+            self.misses.pop(key, None)
+            self.dirty.add(key)
+            if not self.registered:
+                atexit.register(self.flush)
+                self.registered = True
+            due = time.time() - self.lastFlush > TIMEOUT_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def miss(self, host, op):
+        """Record a wait that ran past its limit."""
+        key = self._key(host, op)
+        with self.lock:
+            self.misses[key] = self.misses.get(key, 0) + 1
+
+    def flush(self):
+        """Write the new samples to the cache."""
+        now = time.time()
+        with self.lock:
+            self.lastFlush = now
+            if not self.dirty:
+                return
+            m = {}
+            for key in self.dirty:
+                m[key] = {'samples' : self.samples[key], 'updated' : now,}
+            self.dirty = set()
+
+        # drop the least recently updated keys
+        data = dict(self.cache.load(reload=True))
+        data.update(m)
+        remove = []
+        if len(data) > TIMEOUT_MAX_KEYS:
+            keys = sorted(data.keys(), key=lambda x: data[x].get('updated', 0))
+            remove = keys[:len(data)-TIMEOUT_MAX_KEYS]
+        self.cache.update(m, remove=remove)
+
+    def clear(self, host=None):
+        """Forget the samples for a host (or for all hosts)."""
+        with self.lock:
+            pfx = None if host is None else "%s|" % host
+            keys = [x for x in self.cache.load(reload=True).keys()
+                    if pfx is None or x.startswith(pfx)]
+            for key in self.samples.keys():
+                if pfx is None or key.startswith(pfx):
+                    self.samples.pop(key)
+                    self.misses.pop(key, None)
+                    self.dirty.discard(key)
+        self.cache.update(remove=keys)
+
+TIMEOUT_CACHE = CacheUtils.JsonCache("timeouts")
+TIMEOUT_POLICY = TimeoutPolicy(TIMEOUT_CACHE)
+
+def getTimeout(host, op, cap):
+    return TIMEOUT_POLICY.getTimeout(host, op, cap)
+
+def observe(host, op, secs):
+    TIMEOUT_POLICY.observe(host, op, secs)
+
+def miss(host, op):
+    TIMEOUT_POLICY.miss(host, op)
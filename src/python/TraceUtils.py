@@ -0,0 +1,144 @@
+"""TraceUtils.py
+
+Timeline tracing in the Chrome trace-event format.
+
+Set $TOOLS_TRACE to a file name to record the spans of a run (script
+steps, subprocess calls, expect waits, transfers); the file is written
+at exit and can be opened in chrome://tracing or ui.perfetto.dev.
+
+Tracing is off by default, in which case span() returns a shared no-op
+context manager.
+"""
+
+import os
+import sys
+import time
+import json
+import atexit
+import threading
+import functools
+
+TRACE_PATH = os.environ.get('TOOLS_TRACE')
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+    def set(self, **kwargs):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is not None:
+            self.args['error'] = "%s: %s" % (type.__name__, value,)
+        self.tracer.complete(self.name, self.cat, self.start, time.time(), self.args)
+        return False
+
+    def set(self, **kwargs):
+        """Add attributes to the span."""
+        self.args.update(kwargs)
+
+class Tracer(object):
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def _tid(self):
+        thr = threading.current_thread()
+        tid = self.threads.get(thr.ident)
+        if tid is None:
+            tid = self.threads[thr.ident] = len(self.threads)+1
+            self.events.append({'name' : 'thread_name', 'ph' : 'M',
+                                'pid' : self.pid, 'tid' : tid,
+                                'args' : {'name' : thr.name,},})
+        return tid
+
+    def complete(self, name, cat, start, end, args=None):
+        ev = {'name' : name, 'cat' : cat, 'ph' : 'X',
+              'ts' : int((start - self.t0) * 1e6),
+              'dur' : int((end - start) * 1e6),
+              'pid' : self.pid,}
+        if args:
+            ev['args'] = dict([(k, v if isinstance(v, (int, long, float, bool, type(None),)) else str(v),)
+                               for k, v in args.iteritems()])
+        with self.lock:
+            ev['tid'] = self._tid()
+            self.events.append(ev)
+
+    def toJson(self):
+        with self.lock:
+            events = list(self.events)
+        meta = {'name' : 'process_name', 'ph' : 'M', 'pid' : self.pid, 'tid' : 0,
+                'args' : {'name' : " ".join([os.path.basename(sys.argv[0])] + sys.argv[1:]),},}
+        return {'traceEvents' : [meta,] + events,
+                'displayTimeUnit' : 'ms',}
+
+    def write(self, path):
+        with open(path, "w") as fd:
+            json.dump(self.toJson(), fd)
+
+TRACER = Tracer() if TRACE_PATH else None
+
+def enabled():
+    return TRACER is not None
+
+def span(name, cat="step", **args):
+    """Record a (possibly nested) span, e.g.
+
+    with TraceUtils.span("upload", host=host):
+        ...
+    """
+    if TRACER is None:
+        return NULL_SPAN
+    return Span(TRACER, name, cat, args)
+
+def complete(name, cat, start, end, **args):
+    """Record a span that has already finished."""
+    if TRACER is None:
+        return
+    TRACER.complete(name, cat, start, end, args)
+
+def traced(name=None, cat="step"):
+    """Decorator that records a span for each call."""
+    def deco(fn):
+        spanName = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if TRACER is None:
+                return fn(*args, **kwargs)
+            with Span(TRACER, spanName, cat, {'args' : args,}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def export():
+    if TRACER is None:
+        return
+    try:
+        TRACER.write(TRACE_PATH)
+    except (IOError, OSError), what:
+        sys.stderr.write("*** cannot write %s: %s\n" % (TRACE_PATH, str(what),))
+
+atexit.register(export)
@@ -1,13 +1,86 @@
 """TrackUtils.py
+
+Switch lookups via biglab.track.
+
+Decoded switch records are cached in memory and on disk for
+TRACK_CACHE_TTL seconds (set $TRACK_CACHE_TTL=0 to always ask track).
 """
 
+import os
 import json
+import time
 import argparse
+import threading
+import Queue
 import biglab.track
 
 from IpUtils import ntop, pton, mton
+import CacheUtils
+import FleetUtils
+
+TRACK_CACHE_TTL = int(os.environ.get('TRACK_CACHE_TTL', '3600'))
+
+# concurrent lookups in getSwitches
+TRACK_WORKERS = 8
+
+class SwitchCache(object):
+    """Track switch records, in memory and in a JsonCache."""
+
+    def __init__(self, cache, ttl=TRACK_CACHE_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def _fresh(self, ent, now):
+        return ent is not None and now - ent.get('time', 0) < self.ttl
+
+    def get(self, switch):
+        """Return a (found, record) pair."""
+        if self.ttl <= 0:
+            return False, None
+        now = time.time()
+        with self.lock:
+            ent = self.data.get(switch)
+        if not self._fresh(ent, now):
+            ent = self.cache.get(switch)
+            if not self._fresh(ent, now):
+                return False, None
+            with self.lock:
+                self.data[switch] = ent
+        return True, ent['data']
+
+    def putMany(self, m):
+        """Save several records at once (one cache write)."""
+        if self.ttl <= 0 or not m:
+            return
+        now = time.time()
+        ents = dict([(k, {'time' : now, 'data' : v},) for k, v in m.items()])
+        with self.lock:
+            self.data.update(ents)
+        self.cache.update(ents)
+
+    def invalidate(self, switch=None):
+        with self.lock:
+            if switch is None:
+                keys = self.cache.load(reload=True).keys()
+                self.data = {}
+            else:
+                keys = [switch]
+                self.data.pop(switch, None)
+        self.cache.update(remove=keys)
+
+SWITCH_CACHE = SwitchCache(CacheUtils.JsonCache("track"))
 
 class BigTrack(biglab.track.BigTrack):
+    """Track client with cached and bulk switch lookups.
+
+    NOTE that biglab.track makes a new HTTP request (and connection)
+    for each REST call, and has no bulk query; the best we can do is
+    to reuse initialized clients (see getBigTrack and TRACK_POOL), skip
+    the requests that the cache can answer, and run the rest a few at
+    a time.
+    """
 
     def __init__(self):
         biglab.track.BigTrack.__init__(self)
@@ -15,15 +88,94 @@ class BigTrack(biglab.track.BigTrack):
         ns.username = ns.port = ns.server = None
         self.Init(ns)
 
-    def getSwitch(self, switch):
+    def _fetchSwitch(self, switch):
         url = "show/%s/" % switch
         data = json.loads(self._BigTrack__restGet(url))
         if not data: return None
         return data[0]
 
+    def getSwitch(self, switch, refresh=False):
+        if not refresh:
+            found, data = SWITCH_CACHE.get(switch)
+            if found:
+                return data
+        data = self._fetchSwitch(switch)
+        if data is not None:
+            SWITCH_CACHE.putMany({switch : data})
+        return data
+
+    def getSwitches(self, switches, refresh=False, workers=TRACK_WORKERS):
+        """Look up several switches, return a dictionary of records.
+
+        Unknown switches map to None.
+        """
+        m = {}
+        missing = []
+        for switch in switches:
+            found, data = (False, None) if refresh else SWITCH_CACHE.get(switch)
+            if found:
+                m[switch] = data
+            elif switch not in missing:
+                missing.append(switch)
+        if not missing:
+            return m
+
+        # the client may not be thread-safe; each lookup borrows an
+        # idle client, so there are never more clients than workers
+        def work(switch):
+            bt = _borrowClient()
+            try:
+                return bt._fetchSwitch(switch)
+            finally:
+                TRACK_POOL.put(bt)
+        results = FleetUtils.runFleet(missing, work, workers=workers)
+
+        new = {}
+        for res in results:
+            if res.exc is not None:
+                res.reraise()
+            m[res.target] = res.value
+            if res.value is not None:
+                new[res.target] = res.value
+        SWITCH_CACHE.putMany(new)
+        return m
+
     def getSwitchV6Address(self, switch):
         data = self.getSwitch(switch)
         if data is None: return None
         netInt = pton("fe80::")
         hostInt = mton(data['Ethernet'])
         return ntop(netInt | hostInt)
+
+    def getSwitchV6Addresses(self, switches, refresh=False):
+        """Look up the link-local addresses of several switches.
+
+        Unknown switches map to None.
+        """
+        netInt = pton("fe80::")
+        m = {}
+        for switch, data in self.getSwitches(switches, refresh=refresh).items():
+            if data is None:
+                m[switch] = None
+            else:
+                m[switch] = ntop(netInt | mton(data['Ethernet']))
+        return m
+
+# idle clients for getSwitches
+# (FleetUtils starts a new thread for each lookup)
+TRACK_POOL = Queue.Queue()
+
+def _borrowClient():
+    try:
+        return TRACK_POOL.get_nowait()
+    except Queue.Empty:
+        return BigTrack()
+
+TRACK_LOCAL = threading.local()
+
+def getBigTrack():
+    """Get the (per-thread) shared BigTrack client."""
+    bt = getattr(TRACK_LOCAL, 'bt', None)
+    if bt is None:
+        bt = TRACK_LOCAL.bt = BigTrack()
+    return bt